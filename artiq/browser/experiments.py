@@ -286,6 +286,10 @@ class LocalDatasetDB:
     def update(self, mod):
         self.dataset_sub.update(mod)
 
+    def update_batch(self, mods):
+        for mod in mods:
+            self.dataset_sub.update(mod)
+
 
 class ExperimentsArea(QtWidgets.QMdiArea):
     def __init__(self, root, dataset_sub):
@@ -302,8 +306,11 @@ class ExperimentsArea(QtWidgets.QMdiArea):
         self.worker_handlers = {
             "get_device_db": lambda: {},
             "get_device": lambda key, resolve_alias=False: {"type": "dummy"},
+            # no snapshot, all devices are dummies
+            "get_device_db_snapshot": lambda known_version=None: (None, None),
             "get_dataset": self._ddb.get,
             "update_dataset": self._ddb.update,
+            "update_dataset_batch": self._ddb.update_batch,
         }
 
     def dataset_changed(self, path):
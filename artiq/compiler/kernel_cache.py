@@ -0,0 +1,160 @@
+"""Persistent on-disk cache of compiled kernels.
+
+Entries are keyed on the generated LLVM IR, which contains the values of
+the host objects quoted into the kernel, together with everything else
+that determines the output of the LLVM backend and of the linker.
+The least recently used entries are removed once the total size of the
+cache exceeds its limit.
+
+The cache is enabled by setting the ``ARTIQ_KERNEL_CACHE`` environment
+variable to the cache directory. ``ARTIQ_KERNEL_CACHE_SIZE`` sets the size
+limit in bytes.
+"""
+
+import os
+import struct
+import hashlib
+import tempfile
+import logging
+from functools import lru_cache
+
+from llvmlite import binding as llvm
+
+from artiq import __version__ as artiq_version
+
+
+__all__ = ["KernelCache", "get_kernel_cache"]
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_SIZE = 256*1024*1024
+
+_MAGIC = b"ARTIQKC2"
+_length = struct.Struct("<I")
+
+# Dumping these would require running the backend.
+_DUMP_VARIABLES = ["ARTIQ_DUMP_UNOPT_LLVM", "ARTIQ_DUMP_LLVM",
+                   "ARTIQ_DUMP_ASM", "ARTIQ_DUMP_OBJ", "ARTIQ_DUMP_ELF"]
+
+
+@lru_cache(maxsize=None)
+def _linker_script_hash():
+    with open(os.path.join(os.path.dirname(__file__), "kernel.ld"), "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class KernelCache:
+    """Stores lists of binary blobs (e.g. kernel object and stripped
+    library) in ``directory``, keeping its total size below ``max_size``
+    bytes."""
+    def __init__(self, directory, max_size=DEFAULT_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+
+    def key(self, target, llvm_ir):
+        """Returns the cache key of the kernel compiled from ``llvm_ir``
+        for ``target``."""
+        h = hashlib.sha256(_MAGIC)
+        for part in [artiq_version,
+                     ".".join(str(v) for v in llvm.llvm_version_info),
+                     _linker_script_hash(),
+                     type(target).__name__, target.triple, target.data_layout,
+                     ",".join(target.features),
+                     " ".join(target.additional_linker_options),
+                     target.tool_ld, target.tool_strip,
+                     str(target.strip_in_linker),
+                     str(target.subkernel_id)]:
+            h.update(part.encode())
+            h.update(b"\0")
+        h.update(llvm_ir.encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".bin")
+
+    def get(self, key):
+        """Returns the blobs stored under ``key``, or ``None``."""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # mark as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        try:
+            if data[:len(_MAGIC)] != _MAGIC:
+                raise ValueError("bad magic")
+            offset = len(_MAGIC)
+            count, = _length.unpack_from(data, offset)
+            offset += _length.size
+            blobs = []
+            for _ in range(count):
+                length, = _length.unpack_from(data, offset)
+                offset += _length.size
+                if offset + length > len(data):
+                    raise ValueError("truncated entry")
+                blobs.append(data[offset:offset+length])
+                offset += length
+        except (ValueError, struct.error):
+            logger.warning("removing corrupted kernel cache entry %s", path,
+                           exc_info=True)
+            self._remove(path)
+            return None
+        return blobs
+
+    def put(self, key, blobs):
+        """Stores ``blobs`` under ``key``, then evicts the least recently
+        used entries if the cache has grown too large."""
+        os.makedirs(self.directory, exist_ok=True)
+        parts = [_MAGIC, _length.pack(len(blobs))]
+        for blob in blobs:
+            parts.append(_length.pack(len(blob)))
+            parts.append(blob)
+        with tempfile.NamedTemporaryFile("wb", dir=self.directory,
+                                         suffix=".tmp", delete=False) as f:
+            f.write(b"".join(parts))
+            tmpname = f.name
+        os.replace(tmpname, self._path(key))
+        self.evict()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        entries = []
+        total_size = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith(".bin"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total_size += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            logger.debug("evicting kernel cache entry %s", path)
+            self._remove(path)
+            total_size -= size
+
+
+def get_kernel_cache():
+    """Returns the cache configured by the environment, or ``None`` if it is
+    disabled or if LLVM IR or backend output dumps are requested."""
+    directory = os.getenv("ARTIQ_KERNEL_CACHE")
+    if not directory:
+        return None
+    if any(os.getenv(variable) is not None for variable in _DUMP_VARIABLES):
+        return None
+    max_size = int(os.getenv("ARTIQ_KERNEL_CACHE_SIZE", DEFAULT_SIZE))
+    return KernelCache(directory, max_size)
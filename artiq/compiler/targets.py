@@ -81,6 +81,9 @@ class Target:
         provided by the target, e.g. ``"printf"``.
     :var now_pinning: (boolean)
         Whether the target implements the now-pinning RTIO optimization.
+    :var strip_in_linker: (boolean)
+        Whether :meth:`link_stripped` has the linker omit the debug information,
+        instead of running ``tool_strip`` on the linked library.
     """
     triple = "unknown"
     data_layout = ""
@@ -88,6 +91,7 @@ class Target:
     additional_linker_options = []
     print_function = "printf"
     now_pinning = True
+    strip_in_linker = True
 
     tool_ld = "ld.lld"
     tool_strip = "llvm-strip"
@@ -139,7 +143,11 @@ class Target:
         llpassmgr.run(llmodule)
 
     def compile(self, module):
-        """Compile the module to a relocatable object for this target."""
+        """Compile the module to an optimized LLVM module for this target."""
+        return self.compile_llvm_ir(self.build_llvm_ir(module))
+
+    def build_llvm_ir(self, module):
+        """Generate the LLVM IR of the module, as text."""
 
         if os.getenv("ARTIQ_DUMP_SIG"):
             print("====== MODULE_SIGNATURE DUMP ======", file=sys.stderr)
@@ -153,13 +161,18 @@ class Target:
         _dump(os.getenv("ARTIQ_DUMP_IR"), "ARTIQ IR", suffix + ".txt",
               lambda: "\n".join(fn.as_entity(type_printer) for fn in module.artiq_ir))
 
-        llmod = module.build_llvm_ir(self)
+        return str(module.build_llvm_ir(self))
+
+    def compile_llvm_ir(self, llir):
+        """Parse, verify and optimize LLVM IR text."""
+        suffix = "_subkernel_{}".format(self.subkernel_id) if self.subkernel_id is not None else ""
 
         try:
-            llparsedmod = llvm.parse_assembly(str(llmod))
+            # A separate LLVM context allows compiling in several threads.
+            llparsedmod = llvm.parse_assembly(llir, context=llvm.create_context())
             llparsedmod.verify()
         except RuntimeError:
-            _dump("", "LLVM IR (broken)", ".ll", lambda: str(llmod))
+            _dump("", "LLVM IR (broken)", ".ll", lambda: llir)
             raise
 
         _dump(os.getenv("ARTIQ_DUMP_UNOPT_LLVM"), "LLVM IR (generated)", suffix + "_unopt.ll",
@@ -183,9 +196,10 @@ class Target:
 
         return llmachine.emit_object(llmodule)
 
-    def link(self, objects):
+    def link(self, objects, strip_debug=False):
         """Link the relocatable objects into a shared library for this target."""
         with RunTool([self.tool_ld, "-shared", "--eh-frame-hdr"] +
+                     (["--strip-debug"] if strip_debug else []) +
                      self.additional_linker_options +
                      ["-T" + os.path.join(os.path.dirname(__file__), "kernel.ld")] +
                      ["{{obj{}}}".format(index) for index in range(len(objects))] +
@@ -204,6 +218,15 @@ class Target:
     def compile_and_link(self, modules):
         return self.link([self.assemble(self.compile(module)) for module in modules])
 
+    def link_stripped(self, objects):
+        """Link the relocatable objects into a shared library without debug
+        information."""
+        # keep dumping the library with debug information
+        if self.strip_in_linker and not os.getenv("ARTIQ_DUMP_ELF"):
+            return self.link(objects, strip_debug=True)
+        else:
+            return self.strip(self.link(objects))
+
     def strip(self, library):
         with RunTool([self.tool_strip, "--strip-debug", "{library}", "-o", "{output}"],
                      library=library, output=None) \
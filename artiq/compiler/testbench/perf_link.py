@@ -0,0 +1,44 @@
+import sys
+from pythonparser import diagnostic
+from ..module import Module, Source
+from ..targets import RV32GTarget
+from . import benchmark
+
+def main():
+    if not len(sys.argv) == 2:
+        print("Expected exactly one module filename", file=sys.stderr)
+        exit(1)
+
+    def process_diagnostic(diag):
+        print("\n".join(diag.render()), file=sys.stderr)
+        if diag.level in ("fatal", "error"):
+            exit(1)
+
+    engine = diagnostic.Engine()
+    engine.process = process_diagnostic
+
+    filename = sys.argv[1]
+    with open(filename) as f:
+        code = f.read()
+    source = Source.from_string(code, filename, engine=engine)
+    module = Module(source)
+
+    target = RV32GTarget()
+    elf_obj = target.assemble(target.compile(module))
+
+    def link_then_strip():
+        return target.strip(target.link([elf_obj]))
+
+    stripped_separately = link_then_strip()
+    stripped_by_linker = target.link([elf_obj], strip_debug=True)
+    print("Library size: {} bytes with {}, {} bytes with --strip-debug".format(
+        len(stripped_separately), target.tool_strip, len(stripped_by_linker)))
+
+    benchmark(link_then_strip,
+              "Linking, then stripping with {}".format(target.tool_strip))
+
+    benchmark(lambda: target.link([elf_obj], strip_debug=True),
+              "Linking with --strip-debug")
+
+if __name__ == "__main__":
+    main()
@@ -199,7 +199,9 @@ class CommKernel:
             return
         self.socket = create_connection(self.host, self.port)
         self.socket.sendall(b"ARTIQ coredev\n")
-        endian = self._read(1)
+        self._set_endian(self._read(1))
+
+    def _set_endian(self, endian):
         if endian == b"e":
             self.endian = "<"
         elif endian == b"E":
@@ -738,3 +740,77 @@ class CommKernel:
                 self._read_expect(Reply.KernelFinished)
                 self._process_async_error()
                 return
+
+
+class CommKernelMux(CommKernel):
+    """Core device connection through the ``aqctl_corecomm_proxy`` daemon
+    listening on the Unix socket ``path``.
+
+    The proxy keeps a single connection to the core device open across
+    processes and runs, and serves one client at a time. A session is
+    acquired when the first request is sent, and released once the kernel
+    has finished. Data sent to the core device is framed as a 32-bit
+    little-endian length followed by the payload, a zero length releasing
+    the session.
+    """
+    _frame_length = struct.Struct("<I")
+
+    def __init__(self, path):
+        CommKernel.__init__(self, None)
+        self.path = path
+        self.system_info_validated = False
+
+    def open(self):
+        if hasattr(self, "socket"):
+            return
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.socket.connect(self.path)
+        except:
+            self.socket.close()
+            del self.socket
+            raise
+        self._set_endian(self._read(1))
+        self.system_info_validated = bool(self._read_int8())
+
+    def close(self):
+        # the proxy then resets its core device connection
+        self.read_buffer.clear()
+        self.write_buffer.clear()
+        CommKernel.close(self)
+
+    def release(self):
+        """Ends the session, leaving the core device connection to other
+        clients."""
+        if not hasattr(self, "socket"):
+            return
+        self.socket.sendall(self._frame_length.pack(0))
+        self.socket.close()
+        del self.socket
+        self.read_buffer.clear()
+
+    def _flush(self):
+        if self.write_buffer:
+            self.socket.sendall(self._frame_length.pack(len(self.write_buffer))
+                                + self.write_buffer)
+            self.write_buffer.clear()
+
+    def check_system_info(self):
+        self.open()
+        if not self.system_info_validated:
+            CommKernel.check_system_info(self)
+
+    def serve(self, embedding_map, symbolizer, demangler):
+        clean = False
+        try:
+            CommKernel.serve(self, embedding_map, symbolizer, demangler)
+            clean = True
+        except Exception as exn:
+            # exceptions raised by the kernel are received in full
+            clean = hasattr(exn, "artiq_core_exception")
+            raise
+        finally:
+            if clean:
+                self.release()
+            else:
+                self.close()
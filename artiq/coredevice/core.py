@@ -1,7 +1,10 @@
 import os, sys
 import numpy
+from time import monotonic
 from inspect import getfullargspec
 from functools import wraps
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from pythonparser import diagnostic
 
@@ -14,8 +17,10 @@ from artiq.language.units import *
 from artiq.compiler.module import Module
 from artiq.compiler.embedding import Stitcher
 from artiq.compiler.targets import RV32IMATarget, RV32GTarget, CortexA9Target
+from artiq.compiler.kernel_cache import get_kernel_cache
 
-from artiq.coredevice.comm_kernel import CommKernel, CommKernelDummy
+from artiq.coredevice.comm_kernel import (CommKernel, CommKernelDummy,
+                                          CommKernelMux)
 # Import for side effects (creating the exception classes).
 from artiq.coredevice import exceptions
 
@@ -85,6 +90,9 @@ class Core:
         (optional).
     :param analyze_at_run_end: automatically trigger the core device analyzer
         proxy after the Experiment's run stage finishes.
+    :param comm_proxy: path of the Unix socket of a ``aqctl_corecomm_proxy``
+        instance to connect through, instead of connecting to ``host``
+        directly (optional).
     """
 
     kernel_invariants = {
@@ -95,7 +103,7 @@ class Core:
                  host, ref_period,
                  analyzer_proxy=None, analyze_at_run_end=False,
                  ref_multiplier=8,
-                 target="rv32g", satellite_cpu_targets={}):
+                 target="rv32g", satellite_cpu_targets={}, comm_proxy=None):
         self.ref_period = ref_period
         self.ref_multiplier = ref_multiplier
         self.satellite_cpu_targets = satellite_cpu_targets
@@ -103,12 +111,16 @@ class Core:
         self.coarse_ref_period = ref_period*ref_multiplier
         if host is None:
             self.comm = CommKernelDummy()
+        elif comm_proxy is not None:
+            self.comm = CommKernelMux(comm_proxy)
         else:
             self.comm = CommKernel(host)
         self.analyzer_proxy_name = analyzer_proxy
         self.analyze_at_run_end = analyze_at_run_end
 
         self.first_run = True
+        # phase -> total duration in seconds, see get_timings()
+        self.timings = dict()
         self.dmgr = dmgr
         self.core = self
         self.comm.core = self
@@ -123,10 +135,51 @@ class Core:
         """
         self.comm.close()
 
+    def _add_timing(self, phase, start):
+        self.timings[phase] = self.timings.get(phase, 0.0) + monotonic() - start
+
+    def get_timings(self):
+        """Returns the total time in seconds spent in each phase of running
+        kernels since the last call: ``compile`` (frontend), ``codegen``
+        (LLVM), ``link``, ``subkernels`` (compilation and upload), ``load``
+        and ``serve`` (execution, including RPCs)."""
+        timings, self.timings = self.timings, dict()
+        return timings
+
     def compile(self, function, args, kwargs, set_result=None,
                 attribute_writeback=True, print_as_rpc=True,
                 target=None, destination=0, subkernel_arg_types=[],
                 old_embedding_map=None):
+        start = monotonic()
+        embedding_map, target, llir, subkernel_arg_types = \
+            self._compile_frontend(function, args, kwargs, set_result,
+                                   attribute_writeback, print_as_rpc,
+                                   target, destination, subkernel_arg_types,
+                                   old_embedding_map)
+        self._add_timing("compile", start)
+        kernel_object, stripped_library = self._compile_backend(
+            target, llir, timed=True)
+
+        # The library with debug information is only needed to
+        # symbolize backtraces, so only link it then.
+        library = None
+        def symbolize(addresses):
+            nonlocal library
+            if library is None:
+                library = target.link([kernel_object])
+            return target.symbolize(library, addresses)
+
+        return embedding_map, stripped_library, \
+               symbolize, \
+               lambda symbols: target.demangle(symbols), \
+               subkernel_arg_types
+
+    def _compile_frontend(self, function, args, kwargs, set_result,
+                          attribute_writeback, print_as_rpc,
+                          target, destination, subkernel_arg_types,
+                          old_embedding_map):
+        # Returns the embedding map, target, LLVM IR and subkernel argument
+        # types. This uses host objects and must run in the calling thread.
         try:
             engine = _DiagnosticEngine(all_errors_are_fatal=True)
 
@@ -142,23 +195,49 @@ class Core:
                 attribute_writeback=attribute_writeback)
             target = target if target is not None else self.target_cls()
 
-            library = target.compile_and_link([module])
-            stripped_library = target.strip(library)
-
-            return stitcher.embedding_map, stripped_library, \
-                   lambda addresses: target.symbolize(library, addresses), \
-                   lambda symbols: target.demangle(symbols), \
+            return stitcher.embedding_map, target, \
+                   target.build_llvm_ir(module), \
                    module.subkernel_arg_types
         except diagnostic.Error as error:
             raise CompileError(error.diagnostic) from error
 
+    def _compile_backend(self, target, llir, timed=False):
+        # Returns the relocatable object and the stripped library.
+        # This only uses the LLVM IR text and can run in any thread,
+        # but only records timings if timed is set (calling thread only).
+        cache = get_kernel_cache()
+        if cache is None:
+            key = None
+        else:
+            key = cache.key(target, llir)
+            blobs = cache.get(key)
+            if blobs is not None:
+                return blobs
+        start = monotonic()
+        kernel_object = target.assemble(target.compile_llvm_ir(llir))
+        if timed:
+            self._add_timing("codegen", start)
+            start = monotonic()
+        blobs = [kernel_object, target.link_stripped([kernel_object])]
+        if timed:
+            self._add_timing("link", start)
+        if cache is not None:
+            cache.put(key, blobs)
+        return blobs
+
     def _run_compiled(self, kernel_library, embedding_map, symbolizer, demangler):
         if self.first_run:
             self.comm.check_system_info()
             self.first_run = False
+        start = monotonic()
         self.comm.load(kernel_library)
-        self.comm.run()
-        self.comm.serve(embedding_map, symbolizer, demangler)
+        self._add_timing("load", start)
+        start = monotonic()
+        try:
+            self.comm.run()
+            self.comm.serve(embedding_map, symbolizer, demangler)
+        finally:
+            self._add_timing("serve", start)
 
     def run(self, function, args, kwargs):
         result = None
@@ -168,11 +247,14 @@ class Core:
             result = new_result
         embedding_map, kernel_library, symbolizer, demangler, subkernel_arg_types = \
             self.compile(function, args, kwargs, set_result)
+        start = monotonic()
         self.compile_and_upload_subkernels(embedding_map, args, subkernel_arg_types)
+        self._add_timing("subkernels", start)
         self._run_compiled(kernel_library, embedding_map, symbolizer, demangler)
         return result
 
-    def compile_subkernel(self, sid, subkernel_fn, embedding_map, args, subkernel_arg_types, subkernels):
+    def _compile_subkernel_frontend(self, sid, subkernel_fn, embedding_map,
+                                    args, subkernel_arg_types):
         # pass self to subkernels (if applicable)
         # assuming the first argument is self
         subkernel_args = getfullargspec(subkernel_fn.artiq_embedded.function)
@@ -183,32 +265,67 @@ class Core:
         destination = subkernel_fn.artiq_embedded.destination
         destination_tgt = self.satellite_cpu_targets[destination]
         target = get_target_cls(destination_tgt)(subkernel_id=sid)
-        object_map, kernel_library, _, _, _ = \
-            self.compile(subkernel_fn, self_arg, {}, attribute_writeback=False,
-                        print_as_rpc=False, target=target, destination=destination, 
-                        subkernel_arg_types=subkernel_arg_types.get(sid, []),
-                        old_embedding_map=embedding_map)
+        object_map, target, llir, _ = \
+            self._compile_frontend(subkernel_fn, self_arg, {}, None,
+                                   attribute_writeback=False,
+                                   print_as_rpc=False, target=target,
+                                   destination=destination,
+                                   subkernel_arg_types=subkernel_arg_types.get(sid, []),
+                                   old_embedding_map=embedding_map)
         if object_map.has_rpc():
             raise ValueError("Subkernel must not use RPC")
+        return destination, target, llir, object_map
+
+    def compile_subkernel(self, sid, subkernel_fn, embedding_map, args, subkernel_arg_types, subkernels):
+        destination, target, llir, object_map = \
+            self._compile_subkernel_frontend(sid, subkernel_fn, embedding_map,
+                                             args, subkernel_arg_types)
+        _, kernel_library = self._compile_backend(target, llir)
         return destination, kernel_library, object_map
 
     def compile_and_upload_subkernels(self, embedding_map, args, subkernel_arg_types):
+        # The frontend of each subkernel receives the embedding map of the
+        # previous one, so they run in sequence in this thread. The LLVM
+        # backends and linker invocations only need the LLVM IR and run in
+        # a thread pool (LLVM and the linker do not hold the GIL), while
+        # the finished subkernels are uploaded in order.
         subkernels = embedding_map.subkernels()
         subkernels_compiled = []
-        while True:
-            new_subkernels = {}
-            for sid, subkernel_fn in subkernels.items():
-                if sid in subkernels_compiled:
-                    continue
-                destination, kernel_library, embedding_map = \
-                    self.compile_subkernel(sid, subkernel_fn, embedding_map,
-                                        args, subkernel_arg_types, subkernels)
+        pending = deque()  # (sid, destination, future)
+
+        def upload_done(wait):
+            while pending and (wait or pending[0][2].done()):
+                sid, destination, future = pending.popleft()
+                _, kernel_library = future.result()
                 self.comm.upload_subkernel(kernel_library, sid, destination)
-                new_subkernels.update(embedding_map.subkernels())
-                subkernels_compiled.append(sid)
-            if new_subkernels == subkernels:
-                break
-            subkernels.update(new_subkernels)
+
+        # created with the first subkernel, most kernels have none
+        executor = None
+        try:
+            while True:
+                new_subkernels = {}
+                for sid, subkernel_fn in subkernels.items():
+                    if sid in subkernels_compiled:
+                        continue
+                    destination, target, llir, embedding_map = \
+                        self._compile_subkernel_frontend(
+                            sid, subkernel_fn, embedding_map,
+                            args, subkernel_arg_types)
+                    if executor is None:
+                        executor = ThreadPoolExecutor(
+                            max_workers=os.cpu_count())
+                    pending.append((sid, destination, executor.submit(
+                        self._compile_backend, target, llir)))
+                    new_subkernels.update(embedding_map.subkernels())
+                    subkernels_compiled.append(sid)
+                    upload_done(wait=False)
+                if new_subkernels == subkernels:
+                    break
+                subkernels.update(new_subkernels)
+            upload_done(wait=True)
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
         # check for messages without a send/recv pair
         unpaired_messages = embedding_map.subkernel_messages_unpaired()
         if unpaired_messages:
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import atexit
+import logging
+import os
+import struct
+
+from sipyco.asyncio_tools import SignalHandler, atexit_register_coroutine
+from sipyco.pc_rpc import Server
+from sipyco import common_args
+
+from artiq.coredevice.comm_kernel import CommKernel
+
+
+logger = logging.getLogger(__name__)
+
+
+_frame_length = struct.Struct("<I")
+
+
+class CoreCommProxy:
+    """Shares a single connection to the core device between the clients
+    of a Unix socket, one at a time (see
+    :class:`artiq.coredevice.comm_kernel.CommKernelMux`).
+
+    The connection is opened, and the system information checked, when the
+    first client connects. It is reset when a client disconnects without
+    releasing its session, e.g. when the worker process is killed while a
+    kernel is running."""
+    def __init__(self, core_addr, core_port=1381):
+        self.core_addr = core_addr
+        self.core_port = core_port
+        self._lock = asyncio.Lock()
+        self._core = None  # (reader, writer, endian byte)
+
+    def _open_core(self):
+        comm = CommKernel(self.core_addr, self.core_port)
+        comm.open()
+        try:
+            comm.check_system_info()
+            if comm.read_buffer:
+                raise IOError("Unexpected data from the core device")
+        except:
+            comm.close()
+            raise
+        sock = comm.socket
+        del comm.socket
+        return sock, b"e" if comm.endian == "<" else b"E"
+
+    async def _get_core(self):
+        if self._core is None:
+            loop = asyncio.get_running_loop()
+            sock, endian = await loop.run_in_executor(None, self._open_core)
+            reader, writer = await asyncio.open_connection(sock=sock)
+            self._core = reader, writer, endian
+            logger.info("connected to core device")
+        return self._core
+
+    async def reset_core(self):
+        if self._core is None:
+            return
+        _, writer, _ = self._core
+        self._core = None
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+        logger.info("disconnected from core device")
+
+    async def _forward_to_core(self, reader, core_writer):
+        while True:
+            length, = _frame_length.unpack(await reader.readexactly(
+                _frame_length.size))
+            if not length:
+                return
+            core_writer.write(await reader.readexactly(length))
+            await core_writer.drain()
+
+    async def _forward_to_client(self, core_reader, writer):
+        while True:
+            data = await core_reader.read(65536)
+            if not data:
+                raise ConnectionResetError(
+                    "Core device connection closed unexpectedly")
+            writer.write(data)
+            await writer.drain()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            async with self._lock:
+                released = False
+                try:
+                    core_reader, core_writer, endian = await self._get_core()
+                    # the system information has been checked on connection
+                    writer.write(endian + b"\x01")
+                    to_core = asyncio.ensure_future(
+                        self._forward_to_core(reader, core_writer))
+                    to_client = asyncio.ensure_future(
+                        self._forward_to_client(core_reader, writer))
+                    try:
+                        await asyncio.wait([to_core, to_client],
+                                           return_when=asyncio.FIRST_COMPLETED)
+                    finally:
+                        for task in to_core, to_client:
+                            task.cancel()
+                        await asyncio.gather(to_core, to_client,
+                                             return_exceptions=True)
+                    if not to_core.cancelled() and to_core.exception() is None:
+                        released = True
+                    else:
+                        logger.warning("session ended without release, "
+                                       "resetting core device connection")
+                except Exception:
+                    logger.error("session failed", exc_info=True)
+                finally:
+                    if not released:
+                        await self.reset_core()
+        finally:
+            writer.close()
+
+
+class PingTarget:
+    def ping(self):
+        return True
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(
+        description="ARTIQ core device connection proxy")
+    common_args.verbosity_args(parser)
+    common_args.simple_network_args(parser, [
+        ("control", "control", 1387)
+    ])
+    parser.add_argument(
+        "--socket", default="corecomm.sock",
+        help=("path of the Unix socket to listen on, to be given as the "
+              "'comm_proxy' argument of the core device "
+              "(default: %(default)s)"))
+    parser.add_argument("core_addr", metavar="CORE_ADDR",
+                        help="hostname or IP address of the core device")
+    return parser
+
+
+def main():
+    args = get_argparser().parse_args()
+    common_args.init_logger_from_args(args)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    atexit.register(loop.close)
+
+    signal_handler = SignalHandler()
+    signal_handler.setup()
+    atexit.register(signal_handler.teardown)
+
+    bind_address = common_args.bind_address_from_args(args)
+
+    proxy = CoreCommProxy(args.core_addr)
+    atexit_register_coroutine(proxy.reset_core, loop=loop)
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+    proxy_server = loop.run_until_complete(asyncio.start_unix_server(
+        proxy.handle_connection, args.socket))
+    atexit.register(os.unlink, args.socket)
+
+    async def stop_proxy_server():
+        proxy_server.close()
+        await proxy_server.wait_closed()
+    atexit_register_coroutine(stop_proxy_server, loop=loop)
+
+    server = Server({"corecomm_proxy": PingTarget()}, None, True)
+    loop.run_until_complete(server.start(bind_address, args.port_control))
+    atexit_register_coroutine(server.stop, loop=loop)
+
+    _, pending = loop.run_until_complete(asyncio.wait(
+        [loop.create_task(signal_handler.wait_terminate()),
+         loop.create_task(server.wait_terminate())],
+        return_when=asyncio.FIRST_COMPLETED))
+    for task in pending:
+        task.cancel()
+
+
+if __name__ == "__main__":
+    main()
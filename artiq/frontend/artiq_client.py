@@ -125,7 +125,7 @@ def get_argparser():
         "show", help="show schedule, log, devices or datasets")
     parser_show.add_argument(
         "what", metavar="WHAT",
-        choices=["schedule", "log", "ccb", "devices", "datasets",
+        choices=["schedule", "stats", "log", "ccb", "devices", "datasets",
                  "interactive-args"],
         help="select object to show: %(choices)s")
 
@@ -275,6 +275,30 @@ def _show_schedule(schedule):
         print("Schedule is empty")
 
 
+def _show_stats(stats):
+    clear_screen()
+    if not stats:
+        print("No statistics yet")
+        return
+    # (pipeline, kind, name) -> durations
+    durations = dict()
+    for run_stats in stats.values():
+        for kind in "statuses", "phases":
+            for name, duration in run_stats[kind].items():
+                key = (run_stats["pipeline"], kind, name)
+                durations.setdefault(key, []).append(duration)
+    table = PrettyTable(["Pipeline", "Status/phase", "Runs",
+                         "Median (s)", "90% (s)", "99% (s)"])
+    # keep the chronological order of the statuses within each pipeline
+    for (pipeline, kind, name), values in sorted(durations.items(),
+                                                 key=lambda item: item[0][0]):
+        percentiles = np.percentile(values, [50, 90, 99])
+        table.add_row([pipeline, name if kind == "statuses" else "  " + name,
+                       len(values)]
+                      + ["{:.3f}".format(p) for p in percentiles])
+    print(table)
+
+
 def _show_devices(devices):
     clear_screen()
     table = PrettyTable(["Name", "Description"])
@@ -365,6 +389,8 @@ def main():
     if action == "show":
         if args.what == "schedule":
             _show_dict(args, "schedule", _show_schedule)
+        elif args.what == "stats":
+            _show_dict(args, "schedule_stats", _show_stats)
         elif args.what == "log":
             _show_log(args)
         elif args.what == "ccb":
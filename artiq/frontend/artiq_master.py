@@ -18,6 +18,7 @@ from artiq.master.log import log_args, init_log
 from artiq.master.databases import (DeviceDB, DatasetDB,
                                     InteractiveArgDB)
 from artiq.master.scheduler import Scheduler
+from artiq.master.worker import WorkerProcessPool, WorkerRecycler
 from artiq.master.rid_counter import RIDCounter
 from artiq.master.experiments import (FilesystemBackend, GitBackend,
                                       ExperimentDB)
@@ -43,6 +44,20 @@ def get_argparser():
                        help="device database file (default: %(default)s)")
     group.add_argument("--dataset-db", default="dataset_db.mdb",
                        help="dataset file (default: %(default)s)")
+    group.add_argument("--dataset-db-journal", default=False,
+                       action="store_true",
+                       help="persist dataset modifications as an append-only "
+                            "journal instead of rewriting whole datasets "
+                            "on each autosave")
+    group.add_argument("--dataset-db-lazy", default=False,
+                       action="store_true",
+                       help="only read persistent dataset values when they "
+                            "are first needed, for faster startup with a "
+                            "large database")
+    group.add_argument("--dataset-broadcast-window", default=0.0, type=float,
+                       help="merge the dataset modifications sent to "
+                            "clients within this period, in seconds "
+                            "(default: %(default)s, disabled)")
 
     group = parser.add_argument_group("repository")
     group.add_argument(
@@ -55,6 +70,73 @@ def get_argparser():
         "--experiment-subdir", default="",
         help=("path to the experiment folder from the repository root "
               "(default: %(default)s)"))
+    group.add_argument(
+        "--scan-workers", default=4, type=int,
+        help=("number of worker processes examining experiment files in "
+              "parallel during repository scans (default: %(default)s)"))
+    group.add_argument(
+        "--examine-cache", default=None,
+        help=("file in which to keep the results of examining experiment "
+              "files, so that repository scans only examine the files that "
+              "have changed (default: disabled)"))
+    group = parser.add_argument_group("scheduler")
+    group.add_argument(
+        "--worker-pool-size", default=0, type=int,
+        help=("number of worker processes to keep started in advance "
+              "for new runs (default: %(default)s)"))
+    group.add_argument(
+        "--prepare-depth", default=1, type=int,
+        help=("number of runs of each pipeline that may be prepared ahead "
+              "of time (default: %(default)s)"))
+    group.add_argument(
+        "--max-workers", default=None, type=int,
+        help=("do not prepare runs ahead of time when a pipeline has this "
+              "many worker processes (default: no limit)"))
+    group.add_argument(
+        "--min-free-memory", default=0, type=int,
+        help=("do not prepare runs ahead of time when less than this many "
+              "MiB of memory are available (default: %(default)s)"))
+    group.add_argument(
+        "--analyze-concurrency", default=1, type=int,
+        help=("number of runs of each pipeline that may be analyzed "
+              "at the same time (default: %(default)s)"))
+    group.add_argument(
+        "--recycle-workers", default=False, action="store_true",
+        help=("reuse the worker process of a completed run for the next run "
+              "of the same experiment file and revision in the same pipeline, "
+              "keeping imported modules and device connections"))
+    group.add_argument(
+        "--recycle-idle-timeout", default=60.0, type=float,
+        help=("time in seconds after which unused worker processes kept for "
+              "reuse are terminated (default: %(default)s)"))
+
+    group.add_argument(
+        "--dataset-batch-size", default=1000, type=int,
+        help=("maximum number of modifications of broadcast datasets that "
+              "a worker sends to the master at once, or 0 to send each "
+              "modification immediately (default: %(default)s)"))
+    group.add_argument(
+        "--dataset-batch-period", default=0.1, type=float,
+        help=("maximum time in seconds for which a worker delays the "
+              "modifications of broadcast datasets (default: %(default)s)"))
+
+    group = parser.add_argument_group("results")
+    group.add_argument(
+        "--hdf5-compression", default=None, choices=["gzip", "lzf"],
+        help=("compression filter of the array datasets in results files, "
+              "unless overridden by their hdf5_options (default: none)"))
+    group.add_argument(
+        "--hdf5-compression-level", default=None, type=int,
+        help="gzip compression level, from 0 to 9 (default: 4)")
+    group.add_argument(
+        "--hdf5-shuffle", default=False, action="store_true",
+        help=("apply the shuffle filter to the array datasets in results "
+              "files, which often improves compression"))
+    group.add_argument(
+        "--results-stream-interval", default=None, type=float,
+        help=("write the archived datasets to the results file at most "
+              "every this many seconds during run(), instead of only at "
+              "the end of the experiment (default: disabled)"))
     log_args(parser)
 
     parser.add_argument("--name",
@@ -92,7 +174,9 @@ def main():
         server_broadcast.broadcast("ccb", msg)
 
     device_db = DeviceDB(args.device_db)
-    dataset_db = DatasetDB(args.dataset_db)
+    dataset_db = DatasetDB(args.dataset_db,
+                           journal=args.dataset_db_journal,
+                           lazy=args.dataset_db_lazy)
     atexit.register(dataset_db.close_db)
     dataset_db.start(loop=loop)
     atexit_register_coroutine(dataset_db.stop, loop=loop)
@@ -103,12 +187,44 @@ def main():
         repo_backend = GitBackend(args.repository)
     else:
         repo_backend = FilesystemBackend(args.repository)
+    atexit.register(repo_backend.close)
     experiment_db = ExperimentDB(
-        repo_backend, worker_handlers, args.experiment_subdir)
+        repo_backend, worker_handlers, args.experiment_subdir,
+        args.scan_workers, args.examine_cache)
     atexit.register(experiment_db.close)
 
+    if args.worker_pool_size > 0:
+        process_pool = WorkerProcessPool(args.worker_pool_size)
+        process_pool.start(loop=loop)
+        atexit_register_coroutine(process_pool.stop, loop=loop)
+    else:
+        process_pool = None
+    if args.recycle_workers:
+        recycler = WorkerRecycler(args.recycle_idle_timeout)
+        recycler.start(loop=loop)
+        atexit_register_coroutine(recycler.stop, loop=loop)
+    else:
+        recycler = None
+    hdf5_options = dict()
+    if args.hdf5_compression is not None:
+        hdf5_options["compression"] = args.hdf5_compression
+        if args.hdf5_compression_level is not None:
+            hdf5_options["compression_opts"] = args.hdf5_compression_level
+    if args.hdf5_shuffle:
+        hdf5_options["shuffle"] = True
+    results_options = {
+        "hdf5_options": hdf5_options,
+        "stream_interval": args.results_stream_interval
+    }
     scheduler = Scheduler(RIDCounter(), worker_handlers, experiment_db,
-                          args.log_submissions)
+                          args.log_submissions, process_pool,
+                          args.prepare_depth, args.max_workers,
+                          args.min_free_memory*1024*1024,
+                          args.analyze_concurrency, recycler,
+                          results_options, {
+                              "batch_size": args.dataset_batch_size,
+                              "batch_period": args.dataset_batch_period
+                          })
     scheduler.start(loop=loop)
     atexit_register_coroutine(scheduler.stop, loop=loop)
 
@@ -118,12 +234,15 @@ def main():
     get_interactive_arguments._worker_pass_rid = True
     worker_handlers.update({
         "get_device_db": device_db.get_device_db,
+        "get_device_db_snapshot": device_db.get_snapshot,
         "get_device": device_db.get,
         "get_dataset": dataset_db.get,
         "get_dataset_metadata": dataset_db.get_metadata,
         "update_dataset": dataset_db.update,
+        "update_dataset_batch": dataset_db.update_batch,
         "get_interactive_arguments": get_interactive_arguments,
         "scheduler_submit": scheduler.submit,
+        "scheduler_submit_many": scheduler.submit_many,
         "scheduler_delete": scheduler.delete,
         "scheduler_request_termination": scheduler.request_termination,
         "scheduler_get_status": scheduler.get_status,
@@ -153,12 +272,15 @@ def main():
 
     server_notify = Publisher({
         "schedule": scheduler.notifier,
+        "schedule_stats": scheduler.stats_notifier,
         "devices": device_db.data,
         "datasets": dataset_db.data,
         "interactive_args": interactive_arg_db.pending,
         "explist": experiment_db.explist,
         "explist_status": experiment_db.status,
     })
+    if args.dataset_broadcast_window > 0:
+        dataset_db.coalesce_broadcasts(args.dataset_broadcast_window)
     loop.run_until_complete(server_notify.start(
         bind, args.port_notify))
     atexit_register_coroutine(server_notify.stop, loop=loop)
@@ -116,6 +116,9 @@ class DummyScheduler:
         logger.info("Submitting: %s, RID=%s", expid, rid)
         return rid
 
+    def submit_many(self, specs):
+        return [self.submit(**spec) for spec in specs]
+
     def delete(self, rid):
         logger.info("Deleting RID %s", rid)
 
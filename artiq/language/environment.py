@@ -3,6 +3,8 @@ from inspect import isclass
 from contextlib import contextmanager
 from types import SimpleNamespace
 
+import numpy as np
+
 from sipyco import pyon
 
 from artiq.language import units
@@ -13,7 +15,7 @@ __all__ = ["NoDefault", "DefaultMissing",
            "PYONValue", "BooleanValue", "EnumerationValue",
            "NumberValue", "StringValue",
            "HasEnvironment", "Experiment", "EnvExperiment",
-           "CancelledArgsError"]
+           "CancelledArgsError", "AppendBuffer"]
 
 
 class NoDefault:
@@ -253,6 +255,242 @@ class ProcessArgumentManager:
         raise NotImplementedError
 
 
+class AppendBuffer:
+    """List-like value of archived datasets that grow by appending numeric
+    values, e.g. timestamps.
+
+    The values are stored in a NumPy array whose capacity is doubled when it
+    is full, instead of a list of Python objects. When the archived datasets
+    are written to the results file during ``run()`` (see the
+    ``--results-stream-interval`` option of the master), the values are
+    moved to an extendable HDF5 dataset, and the memory used does not grow
+    with their number.
+
+    It cannot be broadcast. :meth:`HasEnvironment.append_to_dataset`,
+    :meth:`HasEnvironment.mutate_dataset` and
+    :meth:`HasEnvironment.get_dataset` work as with a list, but indexing
+    returns NumPy scalars and slicing returns NumPy arrays.
+
+    :param values: The initial values.
+    :param dtype: The NumPy data type of the values. By default, that of the
+        initial values, or of the first value appended. Appending values of
+        another kind (e.g. floats to integers) promotes the data type, unless
+        the values were already moved to an HDF5 file, in which case
+        ``TypeError`` is raised.
+    """
+    initial_capacity = 16
+
+    def __init__(self, values=(), dtype=None):
+        self._data = None
+        self._length = 0
+        # HDF5 dataset holding the first values, see spill()
+        self._spill = None
+        self._spilled = 0
+        if dtype is not None or len(values):
+            self._data = np.array(values, dtype=dtype)
+            self._length = len(self._data)
+
+    @property
+    def dtype(self):
+        """The NumPy data type of the values, or ``None`` if it is not
+        known yet."""
+        return None if self._data is None else self._data.dtype
+
+    @property
+    def ndim(self):
+        return 1 if self._data is None else self._data.ndim
+
+    @property
+    def spill_dataset(self):
+        """The HDF5 dataset the values were last spilled to, or ``None``."""
+        return self._spill
+
+    def _reserve(self, length):
+        capacity = len(self._data)
+        if length > capacity:
+            capacity = max(length, 2*capacity, self.initial_capacity)
+            data = np.empty((capacity, ) + self._data.shape[1:],
+                            self._data.dtype)
+            data[:self._length] = self._data[:self._length]
+            self._data = data
+
+    def _promote(self, values):
+        # e.g. floats appended to integers
+        dtype = np.asarray(values).dtype
+        if np.can_cast(dtype, self._data.dtype, "same_kind"):
+            return
+        if self._spill is not None:
+            raise TypeError("Cannot store values of type {} in an "
+                            "AppendBuffer of type {} moved to HDF5"
+                            .format(dtype, self._data.dtype))
+        self._data = self._data.astype(np.result_type(self._data.dtype,
+                                                      dtype))
+
+    def append(self, value):
+        if self._data is None:
+            self._data = np.array([value])
+        else:
+            self._promote(value)
+            self._reserve(self._length + 1)
+            self._data[self._length] = value
+        self._length += 1
+
+    def extend(self, values):
+        values = np.asarray(values)
+        if self._data is None:
+            self._data = values.copy()
+        else:
+            self._promote(values)
+            self._reserve(self._length + len(values))
+            self._data[self._length:self._length + len(values)] = values
+        self._length += len(values)
+
+    def _in_memory(self):
+        if self._data is None:
+            return np.empty(0)
+        return self._data[:self._length]
+
+    def __array__(self, dtype=None, copy=None):
+        if self._spilled:
+            values = np.concatenate([self._spill[:self._spilled],
+                                     self._in_memory()])
+        else:
+            values = self._in_memory().copy()
+        if dtype is not None:
+            values = values.astype(dtype, copy=False)
+        return values
+
+    def tolist(self):
+        return self.__array__().tolist()
+
+    def __len__(self):
+        return self._spilled + self._length
+
+    def __iter__(self):
+        # the spilled values are read by blocks
+        block_size = 65536
+        for start in range(0, self._spilled, block_size):
+            yield from self._spill[start:min(start + block_size,
+                                             self._spilled)]
+        yield from self._in_memory().copy()
+
+    def _split_index(self, index):
+        # Returns the index in the HDF5 dataset and the index in memory of
+        # the values selected by the integer or slice ``index``, either of
+        # which may be None, and for slices whether the order of the values
+        # is reversed.
+        if not isinstance(index, slice):
+            length = len(self)
+            if index < 0:
+                index += length
+            if not 0 <= index < length:
+                raise IndexError("AppendBuffer index out of range")
+            if index < self._spilled:
+                return index, None, False
+            return None, index - self._spilled, False
+        r = range(len(self))[index]
+        reverse = r.step < 0
+        if reverse:
+            r = r[::-1]
+        if not r:
+            return None, slice(0, 0), False
+        spilled = self._spilled
+        disk = memory = None
+        if r.start < spilled:
+            disk = slice(r.start, min(r.stop, spilled), r.step)
+        if r.stop > spilled:
+            first = r.start
+            if first < spilled:
+                first += -(-(spilled - first)//r.step)*r.step
+            if first < r.stop:
+                memory = slice(first - spilled, r.stop - spilled, r.step)
+        return disk, memory, reverse
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple) and index \
+                and isinstance(index[0], (int, np.integer, slice)):
+            # select the values first, then index into them
+            values = self[index[0]]
+            if isinstance(index[0], slice):
+                return values[(slice(None), ) + index[1:]]
+            return values[index[1:]]
+        if not isinstance(index, (int, np.integer, slice)):
+            return self.__array__()[index]
+        disk, memory, reverse = self._split_index(index)
+        if not isinstance(index, slice):
+            if disk is not None:
+                return self._spill[disk]
+            value = self._in_memory()[memory]
+            if isinstance(value, np.ndarray):
+                # do not share the buffer
+                value = value.copy()
+            return value
+        parts = []
+        if disk is not None:
+            parts.append(self._spill[disk])
+        if memory is not None:
+            parts.append(self._in_memory()[memory])
+        values = np.concatenate(parts)
+        if reverse:
+            values = values[::-1]
+        return values
+
+    def __setitem__(self, index, value):
+        if not isinstance(index, (int, np.integer, slice)):
+            # e.g. multi-dimensional indices, through the whole array
+            values = self.__array__()
+            values[index] = value
+            if self._spilled:
+                self._spill[:self._spilled] = values[:self._spilled]
+            self._in_memory()[:] = values[self._spilled:]
+            return
+        disk, memory, reverse = self._split_index(index)
+        if not isinstance(index, slice):
+            if disk is not None:
+                self._spill[disk] = value
+            else:
+                self._in_memory()[memory] = value
+            return
+        value = np.asarray(value)
+        disk_value = memory_value = value
+        if value.ndim == self._in_memory().ndim:
+            # one value per selected index
+            if reverse:
+                value = value[::-1]
+            count = 0 if disk is None else len(range(self._spilled)[disk])
+            disk_value, memory_value = value[:count], value[count:]
+        if disk is not None:
+            self._spill[disk] = disk_value
+        if memory is not None:
+            self._in_memory()[memory] = memory_value
+
+    def __repr__(self):
+        return "<AppendBuffer of {} values of type {}>".format(
+            len(self), self.dtype)
+
+    def spill(self, dataset):
+        """Appends the values held in memory to the extendable HDF5
+        ``dataset`` (with the same data type and a first dimension of
+        unlimited size), and frees their memory.
+
+        The values previously spilled to another dataset are copied to
+        ``dataset``."""
+        if self._spill is not None and self._spill != dataset:
+            values = self.__array__()
+            self._data = values
+            self._length = len(values)
+            self._spilled = 0
+        self._spill = dataset
+        if self._length:
+            dataset.resize(self._spilled + self._length, axis=0)
+            dataset[self._spilled:] = self._in_memory()
+            self._spilled += self._length
+            self._length = 0
+            self._data = np.empty(
+                (self.initial_capacity, ) + self._data.shape[1:],
+                self._data.dtype)
+
+
 class HasEnvironment:
     """Provides methods to manage the environment of an experiment (arguments,
     devices, datasets)."""
@@ -391,11 +629,13 @@ class HasEnvironment:
     @rpc(flags={"async"})
     def set_dataset(self, key, value, *,
                     unit=None, scale=None, precision=None,
-                    broadcast=False, persist=False, archive=True):
+                    broadcast=False, persist=False, archive=True,
+                    hdf5_options=None):
         """Sets the contents and handling modes of a dataset.
 
         Datasets must be scalars (``bool``, ``int``, ``float`` or NumPy scalar)
-        or NumPy arrays.
+        or NumPy arrays. Archived datasets that are appended to a large number
+        of times can use :class:`AppendBuffer` instead of a list.
 
         :param unit: A string representing the unit of the value.
         :param scale: A numerical factor that is used to adjust the value of 
@@ -410,6 +650,11 @@ class HasEnvironment:
             broadcast.
         :param archive: the data is saved into the local storage of the current
             run (archived as a HDF5 file).
+        :param hdf5_options: dictionary of keyword arguments of
+            ``h5py.Group.create_dataset`` (e.g. ``chunks``, ``compression``,
+            ``compression_opts``, ``shuffle``) with which the dataset is
+            archived if it is an array. They override the defaults of the
+            master.
         """
         metadata = {}
         if unit is not None:
@@ -418,6 +663,8 @@ class HasEnvironment:
             metadata["scale"] = scale
         if precision is not None:
             metadata["precision"] = precision
+        if hdf5_options is not None:
+            metadata["hdf5_options"] = hdf5_options
         self.__dataset_mgr.set(key, value, metadata, broadcast, persist, archive)
 
     @rpc(flags={"async"})
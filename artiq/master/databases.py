@@ -1,6 +1,9 @@
 import asyncio
+import struct
+from collections import OrderedDict
 
 import lmdb
+import numpy
 
 from sipyco.sync_struct import (Notifier, process_mod, ModAction,
                                 update_from_dict)
@@ -23,13 +26,23 @@ class DeviceDB:
     def __init__(self, backing_file):
         self.backing_file = backing_file
         self.data = Notifier(device_db_from_file(self.backing_file))
+        # incremented when the contents may have changed
+        self.version = 0
 
     def scan(self):
         update_from_dict(self.data, device_db_from_file(self.backing_file))
+        self.version += 1
 
     def get_device_db(self):
         return self.data.raw_view
 
+    def get_snapshot(self, known_version=None):
+        """Returns the version and the full contents of the device database,
+        or only the version if it is ``known_version``."""
+        if known_version == self.version:
+            return self.version, None
+        return self.version, self.data.raw_view
+
     def get(self, key, resolve_alias=False):
         desc = self.data.raw_view[key]
         if resolve_alias:
@@ -41,78 +54,463 @@ class DeviceDB:
         return self.data.raw_view["satellite_cpu_targets"][destination]
 
 
+# Name of the LMDB sub-database holding the dataset modification journal.
+# It is stored as a key of the main database and therefore cannot be used as
+# a persistent dataset name.
+_JOURNAL_DB = b"__artiq_dataset_journal__"
+
+
+def _mod_key(mod):
+    if mod["path"]:
+        return mod["path"][0]
+    else:
+        assert (mod["action"] == ModAction.setitem.value
+                or mod["action"] == ModAction.delitem.value)
+        return mod["key"]
+
+
+def _replay_mod(data, mod):
+    if not mod["path"] and mod["action"] == ModAction.delitem.value:
+        # the journal entries creating the key may have been superseded
+        # before being written, see DatasetDB._log_mod()
+        data.pop(mod["key"], None)
+    else:
+        process_mod(data, mod)
+
+
+# Binary dataset records: magic, then format version and header length,
+# then a PYON header describing the array, then the raw array data.
+# The magic cannot start a PYON string, so values stored as plain PYON text
+# (non-array values and records written by older versions) are still
+# recognized.
+_RECORD_MAGIC = b"\x00ARTIQDS"
+_RECORD_VERSION = 1
+_record_header = struct.Struct("<BI")
+
+
+def _encode_record(value, metadata):
+    if not isinstance(value, numpy.ndarray) or value.dtype.hasobject:
+        return pyon.encode((value, metadata)).encode()
+    header = pyon.encode({
+        "dtype": numpy.lib.format.dtype_to_descr(value.dtype),
+        "shape": value.shape,
+        "metadata": metadata
+    }).encode()
+    raw = numpy.ascontiguousarray(value).reshape(-1).view(numpy.uint8)
+    return b"".join([_RECORD_MAGIC,
+                     _record_header.pack(_RECORD_VERSION, len(header)),
+                     header, raw])
+
+
+def _decode_record(buf):
+    """Decodes a record from a bytes-like object, which may be a buffer
+    into the LMDB memory map. Array data is copied directly out of the
+    buffer."""
+    if bytes(buf[:len(_RECORD_MAGIC)]) != _RECORD_MAGIC:
+        return pyon.decode(bytes(buf).decode())
+    version, header_len = _record_header.unpack_from(buf, len(_RECORD_MAGIC))
+    if version != _RECORD_VERSION:
+        raise ValueError("Unsupported dataset record version {}"
+                         .format(version))
+    offset = len(_RECORD_MAGIC) + _record_header.size
+    header = pyon.decode(bytes(buf[offset:offset+header_len]).decode())
+    dtype = numpy.lib.format.descr_to_dtype(header["dtype"])
+    value = numpy.frombuffer(buf, dtype=dtype, offset=offset+header_len)
+    return value.reshape(header["shape"]).copy(), header["metadata"]
+
+
+def _decode_record_metadata(buf):
+    """Returns the metadata of a binary record without decoding its data,
+    or ``None`` for a PYON record."""
+    if bytes(buf[:len(_RECORD_MAGIC)]) != _RECORD_MAGIC:
+        return None
+    version, header_len = _record_header.unpack_from(buf, len(_RECORD_MAGIC))
+    if version != _RECORD_VERSION:
+        raise ValueError("Unsupported dataset record version {}"
+                         .format(version))
+    offset = len(_RECORD_MAGIC) + _record_header.size
+    header = pyon.decode(bytes(buf[offset:offset+header_len]).decode())
+    return header["metadata"]
+
+
+def _pack_seq(seq):
+    return struct.pack(">Q", seq)
+
+
+def _unpack_seq(b):
+    return struct.unpack(">Q", b)[0]
+
+
+class _DatasetNotifier(Notifier):
+    # Calls the hooks before raw_view is returned, which happens when a
+    # client subscribes.
+    def __init__(self, backing_struct):
+        self.read_hooks = []
+        Notifier.__init__(self, backing_struct)
+
+    @property
+    def raw_view(self):
+        for hook in self.read_hooks:
+            hook()
+        return self._raw_view
+
+    @raw_view.setter
+    def raw_view(self, value):
+        self._raw_view = value
+
+
+class ModCoalescer:
+    """Merges the modifications of the entries of a dict :class:`Notifier`
+    that are published within ``window`` seconds of each other.
+
+    The first modification after a publication starts the window. When it
+    expires, each entry modified exactly once has its modification
+    published unchanged, an entry that only had items appended to the same
+    list has them published as a single slice assignment, and any other
+    entry is published as a replacement (or deletion) of the whole entry.
+
+    This must be installed after the notifier has been attached to its
+    publisher, and :meth:`sync` must be called before a new subscriber
+    receives the notifier contents.
+    """
+    def __init__(self, notifier, backing_struct, window):
+        self.backing_struct = backing_struct
+        self.window = window
+        self._publish = notifier.publish
+        notifier.publish = self._receive
+
+        self._pending = dict()
+        self._timer = None
+        # entries as seen by the subscribers
+        self._keys = set(backing_struct.keys())
+
+        self.received = 0
+        self.published = 0
+
+    def _receive(self, mod):
+        self.received += 1
+        self._pending.setdefault(_mod_key(mod), []).append(mod)
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                self.window, self.flush)
+
+    def _merge(self, key, mods):
+        if len(mods) == 1:
+            return mods
+        path = mods[0]["path"]
+        if path and all(mod["action"] == ModAction.append.value
+                        and mod["path"] == path for mod in mods):
+            target = self.backing_struct
+            for element in path:
+                target = target[element]
+            return [{"action": ModAction.setitem.value, "path": path,
+                     "key": slice(len(target) - len(mods), None),
+                     "value": [mod["x"] for mod in mods]}]
+        if key in self.backing_struct:
+            return [{"action": ModAction.setitem.value, "path": [],
+                     "key": key, "value": self.backing_struct[key]}]
+        elif key in self._keys:
+            return [{"action": ModAction.delitem.value, "path": [],
+                     "key": key}]
+        else:
+            # created and deleted within the window
+            return []
+
+    def flush(self):
+        """Publishes the pending modifications immediately."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending = self._pending, dict()
+        for key, mods in pending.items():
+            for mod in self._merge(key, mods):
+                if not mod["path"]:
+                    if mod["action"] == ModAction.setitem.value:
+                        self._keys.add(key)
+                    else:
+                        self._keys.discard(key)
+                self._publish(mod)
+                self.published += 1
+
+    def sync(self):
+        self.flush()
+        self._keys = set(self.backing_struct.keys())
+
+    def get_stats(self):
+        return {
+            "received": self.received,
+            "published": self.published,
+            "merged": self.received - self.published
+                      - sum(len(mods) for mods in self._pending.values())
+        }
+
+
 class DatasetDB(TaskObject):
-    def __init__(self, persist_file, autosave_period=30):
+    """Master dataset database, with optional persistence to LMDB.
+
+    In the default mode, every autosave rewrites the full value of each
+    modified persistent dataset. With ``journal=True``, the modifications
+    themselves are appended to a journal stored in the same LMDB file, and
+    periodically folded into the base values in a background thread once
+    ``compact_threshold`` or more journal entries have accumulated. Of the
+    modifications of a dataset between two autosaves, only those after the
+    last replacement of its whole value are appended. The journal is
+    replayed at startup, so both modes yield the same contents.
+
+    With ``lazy=True``, only the keys (and the metadata of binary records)
+    are read at startup. Values are decoded when first modified, when the
+    first client subscribes to :attr:`data`, or temporarily on
+    :meth:`get`, in which case at most ``lazy_cache_size`` of them are kept.
+    """
+    def __init__(self, persist_file, autosave_period=30,
+                 journal=False, compact_threshold=1000,
+                 lazy=False, lazy_cache_size=64):
         self.persist_file = persist_file
         self.autosave_period = autosave_period
+        self.journal = journal
+        self.compact_threshold = compact_threshold
+        self.lazy_cache_size = lazy_cache_size
 
-        self.lmdb = lmdb.open(persist_file, subdir=False, map_size=2**30)
-        data = dict()
-        with self.lmdb.begin() as txn:
-            for key, value_and_metadata in txn.cursor():
-                value, metadata = pyon.decode(value_and_metadata.decode())
-                data[key.decode()] = (True, value, metadata)
-        self.data = Notifier(data)
+        self.lmdb = lmdb.open(persist_file, subdir=False, map_size=2**30,
+                              max_dbs=1)
+        self._data = dict()
+        # key -> metadata (None if unknown) of values not yet decoded
+        self._unloaded = dict()
+        # decoded values of unloaded keys, in LRU order
+        self._cache = OrderedDict()
+        with self.lmdb.begin(buffers=True) as txn:
+            for key, record in txn.cursor():
+                key = bytes(key)
+                if key == _JOURNAL_DB:
+                    continue
+                if lazy:
+                    self._unloaded[key.decode()] = _decode_record_metadata(
+                        record)
+                else:
+                    value, metadata = _decode_record(record)
+                    self._data[key.decode()] = (True, value, metadata)
+
+        try:
+            self._journal_db = self.lmdb.open_db(_JOURNAL_DB,
+                                                 create=journal)
+        except lmdb.NotFoundError:
+            self._journal_db = None
+        self._next_seq = 0
+        if self._journal_db is not None:
+            with self.lmdb.begin(db=self._journal_db) as txn:
+                cursor = txn.cursor()
+                if cursor.last():
+                    self._next_seq = _unpack_seq(cursor.key()) + 1
+                mods = [pyon.decode(entry.decode())
+                        for _, entry in txn.cursor()]
+            for mod in mods:
+                self._materialize(_mod_key(mod))
+                _replay_mod(self._data, mod)
+            if not journal:
+                # journal left over from a previous session in journal mode
+                self._compact()
+
+        self.data = _DatasetNotifier(self._data)
+        if lazy:
+            self.data.read_hooks.append(self._load_all)
+        self._coalescer = None
         self.pending_keys = set()
+        self.pending_mods = []
+        # key -> indices in pending_mods of the entries modifying it
+        self._pending_mod_indices = dict()
 
     def close_db(self):
         self.lmdb.close()
 
+    def _read(self, key):
+        with self.lmdb.begin(buffers=True) as txn:
+            value, metadata = _decode_record(txn.get(key.encode()))
+        return True, value, metadata
+
+    def _materialize(self, key):
+        # Moves an unloaded key into the notifier contents. There cannot be
+        # any subscribers yet, so this is not published.
+        if key in self._unloaded:
+            del self._unloaded[key]
+            entry = self._cache.pop(key, None)
+            if entry is None:
+                entry = self._read(key)
+            self._data[key] = entry
+
+    def _load_all(self):
+        for key in list(self._unloaded.keys()):
+            self._materialize(key)
+
+    def _get_entry(self, key):
+        if key in self._data:
+            return self._data[key]
+        if key not in self._unloaded:
+            raise KeyError(key)
+        try:
+            self._cache.move_to_end(key)
+        except KeyError:
+            self._cache[key] = self._read(key)
+            while len(self._cache) > self.lazy_cache_size:
+                self._cache.popitem(last=False)
+        return self._cache[key]
+
     def save(self):
+        if self.journal:
+            with self.lmdb.begin(write=True, db=self._journal_db) as txn:
+                for entry in self.pending_mods:
+                    if entry is None:
+                        continue  # superseded, see _log_mod()
+                    txn.put(_pack_seq(self._next_seq), entry)
+                    self._next_seq += 1
+            self.pending_mods.clear()
+            self._pending_mod_indices.clear()
+            return
+
         with self.lmdb.begin(write=True) as txn:
             for key in self.pending_keys:
-                if (key not in self.data.raw_view
-                        or not self.data.raw_view[key][0]):
+                if key not in self._data or not self._data[key][0]:
                     txn.delete(key.encode())
                 else:
-                    value_and_metadata = (self.data.raw_view[key][1],
-                                          self.data.raw_view[key][2])
                     txn.put(key.encode(),
-                            pyon.encode(value_and_metadata).encode())
+                            _encode_record(self._data[key][1],
+                                           self._data[key][2]))
         self.pending_keys.clear()
 
+    def coalesce_broadcasts(self, window):
+        """Merges the modifications of :attr:`data` published within
+        ``window`` seconds (see :class:`ModCoalescer`). Must be called after
+        :attr:`data` has been attached to a publisher."""
+        self._coalescer = ModCoalescer(self.data, self._data, window)
+        self.data.read_hooks.append(self._coalescer.sync)
+
+    def get_broadcast_stats(self):
+        """Returns the numbers of modifications received, published and
+        merged by the broadcast coalescer, or ``None`` if it is disabled."""
+        if self._coalescer is None:
+            return None
+        return self._coalescer.get_stats()
+
+    def journal_length(self):
+        if self._journal_db is None:
+            return 0
+        with self.lmdb.begin(db=self._journal_db) as txn:
+            return txn.stat(self._journal_db)["entries"]
+
+    def _compact(self):
+        # Folds the journal into the base values in a single write
+        # transaction. Only touches the LMDB file, not the in-memory
+        # Notifier, so it can run in a thread.
+        with self.lmdb.begin(write=True) as txn:
+            data = dict()
+            touched = set()
+            seqs = []
+            for seq, entry in txn.cursor(db=self._journal_db):
+                seqs.append(seq)
+                mod = pyon.decode(entry.decode())
+                key = _mod_key(mod)
+                if key not in touched:
+                    touched.add(key)
+                    record = txn.get(key.encode())
+                    if record is not None:
+                        value, metadata = _decode_record(record)
+                        data[key] = (True, value, metadata)
+                _replay_mod(data, mod)
+            for key in touched:
+                if key in data:
+                    txn.put(key.encode(),
+                            _encode_record(data[key][1], data[key][2]))
+                else:
+                    txn.delete(key.encode())
+            for seq in seqs:
+                txn.delete(seq, db=self._journal_db)
+
     async def _do(self):
         try:
             while True:
                 await asyncio.sleep(self.autosave_period)
                 self.save()
+                if (self.journal
+                        and self.journal_length() >= self.compact_threshold):
+                    await asyncio.get_running_loop().run_in_executor(
+                        None, self._compact)
         finally:
             self.save()
 
     def get(self, key):
-        return self.data.raw_view[key][1]
+        return self._get_entry(key)[1]
 
     def get_metadata(self, key):
-        return self.data.raw_view[key][2]
+        if self._unloaded.get(key) is not None:
+            return self._unloaded[key]
+        return self._get_entry(key)[2]
+
+    def _is_persisted(self, key):
+        return key in self._data and self._data[key][0]
+
+    def _log_mod(self, key, mod, was_persisted):
+        if self._is_persisted(key):
+            if not was_persisted and mod["path"]:
+                # the dataset has just become persistent through a partial
+                # modification; record its full value instead
+                mod = {"action": ModAction.setitem.value, "path": [],
+                       "key": key, "value": self._data[key]}
+        elif was_persisted:
+            mod = {"action": ModAction.delitem.value, "path": [],
+                   "key": key}
+        else:
+            return
+        indices = self._pending_mod_indices.setdefault(key, [])
+        if not mod["path"]:
+            # replaces or deletes the whole value: the earlier entries of
+            # the key need not be written
+            for i in indices:
+                self.pending_mods[i] = None
+            indices.clear()
+        indices.append(len(self.pending_mods))
+        # Encode immediately: later mods may mutate objects referenced by
+        # this one.
+        self.pending_mods.append(pyon.encode(mod).encode())
 
     def update(self, mod):
-        if mod["path"]:
-            key = mod["path"][0]
+        key = _mod_key(mod)
+        if key in self._unloaded:
+            if mod["path"]:
+                self._materialize(key)
+            else:
+                # replaced or deleted as a whole, no need to decode it
+                del self._unloaded[key]
+                self._cache.pop(key, None)
+                self._data[key] = (True, None, {})
+        if self.journal:
+            was_persisted = self._is_persisted(key)
+            process_mod(self.data, mod)
+            self._log_mod(key, mod, was_persisted)
         else:
-            assert (mod["action"] == ModAction.setitem.value
-                    or mod["action"] == ModAction.delitem.value)
-            key = mod["key"]
-        self.pending_keys.add(key)
-        process_mod(self.data, mod)
+            self.pending_keys.add(key)
+            process_mod(self.data, mod)
+
+    def update_batch(self, mods):
+        for mod in mods:
+            self.update(mod)
 
     # convenience functions (update() can be used instead)
     def set(self, key, value, persist=None, metadata=None):
         if persist is None:
-            if key in self.data.raw_view:
-                persist = self.data.raw_view[key][0]
+            if key in self._data:
+                persist = self._data[key][0]
             else:
-                persist = False
+                persist = key in self._unloaded
         if metadata is None:
-            if key in self.data.raw_view:
-                metadata = self.data.raw_view[key][2]
+            if key in self._data or key in self._unloaded:
+                metadata = self.get_metadata(key)
             else:
                 metadata = {}
-        self.data[key] = (persist, value, metadata)
-        self.pending_keys.add(key)
+        self.update({"action": ModAction.setitem.value, "path": [],
+                     "key": key, "value": (persist, value, metadata)})
 
     def delete(self, key):
-        del self.data[key]
-        self.pending_keys.add(key)
+        self.update({"action": ModAction.delitem.value, "path": [],
+                     "key": key})
     #
 
 
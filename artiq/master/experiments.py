@@ -4,30 +4,81 @@ import tempfile
 import shutil
 import time
 import logging
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 
 from sipyco.sync_struct import Notifier, update_from_dict
+from sipyco import pyon
 
 from artiq.master.worker import (Worker, WorkerInternalException,
                                  log_worker_exception)
 from artiq.tools import get_windows_drives, exc_to_warning
+from artiq import __version__ as artiq_version
 
 
 logger = logging.getLogger(__name__)
 
 
-class _RepoScanner:
-    def __init__(self, worker_handlers):
-        self.worker_handlers = worker_handlers
-        self.worker = None
+class ExamineCache:
+    """Persistent cache of the descriptions of experiment files, stored as
+    PYON in ``filename``.
 
-    async def process_file(self, entry_dict, root, filename):
-        logger.debug("processing file %s %s", root, filename)
+    Entries are looked up with a key derived from the contents of the
+    file (see :meth:`_RepoScanner._cache_key`), and are only valid if the
+    repository files it imports are also unchanged."""
+    def __init__(self, filename):
+        self.filename = filename
         try:
-            description = await self.worker.examine(
-                "scan", os.path.join(root, filename))
-        except:
-            log_worker_exception()
-            raise
+            self.entries = pyon.load_file(filename)
+        except FileNotFoundError:
+            self.entries = dict()
+        except Exception:
+            logger.warning("ignoring unreadable examine cache %s", filename,
+                           exc_info=True)
+            self.entries = dict()
+        self._used = set()
+
+    def get(self, key, get_file_hash):
+        """Returns the cached description under ``key``, or ``None`` if
+        there is none or if a dependency has changed, according to
+        ``get_file_hash``."""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        for filename, file_hash in entry["dependencies"].items():
+            if get_file_hash(filename) != file_hash:
+                return None
+        self._used.add(key)
+        return entry["description"]
+
+    def put(self, key, description, dependencies):
+        self.entries[key] = {
+            "description": description,
+            "dependencies": dependencies
+        }
+        self._used.add(key)
+
+    def save(self):
+        """Removes the entries that were not used since the last call, and
+        writes the cache to its file."""
+        self.entries = {key: entry for key, entry in self.entries.items()
+                        if key in self._used}
+        self._used = set()
+        pyon.store_file(self.filename, self.entries)
+
+
+class _RepoScanner:
+    def __init__(self, worker_handlers, worker_count=4, cache=None,
+                 file_hashes=None):
+        self.worker_handlers = worker_handlers
+        self.worker_count = worker_count
+        self.cache = cache
+        # file name relative to the root -> content hash, or None if the
+        # file does not exist
+        self.file_hashes = dict() if file_hashes is None else file_hashes
+        self._cache_salt = None
+
+    def _add_entries(self, entry_dict, filename, description):
         for class_name, class_desc in description.items():
             name = class_desc["name"]
             if "/" in name:
@@ -52,42 +103,143 @@ class _RepoScanner:
             }
             entry_dict[name] = entry
 
-    async def _scan(self, root, subdir=""):
-        entry_dict = dict()
+    def _file_hash(self, root, filename):
+        try:
+            return self.file_hashes[filename]
+        except KeyError:
+            pass
+        try:
+            with open(os.path.join(root, filename), "rb") as f:
+                file_hash = hashlib.sha256(f.read()).hexdigest()
+        except FileNotFoundError:
+            file_hash = None
+        self.file_hashes[filename] = file_hash
+        return file_hash
+
+    def _cache_key(self, root, filename):
+        if self._cache_salt is None:
+            # examine results can depend on the device database
+            h = hashlib.sha256(artiq_version.encode())
+            if "get_device_db" in self.worker_handlers:
+                h.update(pyon.encode(
+                    self.worker_handlers["get_device_db"]()).encode())
+            self._cache_salt = h.hexdigest()
+        h = hashlib.sha256(self._cache_salt.encode())
+        h.update(filename.encode())
+        h.update(b"\0")
+        h.update(self._file_hash(root, filename).encode())
+        return h.hexdigest()
+
+    def _dependency_hashes(self, root, dependencies):
+        hashes = dict()
+        for path in dependencies:
+            filename = os.path.relpath(os.path.abspath(path), root)
+            if filename.startswith(os.pardir):
+                continue  # outside of the repository
+            hashes[filename] = self._file_hash(root, filename)
+        return hashes
+
+    def _list(self, root, subdir=""):
+        # Returns the directory tree as a list of file names and
+        # (directory name, subtree) pairs, in scanning order.
+        tree = []
         for de in os.scandir(os.path.join(root, subdir)):
             if de.name.startswith("."):
                 continue
             if de.is_file() and de.name.endswith(".py"):
-                filename = os.path.join(subdir, de.name)
+                tree.append(os.path.join(subdir, de.name))
+            if de.is_dir():
+                tree.append((de.name,
+                             self._list(root, os.path.join(subdir, de.name))))
+        return tree
+
+    def _files(self, tree):
+        for item in tree:
+            if isinstance(item, str):
+                yield item
+            else:
+                yield from self._files(item[1])
+
+    def _merge(self, tree, descriptions):
+        entry_dict = dict()
+        for item in tree:
+            if isinstance(item, str):
+                description = descriptions[item]
+                if description is not None:
+                    self._add_entries(entry_dict, item, description)
+            else:
+                name, subtree = item
+                subentries = self._merge(subtree, descriptions)
+                entries = {name + "/" + k: v for k, v in subentries.items()}
+                entry_dict.update(entries)
+        return entry_dict
+
+    async def _examine_files(self, root, filenames, descriptions, durations):
+        worker = Worker(self.worker_handlers)
+        try:
+            for filename in filenames:
+                if self.cache is not None:
+                    key = self._cache_key(root, filename)
+                    description = self.cache.get(
+                        key, lambda f: self._file_hash(root, f))
+                    if description is not None:
+                        descriptions[filename] = description
+                        continue
+                logger.debug("processing file %s %s", root, filename)
+                t1 = time.monotonic()
                 try:
-                    await self.process_file(entry_dict, root, filename)
+                    dependencies = []
+                    descriptions[filename] = await worker.examine(
+                        "scan", os.path.join(root, filename),
+                        dependencies=dependencies)
+                    if self.cache is not None:
+                        self.cache.put(
+                            key, descriptions[filename],
+                            self._dependency_hashes(root, dependencies))
                 except Exception as exc:
+                    log_worker_exception()
                     logger.warning("Skipping file '%s'", filename,
                         exc_info=not isinstance(exc, WorkerInternalException))
+                    descriptions[filename] = None
                     # restart worker
-                    await self.worker.close()
-                    self.worker = Worker(self.worker_handlers)
-            if de.is_dir():
-                subentries = await self._scan(
-                    root, os.path.join(subdir, de.name))
-                entries = {de.name + "/" + k: v for k, v in subentries.items()}
-                entry_dict.update(entries)
-        return entry_dict
+                    await worker.close()
+                    worker = Worker(self.worker_handlers)
+                durations[filename] = time.monotonic() - t1
+        finally:
+            await worker.close()
 
     async def scan(self, root, subdir=""):
-        self.worker = Worker(self.worker_handlers)
-        try:
-            r = await self._scan(root, subdir)
-        finally:
-            await self.worker.close()
-        return r
+        tree = self._list(root, subdir)
+        # The files are examined in parallel, while their results are
+        # merged in scanning order, so that duplicate experiment names are
+        # renamed as in a serial scan.
+        filenames = iter(list(self._files(tree)))
+        descriptions = dict()
+        durations = dict()
+        await asyncio.gather(*[
+            self._examine_files(root, filenames, descriptions, durations)
+            for _ in range(self.worker_count)])
+        for filename, duration in sorted(durations.items(),
+                                         key=lambda item: -item[1]):
+            logger.debug("examining '%s' took %.3f seconds",
+                         filename, duration)
+        return self._merge(tree, descriptions)
 
 
 class ExperimentDB:
-    def __init__(self, repo_backend, worker_handlers, experiment_subdir=""):
+    def __init__(self, repo_backend, worker_handlers, experiment_subdir="",
+                 scan_workers=4, examine_cache=None):
         self.repo_backend = repo_backend
         self.worker_handlers = worker_handlers
         self.experiment_subdir = experiment_subdir
+        self.scan_workers = scan_workers
+        if examine_cache is None:
+            self.examine_cache = None
+        else:
+            self.examine_cache = ExamineCache(examine_cache)
+        # revision and file hashes of the last scan
+        self._scanned_rev = None
+        self._file_hashes = dict()
 
         self.cur_rev = self.repo_backend.get_head_rev()
         self.repo_backend.request_rev(self.cur_rev)
@@ -111,19 +263,48 @@ class ExperimentDB:
         try:
             if new_cur_rev is None:
                 new_cur_rev = self.repo_backend.get_head_rev()
-            wd, _, _ = self.repo_backend.request_rev(new_cur_rev)
+            wd, _, rev = self.repo_backend.request_rev(new_cur_rev)
+            try:
+                await self.repo_backend.wait_rev(rev)
+            except:
+                self.repo_backend.release_rev(rev)
+                raise
             self.repo_backend.release_rev(self.cur_rev)
             self.cur_rev = new_cur_rev
             self.status["cur_rev"] = new_cur_rev
+            file_hashes = self._get_unchanged_hashes(new_cur_rev)
             t1 = time.monotonic()
-            new_explist = await _RepoScanner(self.worker_handlers).scan(
-                wd, self.experiment_subdir)
+            new_explist = await _RepoScanner(
+                self.worker_handlers, self.scan_workers,
+                self.examine_cache, file_hashes).scan(
+                    wd, self.experiment_subdir)
             logger.info("repository scan took %d seconds", time.monotonic()-t1)
+            self._scanned_rev = new_cur_rev
+            self._file_hashes = file_hashes
+            if self.examine_cache is not None:
+                try:
+                    self.examine_cache.save()
+                except Exception:
+                    logger.warning("failed to save examine cache",
+                                   exc_info=True)
             update_from_dict(self.explist, new_explist)
         finally:
             self._scanning = False
             self.status["scanning"] = False
 
+    def _get_unchanged_hashes(self, rev):
+        """Returns the content hashes computed during the last scan for the
+        files that are unchanged in ``rev``."""
+        if self.examine_cache is None or self._scanned_rev is None:
+            return dict()
+        changed = self.repo_backend.get_changed_files(self._scanned_rev, rev)
+        if changed is None:
+            return dict()
+        changed = {os.path.normpath(filename) for filename in changed}
+        return {filename: file_hash
+                for filename, file_hash in self._file_hashes.items()
+                if filename not in changed}
+
     def scan_repository_async(self, new_cur_rev=None, loop=None):
         asyncio.ensure_future(
             exc_to_warning(self.scan_repository(new_cur_rev)), loop=loop)
@@ -134,13 +315,17 @@ class ExperimentDB:
                 revision = self.cur_rev
             wd, _, revision = self.repo_backend.request_rev(revision)
             filename = os.path.join(wd, filename)
-        worker = Worker(self.worker_handlers)
         try:
-            description = await worker.examine("examine", filename)
+            if use_repository:
+                await self.repo_backend.wait_rev(revision)
+            worker = Worker(self.worker_handlers)
+            try:
+                description = await worker.examine("examine", filename)
+            finally:
+                await worker.close()
         finally:
-            await worker.close()
-        if use_repository:
-            self.repo_backend.release_rev(revision)
+            if use_repository:
+                self.repo_backend.release_rev(revision)
         return description
 
     def list_directory(self, directory):
@@ -171,18 +356,89 @@ class FilesystemBackend:
     def request_rev(self, rev):
         return self.root, None, "N/A"
 
+    async def wait_rev(self, rev):
+        pass
+
+    def get_changed_files(self, old_rev, new_rev):
+        # files can change without any change of revision
+        return None
+
     def release_rev(self, rev):
         pass
 
+    def close(self):
+        pass
+
+
+class _ObjectStore:
+    """Folder of the blobs of the checkouts, named after their object ID.
+    Checkouts hard-link their files to the blobs, so that files which are
+    the same in several revisions are only written once. The blobs are
+    read-only, so that an experiment cannot modify the files of other
+    checkouts."""
+    def __init__(self, path):
+        self.path = path
+        os.mkdir(path)
+
+    def link(self, git, oid, executable, dest):
+        name = str(oid) + ("x" if executable else "")
+        src = os.path.join(self.path, name)
+        if not os.path.exists(src):
+            tmp = src + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(git[oid].data)
+            # read-only files cannot be deleted on Windows
+            if os.name != "nt":
+                os.chmod(tmp, 0o555 if executable else 0o444)
+            os.replace(tmp, src)
+        try:
+            os.link(src, dest)
+        except OSError:
+            shutil.copy(src, dest)
+
+    def collect(self):
+        """Deletes the blobs that are not linked by any checkout."""
+        for de in os.scandir(self.path):
+            if de.stat().st_nlink == 1:
+                os.unlink(de.path)
+
 
 class _GitCheckout:
-    def __init__(self, git, rev):
-        self.path = tempfile.mkdtemp()
-        commit = git.get(rev)
-        git.checkout_tree(commit, directory=self.path)
-        self.message = commit.message.strip()
-        self.ref_count = 1
-        logger.info("checked out revision %s into %s", rev, self.path)
+    def __init__(self, git, rev, base_dir):
+        self.rev = rev
+        self.path = tempfile.mkdtemp(dir=base_dir)
+        self.message = git.get(rev).message.strip()
+        self.ref_count = 0
+        self.released_at = None
+        # concurrent.futures.Future set when the files are written
+        self.ready = None
+
+    def materialize(self, repo_path, store):
+        # lazy import - make dependency optional
+        import pygit2
+
+        # pygit2 repository objects must not be shared between threads
+        git = pygit2.Repository(repo_path)
+        t1 = time.monotonic()
+        trees = [(git.get(self.rev).tree, self.path)]
+        while trees:
+            tree, path = trees.pop()
+            for entry in tree:
+                dest = os.path.join(path, entry.name)
+                if entry.filemode == pygit2.GIT_FILEMODE_TREE:
+                    os.mkdir(dest)
+                    trees.append((git[entry.id], dest))
+                elif entry.filemode == pygit2.GIT_FILEMODE_LINK:
+                    os.symlink(git[entry.id].data, dest)
+                elif entry.filemode == pygit2.GIT_FILEMODE_COMMIT:
+                    # submodules are not checked out
+                    os.mkdir(dest)
+                else:
+                    store.link(git, entry.id,
+                        entry.filemode == pygit2.GIT_FILEMODE_BLOB_EXECUTABLE,
+                        dest)
+        logger.info("checked out revision %s into %s in %.3f seconds",
+                    self.rev, self.path, time.monotonic() - t1)
 
     def dispose(self):
         logger.info("disposing of checkout in folder %s", self.path)
@@ -190,12 +446,19 @@ class _GitCheckout:
 
 
 class GitBackend:
+    # time in seconds for which checkouts are kept after their last release
+    linger_time = 30.0
+
     def __init__(self, root):
         # lazy import - make dependency optional
         import pygit2
 
         self.git = pygit2.Repository(root)
         self.checkouts = dict()
+        self._base_dir = tempfile.mkdtemp(prefix="artiq_checkouts_")
+        self._store = _ObjectStore(os.path.join(self._base_dir, "objects"))
+        # checkouts are written and deleted in this thread, in order
+        self._executor = ThreadPoolExecutor(max_workers=1)
 
     def get_head_rev(self):
         return str(self.git.head.target)
@@ -210,19 +473,71 @@ class GitBackend:
         logger.debug('Resolved git ref "%s" into "%s"', rev, commit_id)
         return commit_id
 
+    def get_changed_files(self, old_rev, new_rev):
+        """Returns the paths, relative to the repository root, of the files
+        that differ between two revisions."""
+        old_tree = self.git.get(self._get_pinned_rev(old_rev)).tree
+        new_tree = self.git.get(self._get_pinned_rev(new_rev)).tree
+        changed = set()
+        for delta in old_tree.diff_to_tree(new_tree).deltas:
+            changed.add(delta.old_file.path)
+            changed.add(delta.new_file.path)
+        return changed
+
     def request_rev(self, rev):
+        """Returns the directory of the checkout of ``rev``, the message and
+        the hash of its commit.
+
+        The files are written in a thread: :meth:`wait_rev` must be awaited
+        before using them."""
         rev = self._get_pinned_rev(rev)
+        self._dispose_expired()
         if rev in self.checkouts:
             co = self.checkouts[rev]
-            co.ref_count += 1
         else:
-            co = _GitCheckout(self.git, rev)
+            co = _GitCheckout(self.git, rev, self._base_dir)
+            co.ready = self._executor.submit(
+                co.materialize, self.git.path, self._store)
             self.checkouts[rev] = co
+        co.ref_count += 1
+        co.released_at = None
         return co.path, co.message, rev
 
+    async def wait_rev(self, rev):
+        """Waits until the files of the requested revision ``rev`` are
+        written."""
+        await asyncio.wrap_future(self.checkouts[rev].ready)
+
     def release_rev(self, rev):
         co = self.checkouts[rev]
         co.ref_count -= 1
         if not co.ref_count:
-            co.dispose()
-            del self.checkouts[rev]
+            co.released_at = time.monotonic()
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                pass
+            else:
+                loop.call_later(self.linger_time, self._dispose_expired)
+        self._dispose_expired()
+
+    def _dispose(self, co):
+        co.dispose()
+        self._store.collect()
+
+    def _dispose_expired(self):
+        now = time.monotonic()
+        for rev, co in list(self.checkouts.items()):
+            if co.ref_count:
+                continue
+            failed = co.ready.done() and co.ready.exception() is not None
+            if failed or now - co.released_at >= self.linger_time:
+                del self.checkouts[rev]
+                self._executor.submit(self._dispose, co)
+
+    def close(self):
+        """Deletes all checkouts. The object cannot be used anymore after
+        calling this method."""
+        self._executor.shutdown()
+        self.checkouts.clear()
+        shutil.rmtree(self._base_dir)
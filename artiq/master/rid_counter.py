@@ -25,6 +25,14 @@ class RIDCounter:
         self._update_cache(rid)
         return rid
 
+    def get_range(self, n):
+        """Allocates ``n`` consecutive RIDs and returns them as a range."""
+        rids = range(self._next_rid, self._next_rid + n)
+        self._next_rid += n
+        if n:
+            self._update_cache(rids[-1])
+        return rids
+
     def _last_rid(self):
         try:
             rid = self._last_rid_from_cache()
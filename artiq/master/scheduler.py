@@ -2,9 +2,12 @@ import asyncio
 import logging
 import csv
 import os.path
+import heapq
+from collections import Counter
 from enum import Enum
-from time import time
+from time import time, monotonic
 
+from sipyco import pyon
 from sipyco.sync_struct import Notifier
 from sipyco.asyncio_tools import TaskObject, Condition
 
@@ -27,6 +30,28 @@ class RunStatus(Enum):
     paused = 8
 
 
+# statuses of runs with a worker process
+_WORKER_STATUSES = {RunStatus.preparing, RunStatus.prepare_done,
+                    RunStatus.running, RunStatus.run_done,
+                    RunStatus.analyzing, RunStatus.paused}
+
+
+def _available_memory():
+    """Returns the memory available for new processes in bytes, or ``None``
+    if it cannot be determined."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES")*os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
 def _mk_worker_method(name):
     async def worker_method(self, *args, **kwargs):
         if self.worker.closed.is_set():
@@ -60,10 +85,23 @@ class Run:
         self.due_date = due_date
         self.flush = flush
 
-        self.worker = Worker(pool.worker_handlers)
+        self.worker = Worker(pool.worker_handlers,
+                             process_pool=pool.process_pool)
         self.termination_requested = False
+        # set when the run has completed cleanly and its worker process
+        # may be reused
+        self.recyclable = False
+        self._recycler = pool.recycler
+        self._experiment_db = pool.experiment_db
+        self._results_options = pool.results_options
+        self._dataset_batch = pool.dataset_batch
 
         self._status = RunStatus.pending
+        self.submission_time = time()
+        # status name -> total time spent in it, in order of first entry,
+        # not including the time since the last status change
+        self.durations = {self._status.name: 0.0}
+        self._status_change_time = monotonic()
 
         notification = {
             "pipeline": self.pipeline_name,
@@ -77,6 +115,7 @@ class Run:
         self._notifier = pool.notifier
         self._notifier[self.rid] = notification
         self._state_changed = pool.state_changed
+        self._index = pool.index
 
     @property
     def status(self):
@@ -84,9 +123,14 @@ class Run:
 
     @status.setter
     def status(self, value):
-        self._status = value
+        previous_status, self._status = self._status, value
+        now = monotonic()
+        self.durations[previous_status.name] += now - self._status_change_time
+        self.durations.setdefault(value.name, 0.0)
+        self._status_change_time = now
         if not self.worker.closed.is_set():
             self._notifier[self.rid]["status"] = self._status.name
+        self._index(self, previous_status)
         self._state_changed.notify()
 
     def priority_key(self):
@@ -96,40 +140,145 @@ class Run:
         """
         return (self.priority, -(self.due_date or 0), -self.rid)
 
+    def heap_key(self):
+        """Return the opposite of :meth:`priority_key`, for use in
+        ``heapq`` min-heaps."""
+        return (-self.priority, self.due_date or 0, self.rid)
+
+    def recycle_key(self):
+        """Returns the key of the runs that may reuse the worker process
+        of this run, or ``None`` if it may not be reused."""
+        if "file" not in self.expid:
+            return None
+        return (self.pipeline_name, self.expid["file"],
+                self.expid.get("repo_rev"),
+                pyon.encode(self.expid.get("devarg_override", {})))
+
+    def get_stats(self):
+        """Returns the total time spent in each status, e.g. in several
+        periods of running and paused, and the durations of the phases
+        reported by the worker, all in seconds."""
+        statuses = dict(self.durations)
+        statuses[self._status.name] += monotonic() - self._status_change_time
+        return {
+            "pipeline": self.pipeline_name,
+            "submission_time": self.submission_time,
+            "statuses": statuses,
+            "phases": dict(self.worker.timings)
+        }
+
     async def close(self):
         # called through pool
+        key = self.recycle_key()
+        if (self._recycler is not None and self.recyclable
+                and key is not None):
+            try:
+                process = await self.worker.detach()
+            except Exception:
+                logger.debug("cannot reuse the worker of RID %d",
+                             self.rid, exc_info=True)
+            else:
+                self._recycler.put(key, *process)
         await self.worker.close()
         del self._notifier[self.rid]
 
     _build = _mk_worker_method("build")
 
     async def build(self):
+        if "repo_rev" in self.expid:
+            await self._experiment_db.repo_backend.wait_rev(
+                self.expid["repo_rev"])
+        key = self.recycle_key()
+        if self._recycler is not None and key is not None:
+            process = self._recycler.claim(key)
+            if process is not None:
+                logger.debug("reusing a worker process for RID %d", self.rid)
+                self.worker.adopt(*process)
         await self._build(self.rid, self.pipeline_name,
                           self.wd, self.expid,
-                          self.priority)
+                          self.priority,
+                          results_options=self._results_options,
+                          dataset_batch=self._dataset_batch)
 
     prepare = _mk_worker_method("prepare")
     run = _mk_worker_method("run")
     resume = _mk_worker_method("resume")
     analyze = _mk_worker_method("analyze")
+    wait_results = _mk_worker_method("wait_results")
+
+
+def _resolve_expid(experiment_db, expid):
+    # Returns the working directory and the repository message of the
+    # experiment, holding its revision until the run is deleted.
+    if "repo_rev" in expid:
+        repo_rev_or_ref = expid["repo_rev"] or experiment_db.cur_rev
+        wd, repo_msg, repo_rev = experiment_db.repo_backend.request_rev(repo_rev_or_ref)
+
+        # Mutate expid's repo_rev to that returned from request_rev, in case
+        # a branch was passed instead of a hash
+        expid["repo_rev"] = repo_rev
+    else:
+        if "file" in expid:
+            expid["file"] = os.path.abspath(expid["file"])
+        wd, repo_msg = None, None
+    return wd, repo_msg
+
+
+def _resolve_expids(experiment_db, expids):
+    # Like _resolve_expid for several experiments, releasing the revisions
+    # already held if one of them fails.
+    locations = []
+    try:
+        for expid in expids:
+            locations.append(_resolve_expid(experiment_db, expid))
+    except:
+        for expid in expids[:len(locations)]:
+            if "repo_rev" in expid:
+                experiment_db.repo_backend.release_rev(expid["repo_rev"])
+        raise
+    return locations
 
 
 class RunPool:
-    def __init__(self, ridc, worker_handlers, notifier, experiment_db, log_submissions):
+    # number of deleted runs kept in the statistics notifier
+    stats_history = 1000
+
+    def __init__(self, ridc, worker_handlers, notifier, experiment_db, log_submissions,
+                 process_pool=None, recycler=None, stats_notifier=None,
+                 results_options=None, dataset_batch=None):
         self.runs = dict()
         self.state_changed = Condition()
 
+        # Priority heaps of the runs that stages select from, with lazy
+        # deletion: entries whose run has since changed status are skipped
+        # when they reach the top.
+        self._heaps = {status: [] for status in (RunStatus.pending,
+                                                 RunStatus.prepare_done,
+                                                 RunStatus.run_done)}
+        # (due_date, rid) of pending runs not due yet
+        self._due_heap = []
+        self.status_counts = Counter()
+
         self.ridc = ridc
         self.worker_handlers = worker_handlers
         self.notifier = notifier
         self.experiment_db = experiment_db
         self.log_submissions = log_submissions
+        self.process_pool = process_pool
+        self.recycler = recycler
+        self.stats_notifier = stats_notifier
+        self.results_options = results_options
+        self.dataset_batch = dataset_batch
 
     def log_submission(self, rid, expid):
+        self.log_submission_many([(rid, expid)])
+
+    def log_submission_many(self, submissions):
         start_time = time()
         with open(self.log_submissions, 'a', newline='') as f:
             writer = csv.writer(f)
-            writer.writerow([rid, start_time, expid["file"]])
+            writer.writerows([rid, start_time, expid["file"]]
+                             for rid, expid in submissions)
 
     def submit(self, expid, priority, due_date, flush, pipeline_name):
         """
@@ -142,25 +291,89 @@ class RunPool:
         # replaces relative path with the absolute one.
         # called through scheduler.
         rid = self.ridc.get()
-        if "repo_rev" in expid:
-            repo_rev_or_ref = expid["repo_rev"] or self.experiment_db.cur_rev
-            wd, repo_msg, repo_rev = self.experiment_db.repo_backend.request_rev(repo_rev_or_ref)
+        self._create_run(rid, expid, priority, due_date, flush, pipeline_name)
+        if self.log_submissions is not None:
+            self.log_submission(rid, expid)
+        self.state_changed.notify()
+        return rid
 
-            # Mutate expid's repo_rev to that returned from request_rev, in case
-            # a branch was passed instead of a hash
-            expid["repo_rev"] = repo_rev
-        else:
-            if "file" in expid:
-                expid["file"] = os.path.abspath(expid["file"])
-            wd, repo_msg = None, None
+    def submit_many(self, rids, specs, locations=None):
+        """
+        Submits several experiments with the given RIDs, with a single
+        notification of the stages and a single write to the submission log.
 
+        ``specs`` are dictionaries with the arguments of :meth:`submit`.
+        ``locations`` are the working directories and repository messages
+        of their experiments, which are resolved if not given. Either all
+        the experiments are submitted, or none if an exception is raised.
+        """
+        # called through scheduler.
+        if locations is None:
+            locations = _resolve_expids(self.experiment_db,
+                                        [spec["expid"] for spec in specs])
+        for rid, spec, location in zip(rids, specs, locations):
+            self._add_run(rid, spec["expid"], spec["priority"],
+                          spec["due_date"], spec["flush"],
+                          spec["pipeline_name"], *location)
+        if self.log_submissions is not None:
+            self.log_submission_many([(rid, spec["expid"])
+                                      for rid, spec in zip(rids, specs)])
+        self.state_changed.notify()
+
+    def _create_run(self, rid, expid, priority, due_date, flush, pipeline_name):
+        wd, repo_msg = _resolve_expid(self.experiment_db, expid)
+        self._add_run(rid, expid, priority, due_date, flush, pipeline_name,
+                      wd, repo_msg)
+
+    def _add_run(self, rid, expid, priority, due_date, flush, pipeline_name,
+                 wd, repo_msg):
         run = Run(rid, pipeline_name, wd, expid, priority, due_date, flush,
                   self, repo_msg=repo_msg)
-        if self.log_submissions is not None:
-            self.log_submission(rid, expid)
         self.runs[rid] = run
-        self.state_changed.notify()
-        return rid
+        self.index(run)
+
+    def index(self, run, previous_status=None):
+        """Records a status change of ``run``."""
+        if previous_status is not None:
+            self.status_counts[previous_status] -= 1
+        self.status_counts[run.status] += 1
+        if run.status == RunStatus.pending and (run.due_date or 0) >= time():
+            heapq.heappush(self._due_heap, (run.due_date, run.rid))
+        elif run.status in self._heaps:
+            heapq.heappush(self._heaps[run.status], (run.heap_key(), run.rid))
+
+    def _is_current(self, rid, status):
+        return rid in self.runs and self.runs[rid].status == status
+
+    def promote_due_runs(self, now):
+        """Makes the pending runs whose due date is before ``now``
+        available from :meth:`get_top`."""
+        heap = self._due_heap
+        while heap and heap[0][0] < now:
+            _, rid = heapq.heappop(heap)
+            if self._is_current(rid, RunStatus.pending):
+                run = self.runs[rid]
+                heapq.heappush(self._heaps[RunStatus.pending],
+                               (run.heap_key(), rid))
+
+    def next_due_date(self):
+        """Returns the earliest due date of the pending runs not yet
+        promoted, or ``None``."""
+        heap = self._due_heap
+        while heap and not self._is_current(heap[0][1], RunStatus.pending):
+            heapq.heappop(heap)
+        return heap[0][0] if heap else None
+
+    def get_top(self, status):
+        """Returns the highest-priority run with the given status (pending,
+        prepare_done or run_done), or ``None``.
+
+        For pending runs, only those which were due at the last call of
+        :meth:`promote_due_runs` are considered."""
+        heap = self._heaps[status]
+        while heap and not self._is_current(heap[0][1], status):
+            heapq.heappop(heap)
+        return self.runs[heap[0][1]] if heap else None
 
     async def delete(self, rid):
         # called through deleter
@@ -171,12 +384,37 @@ class RunPool:
         if "repo_rev" in run.expid:
             self.experiment_db.repo_backend.release_rev(run.expid["repo_rev"])
         del self.runs[rid]
+        self.status_counts[run.status] -= 1
+        if self.stats_notifier is not None:
+            self.stats_notifier[rid] = run.get_stats()
+            stats = self.stats_notifier.raw_view
+            while len(stats) > self.stats_history:
+                del self.stats_notifier[next(iter(stats))]
+
+    def worker_count(self):
+        """Returns the number of runs that have a worker process."""
+        return sum(self.status_counts[status] for status in _WORKER_STATUSES)
 
 
 class PrepareStage(TaskObject):
-    def __init__(self, pool, delete_cb):
+    """Builds and prepares the pending runs.
+
+    A run is prepared when no other run is prepared, or when it takes
+    precedence over the prepared runs. Up to ``depth`` runs in total may
+    also be prepared ahead of time, as long as the pipeline has fewer than
+    ``max_workers`` worker processes (if not ``None``) and at least
+    ``min_free_memory`` bytes of memory are available.
+    """
+    # period of the checks of the available memory
+    memory_check_period = 1.0
+
+    def __init__(self, pool, delete_cb, depth=1, max_workers=None,
+                 min_free_memory=0):
         self.pool = pool
         self.delete_cb = delete_cb
+        self.depth = depth
+        self.max_workers = max_workers
+        self.min_free_memory = min_free_memory
 
     def _get_run(self):
         """If a run should get prepared now, return it. Otherwise, return a
@@ -187,29 +425,33 @@ class PrepareStage(TaskObject):
         of them are going to become next-in-line before further pool state
         changes (which will also cause a re-evaluation).
         """
-        pending_runs = list(
-            filter(lambda r: r.status == RunStatus.pending,
-                   self.pool.runs.values()))
-
         now = time()
-        def is_runnable(r):
-            return (r.due_date or 0) < now
-
-        prepared_max = max((r.priority_key() for r in self.pool.runs.values()
-                            if r.status == RunStatus.prepare_done),
-                           default=None)
-        def takes_precedence(r):
-            return prepared_max is None or r.priority_key() > prepared_max
-
-        candidate = max(filter(is_runnable, pending_runs),
-                        key=lambda r: r.priority_key(),
-                        default=None)
-        if candidate is not None and takes_precedence(candidate):
-            return candidate
+        self.pool.promote_due_runs(now)
+
+        prepared = self.pool.get_top(RunStatus.prepare_done)
+        candidate = self.pool.get_top(RunStatus.pending)
+        retry = None
+        if candidate is not None:
+            if (prepared is None
+                    or candidate.priority_key() > prepared.priority_key()):
+                return candidate
+            if (self.pool.status_counts[RunStatus.prepare_done] < self.depth
+                    and (self.max_workers is None
+                         or self.pool.worker_count() < self.max_workers)):
+                if self.min_free_memory:
+                    available = _available_memory()
+                    if available is None or available >= self.min_free_memory:
+                        return candidate
+                    retry = self.memory_check_period
+                else:
+                    return candidate
 
-        return min((r.due_date - now for r in pending_runs
-                    if (not is_runnable(r) and takes_precedence(r))),
-                   default=None)
+        # Checking whether the run due next takes precedence over the
+        # prepared run would require scanning all the pending runs.
+        next_due_date = self.pool.next_due_date()
+        if next_due_date is not None:
+            retry = min(float(next_due_date - now), retry or float("inf"))
+        return retry
 
     async def _do(self):
         while True:
@@ -254,14 +496,7 @@ class RunStage(TaskObject):
         self.delete_cb = delete_cb
 
     def _get_run(self):
-        prepared_runs = filter(lambda r: r.status == RunStatus.prepare_done,
-                               self.pool.runs.values())
-        try:
-            r = max(prepared_runs, key=lambda r: r.priority_key())
-        except ValueError:
-            # prepared_runs is an empty sequence
-            r = None
-        return r
+        return self.pool.get_top(RunStatus.prepare_done)
 
     async def _do(self):
         stack = []
@@ -303,42 +538,87 @@ class RunStage(TaskObject):
 
 
 class AnalyzeStage(TaskObject):
-    def __init__(self, pool, delete_cb):
+    """Analyzes the runs of the pool, up to ``concurrency`` of them at
+    the same time."""
+    def __init__(self, pool, delete_cb, concurrency=1):
         self.pool = pool
         self.delete_cb = delete_cb
+        self.concurrency = concurrency
+        # tasks waiting for results files to be written
+        self._results_tasks = set()
 
     def _get_run(self):
-        run_runs = filter(lambda r: r.status == RunStatus.run_done,
-                          self.pool.runs.values())
+        return self.pool.get_top(RunStatus.run_done)
+
+    async def _wait_results(self, run):
         try:
-            r = max(run_runs, key=lambda r: r.priority_key())
-        except ValueError:
-            # run_runs is an empty sequence
-            r = None
-        return r
+            await run.wait_results()
+        except Exception:
+            logger.error("got worker exception writing the results of "
+                         "RID %d.", run.rid)
+            log_worker_exception()
+        else:
+            run.recyclable = not run.termination_requested
+        self.delete_cb(run.rid)
 
-    async def _do(self):
-        while True:
-            run = self._get_run()
-            while run is None:
-                await self.pool.state_changed.wait()
-                run = self._get_run()
-            run.status = RunStatus.analyzing
-            try:
-                await run.analyze()
-            except Exception:
-                logger.error("got worker exception in analyze stage of RID %d.",
-                             run.rid)
-                log_worker_exception()
+    async def _analyze(self, run):
+        try:
+            await run.analyze()
+        except Exception:
+            logger.error("got worker exception in analyze stage of RID %d.",
+                         run.rid)
+            log_worker_exception()
             self.delete_cb(run.rid)
+        else:
+            # The results file is written in the background by the worker
+            # process, which must not be terminated meanwhile. Wait for it
+            # without holding up other analyses or the deletion of other
+            # runs.
+            task = asyncio.ensure_future(self._wait_results(run))
+            self._results_tasks.add(task)
+            task.add_done_callback(self._results_tasks.discard)
+
+    async def _do(self):
+        tasks = set()
+
+        def task_done(task):
+            tasks.discard(task)
+            self.pool.state_changed.notify()
+
+        try:
+            while True:
+                run = None
+                if len(tasks) < self.concurrency:
+                    run = self._get_run()
+                while run is None:
+                    await self.pool.state_changed.wait()
+                    if len(tasks) < self.concurrency:
+                        run = self._get_run()
+                run.status = RunStatus.analyzing
+                task = asyncio.ensure_future(self._analyze(run))
+                tasks.add(task)
+                task.add_done_callback(task_done)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            results_tasks = list(self._results_tasks)
+            for task in results_tasks:
+                task.cancel()
+            await asyncio.gather(*results_tasks, return_exceptions=True)
 
 
 class Pipeline:
-    def __init__(self, ridc, deleter, worker_handlers, notifier, experiment_db, log_submissions):
-        self.pool = RunPool(ridc, worker_handlers, notifier, experiment_db, log_submissions)
-        self._prepare = PrepareStage(self.pool, deleter.delete)
+    def __init__(self, ridc, deleter, worker_handlers, notifier, experiment_db, log_submissions,
+                 process_pool=None, prepare_options=dict(), analyze_concurrency=1,
+                 recycler=None, stats_notifier=None, results_options=None,
+                 dataset_batch=None):
+        self.pool = RunPool(ridc, worker_handlers, notifier, experiment_db, log_submissions,
+                            process_pool, recycler, stats_notifier,
+                            results_options, dataset_batch)
+        self._prepare = PrepareStage(self.pool, deleter.delete, **prepare_options)
         self._run = RunStage(self.pool, deleter.delete)
-        self._analyze = AnalyzeStage(self.pool, deleter.delete)
+        self._analyze = AnalyzeStage(self.pool, deleter.delete, analyze_concurrency)
 
     def start(self, *, loop=None):
         self._prepare.start(loop=loop)
@@ -358,8 +638,9 @@ class Deleter(TaskObject):
     :meth:`RunPool.delete` is an async function (it needs to close the worker
     connection, etc.), so we maintain a queue of RIDs to delete on a background task.
     """
-    def __init__(self, pipelines):
+    def __init__(self, pipelines, run_pipelines):
         self._pipelines = pipelines
+        self._run_pipelines = run_pipelines
         self._queue = asyncio.Queue()
 
     def delete(self, rid):
@@ -368,10 +649,8 @@ class Deleter(TaskObject):
         Multiple calls for the same RID are silently ignored.
         """
         logger.debug("delete request for RID %d", rid)
-        for pipeline in self._pipelines.values():
-            if rid in pipeline.pool.runs:
-                pipeline.pool.runs[rid].status = RunStatus.deleting
-                break
+        if rid in self._run_pipelines:
+            self._run_pipelines[rid].pool.runs[rid].status = RunStatus.deleting
         self._queue.put_nowait(rid)
 
     async def join(self):
@@ -380,12 +659,12 @@ class Deleter(TaskObject):
     async def _delete(self, rid):
         # By looking up the run by RID, we implicitly make sure to delete each run only
         # once.
-        for pipeline in self._pipelines.values():
-            if rid in pipeline.pool.runs:
-                logger.debug("deleting RID %d...", rid)
-                await pipeline.pool.delete(rid)
-                logger.debug("deletion of RID %d completed", rid)
-                break
+        pipeline = self._run_pipelines.get(rid)
+        if pipeline is not None:
+            logger.debug("deleting RID %d...", rid)
+            await pipeline.pool.delete(rid)
+            del self._run_pipelines[rid]
+            logger.debug("deletion of RID %d completed", rid)
 
     async def _gc_pipelines(self):
         pipeline_names = list(self._pipelines.keys())
@@ -406,8 +685,13 @@ class Deleter(TaskObject):
 
 
 class Scheduler:
-    def __init__(self, ridc, worker_handlers, experiment_db, log_submissions):
+    def __init__(self, ridc, worker_handlers, experiment_db, log_submissions,
+                 process_pool=None, prepare_depth=1, max_workers=None,
+                 min_free_memory=0, analyze_concurrency=1, recycler=None,
+                 results_options=None, dataset_batch=None):
         self.notifier = Notifier(dict())
+        # RID -> statistics of the recently deleted runs
+        self.stats_notifier = Notifier(dict())
 
         self._pipelines = dict()
         self._worker_handlers = worker_handlers
@@ -415,8 +699,20 @@ class Scheduler:
         self._terminated = False
 
         self._ridc = ridc
-        self._deleter = Deleter(self._pipelines)
+        self._run_pipelines = dict()  # rid -> Pipeline
+        self._deleter = Deleter(self._pipelines, self._run_pipelines)
         self._log_submissions = log_submissions
+        self._process_pool = process_pool
+        self._prepare_depth = prepare_depth
+        self._prepare_depths = dict()  # pipeline name -> prepare depth
+        self._max_workers = max_workers
+        self._min_free_memory = min_free_memory
+        self._analyze_concurrency = analyze_concurrency
+        self._recycler = recycler
+        # options of the results files, see worker.Worker.build
+        self._results_options = results_options
+        # batching of dataset modifications, see worker.Worker.build
+        self._dataset_batch = dataset_batch
 
     def start(self, *, loop=None):
         self._loop = loop
@@ -443,16 +739,86 @@ class Scheduler:
         # replaces relative file path with absolute one
         if self._terminated:
             return
+        pipeline = self._get_pipeline(pipeline_name)
+        rid = pipeline.pool.submit(expid, priority, due_date, flush, pipeline_name)
+        self._run_pipelines[rid] = pipeline
+        return rid
+
+    def submit_many(self, specs):
+        """Submits several new runs and returns the list of their RIDs.
+
+        ``specs`` is a list of dictionaries with the arguments of
+        :meth:`submit`. ``pipeline_name`` and ``expid`` are required.
+        The runs get consecutive RIDs, and are added with a single
+        notification of each pipeline and a single write to the submission
+        log. If an exception is raised, e.g. for an unknown revision, no run
+        is submitted."""
+        if self._terminated:
+            return
+        specs = [{
+            "pipeline_name": spec["pipeline_name"],
+            "expid": spec["expid"],
+            "priority": spec.get("priority", 0),
+            "due_date": spec.get("due_date", None),
+            "flush": spec.get("flush", False)
+        } for spec in specs]
+        # All the revisions are resolved before any run is created, so
+        # that no run is submitted if one of them fails.
+        locations = _resolve_expids(self._experiment_db,
+                                    [spec["expid"] for spec in specs])
+        rids = self._ridc.get_range(len(specs))
+        by_pipeline = dict()
+        for rid, spec, location in zip(rids, specs, locations):
+            by_pipeline.setdefault(spec["pipeline_name"], []).append(
+                (rid, spec, location))
+        for pipeline_name, submissions in by_pipeline.items():
+            pipeline = self._get_pipeline(pipeline_name)
+            pipeline_rids, pipeline_specs, pipeline_locations = zip(
+                *submissions)
+            pipeline.pool.submit_many(pipeline_rids, pipeline_specs,
+                                      pipeline_locations)
+            for rid in pipeline_rids:
+                self._run_pipelines[rid] = pipeline
+        return list(rids)
+
+    def _get_pipeline(self, pipeline_name):
         try:
-            pipeline = self._pipelines[pipeline_name]
+            return self._pipelines[pipeline_name]
         except KeyError:
             logger.debug("creating pipeline '%s'", pipeline_name)
             pipeline = Pipeline(self._ridc, self._deleter,
                                 self._worker_handlers, self.notifier,
-                                self._experiment_db, self._log_submissions)
+                                self._experiment_db, self._log_submissions,
+                                self._process_pool, {
+                                    "depth": self._prepare_depths.get(
+                                        pipeline_name, self._prepare_depth),
+                                    "max_workers": self._max_workers,
+                                    "min_free_memory": self._min_free_memory
+                                }, self._analyze_concurrency,
+                                self._recycler, self.stats_notifier,
+                                self._results_options, self._dataset_batch)
             self._pipelines[pipeline_name] = pipeline
             pipeline.start(loop=self._loop)
-        return pipeline.pool.submit(expid, priority, due_date, flush, pipeline_name)
+            return pipeline
+
+    def set_prepare_depth(self, pipeline_name, depth):
+        """Sets the number of runs of a pipeline that may be prepared ahead
+        of time, while the current run is running or being analyzed.
+
+        With the default depth of 1, only the next run is prepared."""
+        if depth < 1:
+            raise ValueError("prepare depth must be at least 1")
+        self._prepare_depths[pipeline_name] = depth
+        pipeline = self._pipelines.get(pipeline_name)
+        if pipeline is not None:
+            pipeline._prepare.depth = depth
+            pipeline.pool.state_changed.notify()
+
+    def _get_run(self, rid):
+        pipeline = self._run_pipelines.get(rid)
+        if pipeline is None:
+            return None
+        return pipeline.pool.runs[rid]
 
     def delete(self, rid):
         """Kills the run with the specified RID."""
@@ -460,14 +826,12 @@ class Scheduler:
 
     def request_termination(self, rid):
         """Requests graceful termination of the run with the specified RID."""
-        for pipeline in self._pipelines.values():
-            if rid in pipeline.pool.runs:
-                run = pipeline.pool.runs[rid]
-                if run.status == RunStatus.running or run.status == RunStatus.paused:
-                    run.termination_requested = True
-                else:
-                    self.delete(rid)
-                break
+        run = self._get_run(rid)
+        if run is not None:
+            if run.status == RunStatus.running or run.status == RunStatus.paused:
+                run.termination_requested = True
+            else:
+                self.delete(rid)
 
     def get_status(self):
         """Returns a dictionary containing information about the runs currently
@@ -488,29 +852,21 @@ class Scheduler:
         This function does not have side effects, and does not have to be
         followed by a call to :meth:`pause`.
         """
-        for pipeline in self._pipelines.values():
-            if rid in pipeline.pool.runs:
-                run = pipeline.pool.runs[rid]
-                if run.status != RunStatus.running:
-                    return False
-                if run.termination_requested:
-                    return True
-
-                prepared_runs = filter(lambda r: r.status == RunStatus.prepare_done,
-                                       pipeline.pool.runs.values())
-                try:
-                    r = max(prepared_runs, key=lambda r: r.priority_key())
-                except ValueError:
-                    # prepared_runs is an empty sequence
-                    return False
-                return r.priority_key() > run.priority_key()
-        raise KeyError("RID not found")
+        pipeline = self._run_pipelines.get(rid)
+        if pipeline is None:
+            raise KeyError("RID not found")
+        run = pipeline.pool.runs[rid]
+        if run.status != RunStatus.running:
+            return False
+        if run.termination_requested:
+            return True
+
+        r = pipeline.pool.get_top(RunStatus.prepare_done)
+        if r is None:
+            return False
+        return r.priority_key() > run.priority_key()
 
     def check_termination(self, rid):
         """Returns ``True`` if termination is requested."""
-        for pipeline in self._pipelines.values():
-            if rid in pipeline.pool.runs:
-                run = pipeline.pool.runs[rid]
-                if run.termination_requested:
-                    return True
-        return False
+        run = self._get_run(rid)
+        return run is not None and run.termination_requested
@@ -4,12 +4,15 @@ import asyncio
 import logging
 import subprocess
 import time
+from collections import deque
 
-from sipyco import pipe_ipc, pyon
+from sipyco import pipe_ipc
 from sipyco.logging_tools import LogParser
 from sipyco.packed_exceptions import current_exc_packed
+from sipyco.asyncio_tools import TaskObject
 
 from artiq.tools import asyncio_wait_or_cancel
+from artiq.master import worker_ipc
 
 
 logger = logging.getLogger(__name__)
@@ -41,15 +44,185 @@ def log_worker_exception():
         logger.error("worker exception details", exc_info=True)
 
 
+async def _spawn_process(log_level, log_source):
+    """Starts a worker process. Its output is logged with the source
+    returned by the function in the one-element list ``log_source``, which
+    may be replaced when the process changes owner."""
+    def get_log_source():
+        return log_source[0]()
+
+    ipc = pipe_ipc.AsyncioParentComm()
+    env = os.environ.copy()
+    env["PYTHONUNBUFFERED"] = "1"
+    await ipc.create_subprocess(
+        sys.executable, "-m", "artiq.master.worker_impl",
+        ipc.get_address(), str(log_level),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        env=env, start_new_session=True)
+    asyncio.ensure_future(
+        LogParser(get_log_source).stream_task(ipc.process.stdout))
+    asyncio.ensure_future(
+        LogParser(get_log_source).stream_task(ipc.process.stderr))
+    return ipc
+
+
+async def _terminate_process(ipc, term_timeout=2.0):
+    try:
+        worker_ipc.write(ipc, {"action": "terminate"})
+        await asyncio.wait_for(ipc.drain(), term_timeout)
+        await asyncio.wait_for(ipc.process.wait(), term_timeout)
+    except Exception:
+        logger.debug("idle worker failed to exit on request, killing",
+                     exc_info=True)
+        try:
+            ipc.process.kill()
+        except ProcessLookupError:
+            pass
+        await ipc.process.wait()
+
+
+class WorkerProcessPool(TaskObject):
+    """Keeps ``size`` worker processes started in advance, with ARTIQ
+    already imported, that :class:`Worker` can use instead of starting a new
+    process. Each process is used only once, and replaced in the background.
+
+    The processes are started with the given log level, which is changed to
+    the one of the experiment by the build action.
+    """
+    def __init__(self, size, log_level=logging.WARNING):
+        self.size = size
+        self.log_level = log_level
+        # (ipc, [get_log_source]) of the idle processes
+        self._idle = deque()
+        self._replenish = asyncio.Event()
+
+    def claim(self):
+        """Returns the IPC and log source list (see :func:`_spawn_process`)
+        of an idle worker process, or ``None`` if there is none."""
+        self._replenish.set()
+        while self._idle:
+            ipc, log_source = self._idle.popleft()
+            if ipc.process.returncode is None:
+                return ipc, log_source
+            logger.warning("idle worker process ended with status code %d",
+                           ipc.process.returncode)
+        return None
+
+    async def _do(self):
+        try:
+            while True:
+                while len(self._idle) < self.size:
+                    log_source = [lambda: "worker(<idle>)"]
+                    ipc = await _spawn_process(self.log_level, log_source)
+                    self._idle.append((ipc, log_source))
+                self._replenish.clear()
+                await self._replenish.wait()
+        finally:
+            while self._idle:
+                ipc, _ = self._idle.popleft()
+                if ipc.process.returncode is None:
+                    await _terminate_process(ipc)
+
+
+class WorkerRecycler(TaskObject):
+    """Keeps the worker processes of completed runs, so that later runs
+    with the same key (see :meth:`artiq.master.scheduler.Run.recycle_key`)
+    can reuse them instead of starting a new process. The imported
+    experiment module and the open device connections are then kept.
+
+    Processes that stay unused for ``idle_timeout`` seconds are terminated,
+    as are the oldest ones when there are more than ``max_idle``.
+    """
+    def __init__(self, idle_timeout=60.0, max_idle=4):
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle
+        # key -> deque of (ipc, log_source, expiry) of the idle processes
+        self._idle = dict()
+        self._changed = asyncio.Event()
+
+    def put(self, key, ipc, log_source):
+        """Adds the idle worker process with the given IPC and log source
+        list under ``key``."""
+        log_source[0] = lambda: "worker(<idle>)"
+        self._idle.setdefault(key, deque()).append(
+            (ipc, log_source, time.monotonic() + self.idle_timeout))
+        self._changed.set()
+
+    def claim(self, key):
+        """Returns the IPC and log source list of an idle worker process
+        with the given key, or ``None`` if there is none."""
+        processes = self._idle.get(key)
+        while processes:
+            ipc, log_source, _ = processes.pop()
+            if not processes:
+                del self._idle[key]
+            if ipc.process.returncode is None:
+                return ipc, log_source
+        return None
+
+    def _pop_expired(self):
+        now = time.monotonic()
+        # oldest first, matching the order of each deque
+        entries = sorted(((expiry, key)
+                          for key, processes in self._idle.items()
+                          for _, _, expiry in processes),
+                         key=lambda entry: entry[0])
+        excess = len(entries) - self.max_idle
+        expired = []
+        for i, (expiry, key) in enumerate(entries):
+            if i >= excess and expiry > now:
+                break
+            expired.append(self._idle[key].popleft()[0])
+        for key in [key for key, processes in self._idle.items()
+                    if not processes]:
+            del self._idle[key]
+        return expired
+
+    def _next_expiry(self):
+        return min((processes[0][2] for processes in self._idle.values()),
+                   default=None)
+
+    async def _do(self):
+        try:
+            while True:
+                for ipc in self._pop_expired():
+                    if ipc.process.returncode is None:
+                        await _terminate_process(ipc)
+                self._changed.clear()
+                next_expiry = self._next_expiry()
+                timeout = None
+                if next_expiry is not None:
+                    timeout = max(next_expiry - time.monotonic(), 0)
+                await asyncio_wait_or_cancel([self._changed.wait()],
+                                             timeout=timeout)
+        finally:
+            for processes in self._idle.values():
+                for ipc, _, _ in processes:
+                    if ipc.process.returncode is None:
+                        await _terminate_process(ipc)
+            self._idle.clear()
+
+
 class Worker:
-    def __init__(self, handlers=dict(), send_timeout=10.0):
+    def __init__(self, handlers=dict(), send_timeout=10.0, process_pool=None):
         self.handlers = handlers
         self.send_timeout = send_timeout
+        self.process_pool = process_pool
 
         self.rid = None
         self.filename = None
         self.ipc = None
+        self._log_source = [self._get_log_source]
         self.watchdogs = dict()  # wid -> expiration (using time.monotonic)
+        # exception raised by the last failed asynchronous request,
+        # reported to the worker in the reply to the next request
+        self.async_exception = None
+        # phase -> duration in seconds, reported by the worker process
+        # (see worker_impl) and for the process startup ("spawn")
+        self.timings = dict()
+        # set when the worker process may be writing the results file of
+        # the run in the background, see wait_results()
+        self.results_pending = False
 
         self.io_lock = asyncio.Lock()
         self.closed = asyncio.Event()
@@ -83,29 +256,58 @@ class Worker:
         try:
             if self.closed.is_set():
                 raise WorkerError("Attempting to create process after close")
-            self.ipc = pipe_ipc.AsyncioParentComm()
-            env = os.environ.copy()
-            env["PYTHONUNBUFFERED"] = "1"
-            await self.ipc.create_subprocess(
-                sys.executable, "-m", "artiq.master.worker_impl",
-                self.ipc.get_address(), str(log_level),
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                env=env, start_new_session=True)
-            asyncio.ensure_future(
-                LogParser(self._get_log_source).stream_task(
-                    self.ipc.process.stdout))
-            asyncio.ensure_future(
-                LogParser(self._get_log_source).stream_task(
-                    self.ipc.process.stderr))
+            process = None
+            if self.process_pool is not None:
+                process = self.process_pool.claim()
+            if process is not None:
+                self.adopt(*process)
+            else:
+                start = time.monotonic()
+                self.ipc = await _spawn_process(log_level, self._log_source)
+                self.timings["spawn"] = time.monotonic() - start
         finally:
             self.io_lock.release()
 
-    async def close(self, term_timeout=2.0):
+    def adopt(self, ipc, log_source):
+        """Uses the already started worker process with the given IPC and
+        log source list, e.g. returned by :meth:`detach`."""
+        assert self.ipc is None
+        self.ipc = ipc
+        self._log_source = log_source
+        self._log_source[0] = self._get_log_source
+
+    async def detach(self, timeout=10.0):
+        """Resets the worker process after a completed run and returns its
+        IPC and log source list, for use by another :class:`Worker`.
+
+        This :class:`Worker` must then be closed as usual, without
+        affecting the process. Raises an exception if the process could
+        not be reset, in which case :meth:`close` terminates it.
+
+        The results of the run are written first, see :meth:`wait_results`;
+        ``timeout`` only applies to the reset."""
+        if self.ipc is None or self.closed.is_set():
+            raise WorkerError("No worker process to detach (RID {})"
+                              .format(self.rid))
+        await self.wait_results()
+        await self._worker_action({"action": "reset"}, timeout)
+        if self.async_exception is not None:
+            raise WorkerError("Pending asynchronous request failure (RID {})"
+                              .format(self.rid))
+        ipc, log_source = self.ipc, self._log_source
+        self.ipc = None
+        return ipc, log_source
+
+    async def close(self, term_timeout=2.0, results_timeout=3600.0):
         """Interrupts any I/O with the worker process and terminates the
         worker process.
 
         This method should always be called by the user to clean up, even if
-        build() or examine() raises an exception."""
+        build() or examine() raises an exception.
+
+        A worker process that may be writing the results file of the run
+        is given ``results_timeout`` seconds to exit instead of
+        ``term_timeout``, so that the file is not left incomplete."""
         self.closed.set()
         await self.io_lock.acquire()
         try:
@@ -120,11 +322,26 @@ class Worker:
                                    " (RID %s)", self.ipc.process.returncode,
                                    self.rid)
                 return
+            if self.results_pending:
+                logger.debug("waiting for the results of RID %s to be "
+                             "written", self.rid)
+                exit_timeout = results_timeout
+            else:
+                exit_timeout = term_timeout
             try:
                 await self._send({"action": "terminate"}, cancellable=False)
-                await asyncio.wait_for(self.ipc.process.wait(), term_timeout)
+                await asyncio.wait_for(self.ipc.process.wait(), exit_timeout)
                 logger.debug("worker exited on request (RID %s)", self.rid)
                 return
+            except asyncio.TimeoutError:
+                if self.results_pending:
+                    logger.warning("worker did not finish writing the results"
+                                   " of RID %s within %s seconds, ending the"
+                                   " process", self.rid, results_timeout)
+                else:
+                    logger.debug("worker failed to exit on request"
+                                 " (RID %s), ending the process", self.rid,
+                                 exc_info=True)
             except:
                 logger.debug("worker failed to exit on request"
                              " (RID %s), ending the process", self.rid,
@@ -157,8 +374,7 @@ class Worker:
 
     async def _send(self, obj, cancellable=True):
         assert self.io_lock.locked()
-        line = pyon.encode(obj)
-        self.ipc.write((line + "\n").encode())
+        worker_ipc.write(self.ipc, obj)
         ifs = [self.ipc.drain()]
         if cancellable:
             ifs.append(self.closed.wait())
@@ -178,8 +394,10 @@ class Worker:
 
     async def _recv(self, timeout):
         assert self.io_lock.locked()
+        # NB: a timeout in the middle of a frame desynchronizes the
+        # connection, but the worker is then closed anyway.
         fs = await asyncio_wait_or_cancel(
-            [self.ipc.readline(), self.closed.wait()],
+            [worker_ipc.read(self.ipc), self.closed.wait()],
             timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
         if all(f.cancelled() for f in fs):
             raise WorkerTimeout(
@@ -188,18 +406,29 @@ class Worker:
             raise WorkerError(
                 "Receiving data from worker cancelled (RID {})".format(
                     self.rid))
-        line = fs[0].result()
-        if not line:
-            raise WorkerError(
-                "Worker ended while attempting to receive data (RID {})".
-                format(self.rid))
         try:
-            obj = pyon.decode(line.decode())
+            obj = fs[0].result()
+        except EOFError:
+            obj = None
         except:
-            raise WorkerError("Worker sent invalid PYON data (RID {})".format(
+            raise WorkerError("Worker sent invalid data (RID {})".format(
                 self.rid))
+        if obj is None:
+            raise WorkerError(
+                "Worker ended while attempting to receive data (RID {})".
+                format(self.rid))
         return obj
 
+    async def _call_handler(self, func, obj):
+        if getattr(func, "_worker_pass_rid", False):
+            args = [self.rid] + list(obj["args"])
+        else:
+            args = obj["args"]
+        data = func(*args, **obj["kwargs"])
+        if asyncio.iscoroutine(data):
+            data = await data
+        return data
+
     async def _handle_worker_requests(self):
         while True:
             try:
@@ -212,6 +441,12 @@ class Worker:
                 raise WorkerWatchdogTimeout
             action = obj["action"]
             if action == "completed":
+                self.timings.update(obj.get("timings", dict()))
+                if self.async_exception is not None:
+                    # no synchronous request reported it
+                    self.async_exception = None
+                    raise WorkerError("Asynchronous request failed "
+                                      "(RID {})".format(self.rid))
                 return True
             elif action == "pause":
                 return False
@@ -223,22 +458,35 @@ class Worker:
                 func = self.delete_watchdog
             elif action == "register_experiment":
                 func = self.register_experiment
+            elif action == "register_dependencies":
+                func = self.register_dependencies
             else:
                 func = self.handlers[action]
-            try:
-                if getattr(func, "_worker_pass_rid", False):
-                    args = [self.rid] + list(obj["args"])
-                else:
-                    args = obj["args"]
-                data = func(*args, **obj["kwargs"])
-                if asyncio.iscoroutine(data):
-                    data = await data
-                reply = {"status": "ok", "data": data}
-            except Exception:
+            if obj.get("async", False):
+                try:
+                    await self._call_handler(func, obj)
+                except Exception:
+                    logger.error("asynchronous request %s from worker "
+                                 "failed", action, exc_info=True)
+                    if self.async_exception is None:
+                        self.async_exception = current_exc_packed()
+                # no reply
+                continue
+            if self.async_exception is not None:
                 reply = {
                     "status": "failed",
-                    "exception": current_exc_packed()
+                    "exception": self.async_exception
                 }
+                self.async_exception = None
+            else:
+                try:
+                    data = await self._call_handler(func, obj)
+                    reply = {"status": "ok", "data": data}
+                except Exception:
+                    reply = {
+                        "status": "failed",
+                        "exception": current_exc_packed()
+                    }
             await self.io_lock.acquire()
             try:
                 await self._send(reply)
@@ -264,7 +512,19 @@ class Worker:
         return completed
 
     async def build(self, rid, pipeline_name, wd, expid, priority,
-                    timeout=15.0):
+                    timeout=15.0, results_options=None, dataset_batch=None):
+        """Starts the worker process and builds the experiment.
+
+        ``results_options`` is a dictionary that may contain
+        ``hdf5_options``, the default HDF5 dataset creation options of
+        array datasets, and ``stream_interval``, the interval in seconds at
+        which archived datasets are written to the results file during
+        ``run()``.
+
+        ``dataset_batch`` is a dictionary with the ``batch_size`` and
+        ``batch_period`` arguments of
+        :class:`~artiq.master.worker_db.DatasetManager`, used for the
+        modifications of broadcast datasets."""
         self.rid = rid
         if "file" in expid:
             self.filename = os.path.basename(expid["file"])
@@ -275,7 +535,9 @@ class Worker:
              "pipeline_name": pipeline_name,
              "wd": wd,
              "expid": expid,
-             "priority": priority},
+             "priority": priority,
+             "results_options": results_options,
+             "dataset_batch": dataset_batch},
             timeout)
 
     async def prepare(self):
@@ -299,8 +561,29 @@ class Worker:
 
     async def analyze(self):
         await self._worker_action({"action": "analyze"})
+        self.results_pending = True
+
+    async def wait_results(self):
+        """Waits until the worker process has written the results file of
+        the run, without time limit.
 
-    async def examine(self, rid, file, timeout=20.0):
+        The file is written in the background after :meth:`analyze` has
+        completed. Raises an exception if writing it failed."""
+        if not self.results_pending:
+            return
+        try:
+            await self._worker_action({"action": "wait_results"})
+        except Exception:
+            # the process does not write anything after an exception
+            self.results_pending = False
+            raise
+        self.results_pending = False
+
+    async def examine(self, rid, file, timeout=20.0, dependencies=None):
+        """Returns the descriptions of the experiments in ``file``.
+
+        If ``dependencies`` is a list, the files of the modules imported
+        by ``file`` are appended to it."""
         self.rid = rid
         self.filename = os.path.basename(file)
 
@@ -315,8 +598,13 @@ class Worker:
                 "argument_ui": argument_ui,
                 "scheduler_defaults": scheduler_defaults
             }
+        def register_dependencies(files):
+            if dependencies is not None:
+                dependencies.extend(files)
         self.register_experiment = register
+        self.register_dependencies = register_dependencies
         await self._worker_action({"action": "examine", "file": file},
                                   timeout)
         del self.register_experiment
+        del self.register_dependencies
         return r
@@ -7,10 +7,18 @@ standalone command line tools).
 from operator import setitem
 import importlib
 import logging
+import copy
+import time
+import threading
+
+import numpy as np
 
 from sipyco.sync_struct import Notifier
+from sipyco import pyon
 from sipyco.pc_rpc import AutoTarget, Client, BestEffortClient
 
+from artiq.language.environment import AppendBuffer
+
 
 logger = logging.getLogger(__name__)
 
@@ -61,6 +69,8 @@ class DeviceManager:
         self.ddb = ddb
         self.virtual_devices = virtual_devices
         self.active_devices = []
+        # PYON encoding of the description -> device, for active_devices
+        self._active_index = dict()
         self.devarg_override = {}
 
     def get_device_db(self):
@@ -82,9 +92,11 @@ class DeviceManager:
             raise DeviceError("Failed to get description of device '{}'"
                               .format(name)) from e
 
-        for existing_desc, existing_dev in self.active_devices:
-            if desc == existing_desc:
-                return existing_dev
+        index_key = pyon.encode(desc)
+        try:
+            return self._active_index[index_key]
+        except KeyError:
+            pass
 
         try:
             dev = _create_device(desc, self, self.devarg_override.get(name, {}))
@@ -92,6 +104,7 @@ class DeviceManager:
             raise DeviceError("Failed to create device '{}'"
                               .format(name)) from e
         self.active_devices.append((desc, dev))
+        self._active_index[index_key] = dev
         return dev
 
     def notify_run_end(self):
@@ -101,6 +114,18 @@ class DeviceManager:
             if hasattr(dev, "notify_run_end"):
                 dev.notify_run_end()
 
+    def get_timings(self):
+        """Returns the sum of the timings reported by the ``get_timings``
+        methods of the active devices (e.g. the core device driver) since
+        the last call."""
+        timings = dict()
+        for _desc, dev in self.active_devices:
+            if (not isinstance(dev, (Client, BestEffortClient))
+                    and hasattr(dev, "get_timings")):
+                for phase, duration in dev.get_timings().items():
+                    timings[phase] = timings.get(phase, 0.0) + duration
+        return timings
+
     def close_devices(self):
         """Closes all active devices, in the opposite order as they were
         requested."""
@@ -114,22 +139,106 @@ class DeviceManager:
                 logger.warning("Exception raised when closing device %r:",
                                dev, exc_info=True)
         self.active_devices.clear()
+        self._active_index.clear()
 
 
 class DatasetManager:
-    def __init__(self, ddb):
+    """Handles the datasets of an experiment.
+
+    Modifications of broadcast datasets are sent to the dataset DB with
+    ``ddb.update`` as they happen, unless ``batch_size`` is set. In that
+    case, they are buffered and sent with ``ddb.update_batch`` once
+    ``batch_size`` of them are pending, when the oldest has been pending for
+    ``batch_period`` seconds, or when :meth:`flush` is called. The batches
+    that are due after ``batch_period`` are sent from a flusher thread,
+    started with the first batch, so ``ddb.update_batch`` must be
+    thread-safe.
+
+    Array datasets are written to HDF5 with the dataset creation options
+    (e.g. ``chunks``, ``compression``, ``shuffle``) of ``hdf5_options``,
+    updated with those of their ``hdf5_options`` metadata.
+    """
+    def __init__(self, ddb, batch_size=None, batch_period=0.1):
         self._broadcaster = Notifier(dict())
         self.local = dict()
         self.archive = dict()
         self.metadata = dict()
+        self.hdf5_options = dict()
+
+        # results file the archived datasets are streamed to
+        # (see start_streaming)
+        self._stream_file = None
+        self._stream_interval = None
+        self._stream_time = None
+        # key -> whether the dataset was only appended to since it was last
+        # streamed
+        self._dirty = dict()
 
         self.ddb = ddb
-        self._broadcaster.publish = ddb.update
+        self.batch_size = batch_size
+        self.batch_period = batch_period
+        self._pending_mods = []
+        self._batch_start = None
+        self._batch_cond = threading.Condition()
+        self._flusher = None
+        if batch_size:
+            self._broadcaster.publish = self._buffer_mod
+        else:
+            self._broadcaster.publish = ddb.update
+
+    def _buffer_mod(self, mod):
+        # Modifications reference the dataset objects, which may be
+        # modified again before the batch is sent.
+        mod = copy.deepcopy(mod)
+        with self._batch_cond:
+            self._pending_mods.append(mod)
+            now = time.monotonic()
+            if len(self._pending_mods) == 1:
+                self._batch_start = now
+                # send the batch even if no other modification follows,
+                # e.g. during a long kernel
+                if self._flusher is None:
+                    self._flusher = threading.Thread(
+                        target=self._flusher_loop, daemon=True)
+                    self._flusher.start()
+                self._batch_cond.notify()
+            due = (len(self._pending_mods) >= self.batch_size
+                   or now - self._batch_start >= self.batch_period)
+        if due:
+            self.flush()
+
+    def _flusher_loop(self):
+        with self._batch_cond:
+            while True:
+                if not self._pending_mods:
+                    self._batch_cond.wait()
+                    continue
+                remaining = (self._batch_start + self.batch_period
+                             - time.monotonic())
+                if remaining > 0:
+                    self._batch_cond.wait(remaining)
+                else:
+                    self._send_batch()
+
+    def _send_batch(self):
+        # called with the lock held, so that batches are sent in order
+        if self._pending_mods:
+            mods, self._pending_mods = self._pending_mods, []
+            self.ddb.update_batch(mods)
+
+    def flush(self):
+        """Sends the buffered modifications of broadcast datasets."""
+        with self._batch_cond:
+            self._send_batch()
 
     def set(self, key, value, metadata, broadcast, persist, archive):
         if persist:
             broadcast = True
 
+        if broadcast and isinstance(value, AppendBuffer):
+            raise TypeError("Dataset '{}': AppendBuffer datasets cannot be "
+                            "broadcast".format(key))
+
         if not (broadcast or archive):
             logger.warning(f"Dataset '{key}' will not be stored. Both 'broadcast' and 'archive' are set to False.")
 
@@ -144,6 +253,7 @@ class DatasetManager:
             del self.local[key]
         
         self.metadata[key] = metadata
+        self._mark_dirty(key)
 
     def _get_mutation_target(self, key):
         target = self.local.get(key, None)
@@ -163,9 +273,11 @@ class DatasetManager:
             else:
                 index = slice(*index)
         setitem(target, index, value)
+        self._mark_dirty(key)
 
     def append_to(self, key, value):
         self._get_mutation_target(key).append(value)
+        self._mark_dirty(key, append=True)
 
     def get(self, key, archive=False):
         if key in self.local:
@@ -184,25 +296,150 @@ class DatasetManager:
             return self.metadata[key]
         return self.ddb.get_metadata(key)
 
+    def start_streaming(self, f, interval):
+        """Writes the archived datasets to the ``datasets`` group of the
+        HDF5 file ``f`` now, and then those that were modified, at most
+        every ``interval`` seconds, until :meth:`write_hdf5` is called with
+        the same file."""
+        self._stream_file = f
+        self._stream_interval = interval
+        f.create_group("datasets")
+        self._dirty = dict.fromkeys(self.local.keys(), False)
+        self.stream()
+
+    def _mark_dirty(self, key, append=False):
+        if self._stream_file is None:
+            return
+        self._dirty[key] = append and self._dirty.get(key, True)
+        if time.monotonic() - self._stream_time >= self._stream_interval:
+            self.stream()
+
+    def stream(self):
+        """Writes the archived datasets modified since the last call to the
+        results file.
+
+        Datasets are overwritten in place when their shape and type are
+        unchanged, and lists are stored in extendable datasets, to which
+        the appended values are added. Other datasets are deleted and
+        written again, which leaves unused space in the file."""
+        group = self._stream_file["datasets"]
+        for k, appended in self._dirty.items():
+            v = self.local.get(k)
+            if k in group:
+                if v is not None and self._update_in_place(
+                        group[k], k, v, appended):
+                    continue
+                del group[k]
+            if isinstance(v, AppendBuffer) and v.dtype is not None:
+                self._create_spill_dataset(group, k, v)
+            elif isinstance(v, list):
+                self._create_extendable_dataset(group, k, v)
+            elif v is not None:
+                self._write(group, k, v)
+        self._dirty = dict()
+        self._stream_file.flush()
+        self._stream_time = time.monotonic()
+
+    def _write_attrs(self, dataset, k):
+        for key, val in self.metadata.get(k, {}).items():
+            if key != "hdf5_options":
+                dataset.attrs[key] = val
+
+    def _update_in_place(self, dataset, k, v, appended):
+        if isinstance(v, AppendBuffer):
+            if v.spill_dataset != dataset:
+                return False
+            v.spill(dataset)
+            return True
+        if isinstance(v, list) and appended and dataset.maxshape[0] is None:
+            length = dataset.shape[0]
+            try:
+                tail = np.asarray(v[length:])
+            except ValueError:
+                return False
+            if (tail.shape[1:] != dataset.shape[1:]
+                    or not np.can_cast(tail.dtype, dataset.dtype,
+                                       "same_kind")):
+                return False
+            dataset.resize(len(v), axis=0)
+            dataset[length:] = tail
+            return True
+        try:
+            value = np.asarray(v)
+        except ValueError:
+            return False
+        if (value.dtype.kind in "OU" or value.shape != dataset.shape
+                or value.dtype != dataset.dtype):
+            return False
+        if value.ndim:
+            dataset[...] = value
+        else:
+            dataset[()] = value
+        self._write_attrs(dataset, k)
+        return True
+
+    def _create_extendable_dataset(self, group, k, v):
+        try:
+            value = np.asarray(v)
+        except ValueError:
+            value = None
+        if value is None or value.dtype.kind in "OU":
+            # not representable as an array, let _write report errors
+            self._write(group, k, v)
+            return
+        options = self._get_hdf5_options(k)
+        if options.get("chunks") is None:
+            options["chunks"] = True
+        dataset = group.create_dataset(
+            k, data=value, maxshape=(None, ) + value.shape[1:], **options)
+        self._write_attrs(dataset, k)
+
+    def _get_hdf5_options(self, k):
+        options = dict(self.hdf5_options)
+        options.update(self.metadata.get(k, {}).get("hdf5_options", {}))
+        return options
+
+    def _write(self, group, k, v):
+        _write(group, k, v, self.metadata.get(k, {}),
+               self._get_hdf5_options(k))
+
+    def _create_spill_dataset(self, group, k, v):
+        options = self._get_hdf5_options(k)
+        if options.get("chunks") is None:
+            options["chunks"] = True
+        item_shape = v[:0].shape[1:]
+        dataset = group.create_dataset(
+            k, shape=(0, ) + item_shape, maxshape=(None, ) + item_shape,
+            dtype=v.dtype, **options)
+        self._write_attrs(dataset, k)
+        v.spill(dataset)
+
     def write_hdf5(self, f):
-        datasets_group = f.create_group("datasets")
-        for k, v in self.local.items():
-            m = self.metadata.get(k, {})
-            _write(datasets_group, k, v, m)
+        if f is self._stream_file:
+            self.stream()
+            self._stream_file = None
+        else:
+            datasets_group = f.create_group("datasets")
+            for k, v in self.local.items():
+                self._write(datasets_group, k, v)
 
         archive_group = f.create_group("archive")
         for k, v in self.archive.items():
-            m = self.metadata.get(k, {})
-            _write(archive_group, k, v, m)
+            self._write(archive_group, k, v)
 
 
-def _write(group, k, v, m):
+def _write(group, k, v, m, options=None):
     # Add context to exception message when the user writes a dataset that is
     # not representable in HDF5.
     try:
-        group[k] = v
+        if options and np.ndim(v) > 0:
+            # scalar datasets do not support chunking and filters
+            group.create_dataset(k, data=v, **options)
+        else:
+            group[k] = v
         for key, val in m.items():
-            group[k].attrs[key] = val
+            if key != "hdf5_options":
+                group[k].attrs[key] = val
     except TypeError as e:
         raise TypeError("Error writing dataset '{}' of type '{}': {}".format(
             k, type(v), e))
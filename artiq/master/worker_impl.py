@@ -12,6 +12,8 @@ import os
 import inspect
 import logging
 import traceback
+import threading
+import queue
 from collections import OrderedDict
 import importlib.util
 import linecache
@@ -24,6 +26,7 @@ from sipyco.logging_tools import multiline_log_config
 
 import artiq
 from artiq import tools
+from artiq.master import worker_ipc
 from artiq.master.worker_db import DeviceManager, DatasetManager, DummyDevice
 from artiq.language.environment import (
     is_public_experiment, TraceArgumentManager, ProcessArgumentManager
@@ -36,21 +39,42 @@ from artiq import __version__ as artiq_version
 
 
 ipc = None
+dataset_mgr = None
 
 
 def get_object():
-    line = ipc.readline().decode()
-    return pyon.decode(line)
+    obj = worker_ipc.read_sync(ipc)
+    if obj is None:
+        raise EOFError("Connection to the master closed")
+    return obj
+
+
+# held while writing a message, since the dataset manager sends batches of
+# modifications from a timer thread
+_put_lock = threading.Lock()
 
 
 def put_object(obj):
-    ds = pyon.encode(obj)
-    ipc.write((ds + "\n").encode())
+    with _put_lock:
+        worker_ipc.write(ipc, obj)
 
 
-def make_parent_action(action):
+def make_parent_action(action, asynchronous=False):
+    """Creates a function making a request to the master.
+
+    Asynchronous requests return ``None`` without waiting for the master.
+    If one fails, the error is logged by the master and raised by the next
+    synchronous request instead of performing it."""
     def parent_action(*args, **kwargs):
+        if action != "update_dataset_batch" and dataset_mgr is not None:
+            # the master must see the dataset modifications made before
+            # any other request
+            dataset_mgr.flush()
         request = {"action": action, "args": args, "kwargs": kwargs}
+        if asynchronous:
+            request["async"] = True
+            put_object(request)
+            return
         put_object(request)
         reply = get_object()
         if "action" in reply:
@@ -66,13 +90,52 @@ def make_parent_action(action):
 
 
 class ParentDeviceDB:
-    get_device_db = make_parent_action("get_device_db")
-    get = make_parent_action("get_device")
+    """Device database of the master, read from a local snapshot.
+
+    After :meth:`invalidate`, the snapshot is updated on the next access if
+    the master has a new version. Devices are requested from the master
+    individually if it does not provide snapshots."""
+    _get_device_db = staticmethod(make_parent_action("get_device_db"))
+    _get = staticmethod(make_parent_action("get_device"))
+    _get_snapshot = staticmethod(make_parent_action("get_device_db_snapshot"))
+
+    def __init__(self):
+        self.version = None
+        self.data = None
+        self._stale = True
+
+    def invalidate(self):
+        self._stale = True
+
+    def _refresh(self):
+        if self._stale:
+            version, data = self._get_snapshot(self.version)
+            if data is not None or version is None:
+                self.version, self.data = version, data
+            self._stale = False
+
+    def get_device_db(self):
+        self._refresh()
+        if self.data is None:
+            return self._get_device_db()
+        return self.data
+
+    def get(self, key, resolve_alias=False):
+        self._refresh()
+        if self.data is None:
+            return self._get(key, resolve_alias)
+        desc = self.data[key]
+        if resolve_alias:
+            while isinstance(desc, str):
+                desc = self.data[desc]
+        return desc
 
 
 class ParentDatasetDB:
     get = make_parent_action("get_dataset")
-    update = make_parent_action("update_dataset")
+    update = make_parent_action("update_dataset", asynchronous=True)
+    update_batch = make_parent_action("update_dataset_batch",
+                                      asynchronous=True)
     get_metadata = make_parent_action("get_dataset_metadata")
 
 
@@ -128,18 +191,83 @@ class Scheduler:
             priority = self.priority
         return self._submit(pipeline_name, expid, priority, due_date, flush)
 
-    delete = staticmethod(make_parent_action("scheduler_delete"))
+    _submit_many = staticmethod(make_parent_action("scheduler_submit_many"))
+    def submit_many(self, specs):
+        specs = [{"pipeline_name": self.pipeline_name,
+                  "expid": self.expid,
+                  "priority": self.priority} | spec
+                 for spec in specs]
+        return self._submit_many(specs)
+
+    delete = staticmethod(make_parent_action("scheduler_delete",
+                                             asynchronous=True))
     request_termination = staticmethod(
         make_parent_action("scheduler_request_termination"))
     get_status = staticmethod(make_parent_action("scheduler_get_status"))
 
 
 class CCB:
-    issue = staticmethod(make_parent_action("ccb_issue"))
+    issue = staticmethod(make_parent_action("ccb_issue", asynchronous=True))
+
+
+# file -> (modification time, module), kept when the process is reused
+_experiment_modules = dict()
+# names of the modules imported before the first experiment
+_base_modules = None
+# name -> modification time of the file of the modules imported since,
+# e.g. the helper modules of the experiments
+_module_mtimes = dict()
+
+
+def _get_module_mtime(module):
+    filename = getattr(module, "__file__", None)
+    if filename is None:
+        return None
+    try:
+        return os.stat(filename).st_mtime_ns
+    except OSError:
+        return None
+
+
+def record_experiment_modules():
+    """Records the modification times of the modules imported since the
+    first experiment."""
+    if _base_modules is None:
+        return
+    for name, module in list(sys.modules.items()):
+        if name not in _base_modules and name not in _module_mtimes:
+            _module_mtimes[name] = _get_module_mtime(module)
+
+
+def _check_experiment_modules():
+    # When the process is reused, the modules imported by previous
+    # experiments are removed if any of them changed, so that they are
+    # imported again, as by examine().
+    for name, mtime in _module_mtimes.items():
+        if _get_module_mtime(sys.modules.get(name)) != mtime:
+            break
+    else:
+        return
+    for name in _module_mtimes:
+        sys.modules.pop(name, None)
+    _module_mtimes.clear()
+    _experiment_modules.clear()
 
 
 def get_experiment_from_file(file, class_name):
-    module = tools.file_import(file, prefix="artiq_worker_")
+    global _base_modules
+    if _base_modules is None:
+        _base_modules = set(sys.modules.keys())
+    else:
+        _check_experiment_modules()
+    mtime = os.stat(file).st_mtime_ns
+    cached = _experiment_modules.get(file)
+    if cached is not None and cached[0] == mtime:
+        module = cached[1]
+    else:
+        module = tools.file_import(file, prefix="artiq_worker_")
+        _experiment_modules[file] = mtime, module
+        record_experiment_modules()
     return tools.get_experiment(module, class_name)
 
 
@@ -172,6 +300,7 @@ def get_experiment_from_content(content, class_name):
 
 
 register_experiment = make_parent_action("register_experiment")
+register_dependencies = make_parent_action("register_dependencies")
 
 
 class ExamineDeviceMgr:
@@ -214,6 +343,11 @@ def examine(device_mgr, dataset_mgr, file):
             if hasattr(exp_class, "argument_ui"):
                 argument_ui = exp_class.argument_ui
             register_experiment(class_name, name, arginfo, argument_ui, scheduler_defaults)
+        # files of the modules imported by the experiment file
+        register_dependencies([
+            sys.modules[key].__file__
+            for key in set(sys.modules.keys()) - previous_keys
+            if getattr(sys.modules[key], "__file__", None) is not None])
     finally:
         new_keys = set(sys.modules.keys())
         for key in new_keys - previous_keys:
@@ -259,12 +393,20 @@ def setup_diagnostics(experiment_file, repository_path):
         render_diagnostic
 
 
-def put_completed():
-    put_object({"action": "completed"})
+def put_completed(timings=None):
+    dataset_mgr.flush()
+    obj = {"action": "completed"}
+    if timings is not None:
+        obj["timings"] = timings
+    put_object(obj)
 
 
 def put_exception_report():
     _, exc, _ = sys.exc_info()
+    try:
+        dataset_mgr.flush()
+    except Exception:
+        logging.error("Failed to send dataset modifications", exc_info=True)
     # When we get CompileError, a more suitable diagnostic has already
     # been printed.
     if not isinstance(exc, CompileError):
@@ -283,8 +425,45 @@ def put_exception_report():
     put_object({"action": "exception"})
 
 
+class ResultsWriter:
+    """Runs the functions that write results files in a thread, in order,
+    so that the completion of an action can be reported without waiting
+    for the disk.
+
+    At most ``maxsize`` functions may be pending; :meth:`submit` blocks
+    beyond that."""
+    def __init__(self, maxsize=2):
+        self._queue = queue.Queue(maxsize)
+        self._exception = None
+        self._thread = threading.Thread(target=self._process,
+                                        name="results_writer", daemon=True)
+        self._thread.start()
+
+    def _process(self):
+        while True:
+            write = self._queue.get()
+            try:
+                write()
+            except Exception as exc:
+                if self._exception is None:
+                    self._exception = exc
+            finally:
+                self._queue.task_done()
+
+    def submit(self, write):
+        self._queue.put(write)
+
+    def join(self):
+        """Waits until the submitted functions have run, and raises the
+        exception of the first one that failed since the last call."""
+        self._queue.join()
+        exc, self._exception = self._exception, None
+        if exc is not None:
+            raise exc
+
+
 def main():
-    global ipc
+    global ipc, dataset_mgr
 
     multiline_log_config(level=int(sys.argv[2]))
     ipc = pipe_ipc.ChildComm(sys.argv[1])
@@ -296,32 +475,97 @@ def main():
     exp = None
     exp_inst = None
     repository_path = None
+    # phase -> duration in seconds, for the current run
+    timings = dict()
+    # interval in seconds at which archived datasets are written during
+    # run(), or None to write them at the end
+    stream_interval = None
+    # results file while it is written during run()
+    results_file = None
+
+    def add_timing(phase, start):
+        timings[phase] = timings.get(phase, 0.0) + time.monotonic() - start
+        for device_phase, duration in device_mgr.get_timings().items():
+            timings[device_phase] = timings.get(device_phase, 0.0) + duration
+
+    def open_results(filename, header):
+        f = h5py.File(filename, "w")
+        for key, value in header.items():
+            f[key] = value
+        return f
+
+    def get_results_filename():
+        # absolute, since the directory is changed by the next build
+        return os.path.abspath("{:09}-{}.h5".format(rid, exp.__name__))
+
+    def get_results_header():
+        return {
+            "artiq_version": artiq_version,
+            "rid": rid,
+            "start_time": start_time,
+            "run_time": run_time,
+            "expid": pyon.encode(expid)
+        }
 
     def write_results():
-        filename = "{:09}-{}.h5".format(rid, exp.__name__)
-        with h5py.File(filename, "w") as f:
-            dataset_mgr.write_hdf5(f)
-            f["artiq_version"] = artiq_version
-            f["rid"] = rid
-            f["start_time"] = start_time
-            f["run_time"] = run_time
-            f["expid"] = pyon.encode(expid)
-
-    device_mgr = DeviceManager(ParentDeviceDB,
+        # The file is written by results_writer, which is joined before the
+        # next action is processed and may modify the state of the run.
+        nonlocal results_file
+        f, results_file = results_file, None
+        filename = get_results_filename()
+        header = get_results_header()
+        run_dataset_mgr = dataset_mgr
+        run_timings = dict(timings)
+
+        def write():
+            start = time.monotonic()
+            results = f
+            if results is None:
+                results = open_results(filename, header)
+            with results:
+                run_dataset_mgr.write_hdf5(results)
+                timings_group = results.create_group("timings")
+                for phase, duration in run_timings.items():
+                    timings_group[phase] = duration
+            logging.debug("results written in %.3f seconds",
+                          time.monotonic() - start)
+        results_writer.submit(write)
+
+    def join_results_writer():
+        try:
+            results_writer.join()
+        except Exception:
+            logging.error("Failed to write results", exc_info=True)
+
+    device_mgr = DeviceManager(ParentDeviceDB(),
                                virtual_devices={"scheduler": Scheduler(),
                                                 "ccb": CCB()})
-    dataset_mgr = DatasetManager(ParentDatasetDB)
+    dataset_mgr = DatasetManager(ParentDatasetDB, batch_size=1000)
+    results_writer = ResultsWriter()
+    initial_cwd = os.getcwd()
 
     import_cache.install_hook()
 
     try:
         while True:
             obj = get_object()
+            results_writer.join()
             action = obj["action"]
+            action_start = time.monotonic()
             if action == "build":
                 start_time = time.time()
+                device_mgr.ddb.invalidate()
                 rid = obj["rid"]
                 expid = obj["expid"]
+                if obj.get("dataset_batch") is not None:
+                    dataset_mgr = DatasetManager(ParentDatasetDB,
+                                                 **obj["dataset_batch"])
+                results_options = obj.get("results_options") or dict()
+                dataset_mgr.hdf5_options = results_options.get(
+                    "hdf5_options", dict())
+                stream_interval = results_options.get("stream_interval")
+                # the process may have been started in advance
+                logging.getLogger().setLevel(expid["log_level"])
                 if "devarg_override" in expid:
                     device_mgr.devarg_override = expid["devarg_override"]
                 if "file" in expid:
@@ -333,10 +577,13 @@ def main():
                         experiment_file = expid["file"]
                         repository_path = None
                     setup_diagnostics(experiment_file, repository_path)
+                    import_start = time.monotonic()
                     exp = get_experiment_from_file(experiment_file, expid["class_name"])
                 else:
                     setup_diagnostics("<none>", None)
+                    import_start = time.monotonic()
                     exp = get_experiment_from_content(expid["content"], expid["class_name"])
+                add_timing("import", import_start)
                 device_mgr.virtual_devices["scheduler"].set_run_info(
                     rid, obj["pipeline_name"], expid, obj["priority"])
                 start_local_time = time.localtime(start_time)
@@ -348,12 +595,18 @@ def main():
                 argument_mgr = ArgumentManager(expid["arguments"])
                 exp_inst = exp((device_mgr, dataset_mgr, argument_mgr, {}))
                 argument_mgr.check_unprocessed_arguments()
-                put_completed()
+                add_timing("build", action_start)
+                put_completed(timings)
             elif action == "prepare":
                 exp_inst.prepare()
-                put_completed()
+                add_timing("prepare", action_start)
+                put_completed(timings)
             elif action == "run":
                 run_time = time.time()
+                if stream_interval is not None:
+                    results_file = open_results(get_results_filename(),
+                                                get_results_header())
+                    dataset_mgr.start_streaming(results_file, stream_interval)
                 try:
                     exp_inst.run()
                 except:
@@ -369,25 +622,51 @@ def main():
                         # callbacks produce an exception
                         write_results()
                         raise
-                put_completed()
+                # includes the time paused
+                add_timing("run", action_start)
+                put_completed(timings)
             elif action == "analyze":
                 try:
                     exp_inst.analyze()
+                    add_timing("analyze", action_start)
                 finally:
                     # browser's analyze shouldn't write results,
                     # since it doesn't run the experiment and cannot have rid
                     if rid is not None:
                         write_results()
 
-                put_completed()
+                put_completed(timings)
             elif action == "examine":
                 examine(ExamineDeviceMgr, ExamineDatasetMgr, obj["file"])
                 put_completed()
+            elif action == "reset":
+                # Clear the state of the completed run so that the process
+                # can build another one, keeping the imported modules and
+                # the open devices.
+                os.chdir(initial_cwd)
+                # modules imported after build()
+                record_experiment_modules()
+                dataset_mgr = DatasetManager(ParentDatasetDB, batch_size=1000)
+                start_time = run_time = rid = expid = None
+                stream_interval = None
+                exp = exp_inst = None
+                timings.clear()
+                device_mgr.get_timings()
+                put_completed()
+            elif action == "wait_results":
+                # results_writer has been joined above
+                put_completed()
             elif action == "terminate":
                 break
     except:
+        # the master may end the process once the exception is reported,
+        # so the results of the failed run are written first
+        join_results_writer()
         put_exception_report()
     finally:
+        join_results_writer()
+        if results_file is not None:
+            results_file.close()
         device_mgr.close_devices()
         ipc.close()
 
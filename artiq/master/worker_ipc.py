@@ -0,0 +1,155 @@
+"""Framing of the messages exchanged between the master and the worker
+processes.
+
+Each message is sent as a frame containing the PYON encoding of the
+message, preceded by its length. Large NumPy arrays are not converted to
+text: their raw data is appended to the frame as out-of-band buffers, and
+each array is replaced in the PYON text by a dictionary giving the index
+of its buffer, its dtype and its shape. The frame layout is::
+
+    PYON length (u32), number of buffers (u32)
+    length of each buffer (u64)
+    PYON text
+    buffers
+
+All integers are little-endian.
+"""
+
+import struct
+
+import numpy
+from numpy.lib.format import dtype_to_descr, descr_to_dtype
+
+from sipyco import pyon
+
+
+__all__ = ["encode", "decode", "write", "read", "read_sync"]
+
+
+_header = struct.Struct("<II")
+_buffer_length = struct.Struct("<Q")
+
+_OOB_KEY = "__oob_ndarray__"
+# smaller arrays are encoded in PYON
+_MIN_OOB_SIZE = 1024
+
+
+def _extract_arrays(obj, buffers):
+    t = type(obj)
+    if t is numpy.ndarray:
+        if obj.dtype.hasobject or obj.nbytes < _MIN_OOB_SIZE:
+            return obj
+        array = numpy.ascontiguousarray(obj)
+        buffers.append(array.reshape(-1).view(numpy.uint8))
+        return {
+            _OOB_KEY: len(buffers) - 1,
+            "dtype": dtype_to_descr(array.dtype),
+            "shape": array.shape
+        }
+    elif t is dict:
+        return {k: _extract_arrays(v, buffers) for k, v in obj.items()}
+    elif t is list:
+        return [_extract_arrays(v, buffers) for v in obj]
+    elif t is tuple:
+        return tuple(_extract_arrays(v, buffers) for v in obj)
+    else:
+        return obj
+
+
+def _restore_arrays(obj, buffers):
+    t = type(obj)
+    if t is dict:
+        if _OOB_KEY in obj:
+            return numpy.frombuffer(
+                buffers[obj[_OOB_KEY]],
+                dtype=descr_to_dtype(obj["dtype"])).reshape(obj["shape"])
+        return {k: _restore_arrays(v, buffers) for k, v in obj.items()}
+    elif t is list:
+        return [_restore_arrays(v, buffers) for v in obj]
+    elif t is tuple:
+        return tuple(_restore_arrays(v, buffers) for v in obj)
+    else:
+        return obj
+
+
+def encode(obj):
+    """Returns the frame of ``obj`` as a list of bytes-like chunks."""
+    buffers = []
+    text = pyon.encode(_extract_arrays(obj, buffers)).encode()
+    header = [_header.pack(len(text), len(buffers))]
+    header += [_buffer_length.pack(buffer.nbytes) for buffer in buffers]
+    header.append(text)
+    return [b"".join(header)] + buffers
+
+
+def decode(text, buffers):
+    """Returns the message of a frame with the given PYON text and
+    buffers."""
+    obj = pyon.decode(text.decode())
+    if buffers:
+        obj = _restore_arrays(obj, buffers)
+    return obj
+
+
+def write(ipc, obj):
+    """Writes the frame of ``obj``. When ``ipc`` is an asyncio connection,
+    the caller must then drain it."""
+    for chunk in encode(obj):
+        chunk = memoryview(chunk).cast("B")
+        while chunk:
+            written = ipc.write(chunk)
+            # asyncio connections buffer all the data
+            if written is None:
+                break
+            chunk = chunk[written:]
+
+
+async def _read_exactly(ipc, n):
+    data = bytearray()
+    while len(data) < n:
+        chunk = await ipc.read(n - len(data))
+        if not chunk:
+            raise EOFError("Connection closed in the middle of a frame")
+        data += chunk
+    return data
+
+
+def _read_exactly_sync(ipc, n):
+    data = bytearray()
+    while len(data) < n:
+        chunk = ipc.read(n - len(data))
+        if not chunk:
+            raise EOFError("Connection closed in the middle of a frame")
+        data += chunk
+    return data
+
+
+async def read(ipc):
+    """Reads a message from an asyncio connection. Returns ``None`` if the
+    connection was closed before the frame started."""
+    try:
+        header = await _read_exactly(ipc, _header.size)
+    except EOFError:
+        return None
+    text_length, buffer_count = _header.unpack(header)
+    lengths = await _read_exactly(ipc, buffer_count*_buffer_length.size)
+    text = await _read_exactly(ipc, text_length)
+    buffers = []
+    for (length, ) in _buffer_length.iter_unpack(lengths):
+        buffers.append(await _read_exactly(ipc, length))
+    return decode(text, buffers)
+
+
+def read_sync(ipc):
+    """Reads a message from a blocking connection. Returns ``None`` if the
+    connection was closed before the frame started."""
+    try:
+        header = _read_exactly_sync(ipc, _header.size)
+    except EOFError:
+        return None
+    text_length, buffer_count = _header.unpack(header)
+    lengths = _read_exactly_sync(ipc, buffer_count*_buffer_length.size)
+    text = _read_exactly_sync(ipc, text_length)
+    buffers = [_read_exactly_sync(ipc, length)
+               for (length, ) in _buffer_length.iter_unpack(lengths)]
+    return decode(text, buffers)
@@ -0,0 +1,47 @@
+import os
+import tempfile
+import unittest
+
+from artiq.compiler.kernel_cache import KernelCache
+from artiq.compiler.targets import RV32GTarget, CortexA9Target
+
+
+class KernelCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = KernelCache(self.tmpdir.name, max_size=1300)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_key(self):
+        key = self.cache.key(RV32GTarget(), "ir")
+        self.assertEqual(key, self.cache.key(RV32GTarget(), "ir"))
+        self.assertNotEqual(key, self.cache.key(RV32GTarget(), "ir2"))
+        self.assertNotEqual(key, self.cache.key(CortexA9Target(), "ir"))
+        self.assertNotEqual(
+            key, self.cache.key(RV32GTarget(subkernel_id=1), "ir"))
+
+    def test_get_put(self):
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.put("a", [b"library", b""])
+        self.assertEqual(self.cache.get("a"), [b"library", b""])
+
+    def test_corrupted(self):
+        self.cache.put("a", [b"library"])
+        path = os.path.join(self.tmpdir.name, "a.bin")
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) - 1)
+        self.assertIsNone(self.cache.get("a"))
+        self.assertFalse(os.path.exists(path))
+
+    def test_evict(self):
+        for i, key in enumerate("abc"):
+            self.cache.put(key, [bytes(400)])
+            os.utime(os.path.join(self.tmpdir.name, key + ".bin"), (i, i))
+        # b is now the least recently used
+        os.utime(os.path.join(self.tmpdir.name, "a.bin"), (3, 3))
+        self.cache.put("d", [bytes(100)])
+        self.assertIsNone(self.cache.get("b"))
+        for key in "acd":
+            self.assertIsNotNone(self.cache.get(key))
@@ -0,0 +1,152 @@
+import unittest
+import asyncio
+import os
+import socket
+import struct
+import tempfile
+
+from artiq.coredevice.comm_kernel import CommKernelMux
+from artiq.frontend.aqctl_corecomm_proxy import CoreCommProxy
+
+
+_frame_length = struct.Struct("<I")
+
+
+def _frame(data):
+    return _frame_length.pack(len(data)) + data
+
+
+class CoreCommProxyCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "corecomm.sock")
+
+        # the core device is the other end of a socket pair
+        self.cores = []
+        self.core_streams = dict()
+        self.proxy = CoreCommProxy("core")
+        self.proxy._open_core = self._open_core
+        self.sessions = set()
+        self.server = self.loop.run_until_complete(asyncio.start_unix_server(
+            self._handle_connection, self.path))
+
+    def tearDown(self):
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        if self.sessions:
+            # released sessions end once the client disconnects
+            self.loop.run_until_complete(asyncio.wait(
+                list(self.sessions), timeout=1.0))
+        for session in self.sessions:
+            session.cancel()
+        self.loop.run_until_complete(asyncio.gather(
+            *self.sessions, return_exceptions=True))
+        self.loop.run_until_complete(self.proxy.reset_core())
+        for _, writer in self.core_streams.values():
+            writer.close()
+        for core in self.cores:
+            core.close()
+        self.loop.close()
+        self.tmpdir.cleanup()
+
+    async def _handle_connection(self, reader, writer):
+        session = asyncio.current_task()
+        self.sessions.add(session)
+        try:
+            await self.proxy.handle_connection(reader, writer)
+        finally:
+            self.sessions.discard(session)
+
+    def _open_core(self):
+        sock, core = socket.socketpair()
+        self.cores.append(core)
+        return sock, b"e"
+
+    async def _core_streams(self, i=0):
+        if i not in self.core_streams:
+            self.core_streams[i] = await asyncio.open_connection(
+                sock=self.cores[i])
+        return self.core_streams[i]
+
+    async def _connect(self):
+        reader, writer = await asyncio.open_unix_connection(self.path)
+        self.assertEqual(await reader.readexactly(2), b"e\x01")
+        return reader, writer
+
+    async def _release(self, reader, writer):
+        writer.write(_frame_length.pack(0))
+        await writer.drain()
+        # the proxy closes the connection once the session is released
+        self.assertEqual(await reader.read(), b"")
+        writer.close()
+
+    def test_framing(self):
+        async def test():
+            reader, writer = await self._connect()
+            writer.write(_frame(b"abc") + _frame(b"de"))
+            core_reader, core_writer = await self._core_streams()
+            self.assertEqual(await core_reader.readexactly(5), b"abcde")
+            core_writer.write(b"xyz")
+            self.assertEqual(await reader.readexactly(3), b"xyz")
+            await self._release(reader, writer)
+            # the core device connection is kept
+            self.assertIsNotNone(self.proxy._core)
+        self.loop.run_until_complete(test())
+
+    def test_sessions(self):
+        async def test():
+            reader1, writer1 = await self._connect()
+            connect2 = asyncio.ensure_future(self._connect())
+            await asyncio.sleep(0.2)
+            self.assertFalse(connect2.done())
+
+            writer1.write(_frame(b"1"))
+            core_reader, core_writer = await self._core_streams()
+            self.assertEqual(await core_reader.readexactly(1), b"1")
+            await self._release(reader1, writer1)
+
+            reader2, writer2 = await asyncio.wait_for(connect2, 1.0)
+            writer2.write(_frame(b"2"))
+            self.assertEqual(await core_reader.readexactly(1), b"2")
+            core_writer.write(b"3")
+            self.assertEqual(await reader2.readexactly(1), b"3")
+            await self._release(reader2, writer2)
+            self.assertEqual(len(self.cores), 1)
+        self.loop.run_until_complete(test())
+
+    def test_unreleased_session(self):
+        async def test():
+            reader, writer = await self._connect()
+            core_reader, _ = await self._core_streams()
+            writer.close()
+            # the core device connection is reset
+            self.assertEqual(await asyncio.wait_for(core_reader.read(), 1.0),
+                             b"")
+
+            reader, writer = await self._connect()
+            self.assertEqual(len(self.cores), 2)
+            await self._release(reader, writer)
+        self.loop.run_until_complete(test())
+
+    def test_comm_kernel_mux(self):
+        def client():
+            comm = CommKernelMux(self.path)
+            comm.check_system_info()
+            self.assertEqual(comm.endian, "<")
+            comm._write(b"abc")
+            comm._flush()
+            self.assertEqual(comm._read(2), b"de")
+            comm.release()
+
+        async def test():
+            done = self.loop.run_in_executor(None, client)
+            while not self.cores:
+                await asyncio.sleep(0.01)
+            core_reader, core_writer = await self._core_streams()
+            self.assertEqual(await core_reader.readexactly(3), b"abc")
+            core_writer.write(b"de")
+            await asyncio.wait_for(done, 1.0)
+            self.assertIsNotNone(self.proxy._core)
+        self.loop.run_until_complete(test())
@@ -0,0 +1,226 @@
+"""Tests for the master dataset database and its LMDB persistence."""
+
+import asyncio
+import os
+import tempfile
+import unittest
+
+import lmdb
+import numpy
+from sipyco import pyon
+from sipyco.sync_struct import process_mod
+
+from artiq.master.databases import DatasetDB
+
+
+KEY1 = "key1"
+KEY2 = "key2"
+DATA = list(range(10))
+
+
+class DatasetDBCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.persist_file = os.path.join(self.tmpdir.name, "dataset_db.mdb")
+        self.ddb = None
+
+    def tearDown(self):
+        if self.ddb is not None:
+            self.ddb.close_db()
+        self.tmpdir.cleanup()
+
+    def reload(self, **kwargs):
+        if self.ddb is not None:
+            self.ddb.save()
+            self.ddb.close_db()
+        self.ddb = DatasetDB(self.persist_file, **kwargs)
+        return self.ddb
+
+    def test_persist(self):
+        ddb = self.reload()
+        ddb.set(KEY1, DATA, persist=True)
+        ddb.set(KEY2, 1, persist=False)
+        ddb = self.reload()
+        self.assertEqual(ddb.get(KEY1), DATA)
+        with self.assertRaises(KeyError):
+            ddb.get(KEY2)
+
+    def test_journal_replay(self):
+        ddb = self.reload(journal=True)
+        ddb.set(KEY1, [], persist=True, metadata={"unit": "s"})
+        for i in range(5):
+            ddb.update({"action": "append", "path": [KEY1, 1], "x": i})
+        ddb.update({"action": "setitem", "path": [KEY1, 1], "key": 0,
+                    "value": 42})
+        ddb.set(KEY2, 1, persist=False)
+
+        ddb = self.reload(journal=True)
+        self.assertEqual(ddb.get(KEY1), [42, 1, 2, 3, 4])
+        self.assertEqual(ddb.get_metadata(KEY1), {"unit": "s"})
+        with self.assertRaises(KeyError):
+            ddb.get(KEY2)
+        self.assertEqual(ddb.journal_length(), 7)
+
+    def test_journal_overwrite(self):
+        ddb = self.reload(journal=True)
+        for i in range(10):
+            ddb.set(KEY1, numpy.full(1000, i), persist=True)
+        ddb.update({"action": "setitem", "path": [KEY1, 1], "key": 0,
+                    "value": 42})
+        ddb.set(KEY2, 0, persist=True)
+        ddb.delete(KEY2)
+
+        ddb = self.reload(journal=True)
+        # only the last whole value of each key is written
+        self.assertEqual(ddb.journal_length(), 3)
+        self.assertEqual(ddb.get(KEY1).tolist(), [42] + [9]*999)
+        with self.assertRaises(KeyError):
+            ddb.get(KEY2)
+
+    def test_journal_persist_change(self):
+        ddb = self.reload(journal=True)
+        ddb.set(KEY1, [0], persist=False)
+        ddb.update({"action": "append", "path": [KEY1, 1], "x": 1})
+        ddb.set(KEY1, ddb.get(KEY1), persist=True)
+        ddb.update({"action": "append", "path": [KEY1, 1], "x": 2})
+        ddb.set(KEY2, 3, persist=True)
+        ddb.set(KEY2, 3, persist=False)
+
+        ddb = self.reload(journal=True)
+        self.assertEqual(ddb.get(KEY1), [0, 1, 2])
+        with self.assertRaises(KeyError):
+            ddb.get(KEY2)
+
+    def test_journal_compact(self):
+        ddb = self.reload(journal=True)
+        ddb.set(KEY1, [], persist=True)
+        ddb.set(KEY2, 0, persist=True)
+        for i in range(3):
+            ddb.update({"action": "append", "path": [KEY1, 1], "x": i})
+        ddb.delete(KEY2)
+        ddb.save()
+        ddb._compact()
+        self.assertEqual(ddb.journal_length(), 0)
+
+        # compacted contents are also readable without journal mode
+        ddb = self.reload()
+        self.assertEqual(ddb.get(KEY1), [0, 1, 2])
+        with self.assertRaises(KeyError):
+            ddb.get(KEY2)
+
+    def test_journal_leftover(self):
+        ddb = self.reload(journal=True)
+        ddb.set(KEY1, [0], persist=True)
+        ddb.update({"action": "append", "path": [KEY1, 1], "x": 1})
+
+        # switching journal mode off folds the journal into the base values
+        ddb = self.reload()
+        self.assertEqual(ddb.get(KEY1), [0, 1])
+        self.assertEqual(ddb.journal_length(), 0)
+        ddb = self.reload()
+        self.assertEqual(ddb.get(KEY1), [0, 1])
+
+    def test_array_record(self):
+        arrays = [
+            numpy.arange(12, dtype=numpy.int32).reshape(3, 4),
+            numpy.linspace(0, 1, 5).reshape(5, 1).T,
+            numpy.array(1.5),
+            numpy.zeros((0, 2)),
+            numpy.zeros(3, dtype=[("a", "<i4"), ("b", "<f8")])
+        ]
+        ddb = self.reload()
+        for i, value in enumerate(arrays):
+            ddb.set(str(i), value, persist=True, metadata={"unit": "V"})
+        ddb = self.reload()
+        for i, value in enumerate(arrays):
+            loaded = ddb.get(str(i))
+            self.assertEqual(loaded.dtype, value.dtype)
+            self.assertEqual(loaded.shape, value.shape)
+            numpy.testing.assert_array_equal(loaded, value)
+            self.assertTrue(loaded.flags.writeable)
+            self.assertEqual(ddb.get_metadata(str(i)), {"unit": "V"})
+
+    def test_pyon_record(self):
+        # records written by previous versions are plain PYON text
+        env = lmdb.open(self.persist_file, subdir=False, map_size=2**20)
+        with env.begin(write=True) as txn:
+            txn.put(KEY1.encode(),
+                    pyon.encode((numpy.arange(3), {"unit": "s"})).encode())
+        env.close()
+        ddb = self.reload()
+        numpy.testing.assert_array_equal(ddb.get(KEY1), numpy.arange(3))
+        self.assertEqual(ddb.get_metadata(KEY1), {"unit": "s"})
+
+    def test_lazy(self):
+        ddb = self.reload()
+        for i in range(4):
+            ddb.set(str(i), numpy.full(3, i), persist=True,
+                    metadata={"index": i})
+        ddb.set(KEY1, [0], persist=True)
+
+        ddb = self.reload(lazy=True, lazy_cache_size=2)
+        self.assertEqual(ddb._data, dict())
+        self.assertEqual(ddb.get_metadata("0"), {"index": 0})
+        for i in range(4):
+            numpy.testing.assert_array_equal(ddb.get(str(i)),
+                                             numpy.full(3, i))
+        self.assertEqual(list(ddb._cache.keys()), ["2", "3"])
+        self.assertEqual(ddb._data, dict())
+
+        ddb.update({"action": "append", "path": [KEY1, 1], "x": 1})
+        ddb.set("0", 42)
+        ddb.delete("1")
+        self.assertEqual(set(ddb._data.keys()), {KEY1, "0"})
+
+        # subscribing loads everything
+        self.assertEqual(set(ddb.data.raw_view.keys()),
+                         {KEY1, "0", "2", "3"})
+        self.assertEqual(ddb._unloaded, dict())
+
+        ddb = self.reload()
+        self.assertEqual(ddb.get(KEY1), [0, 1])
+        self.assertEqual(ddb.get("0"), 42)
+        self.assertEqual(ddb.get_metadata("0"), {"index": 0})
+        with self.assertRaises(KeyError):
+            ddb.get("1")
+
+    def test_lazy_journal(self):
+        ddb = self.reload(journal=True)
+        ddb.set(KEY1, [0], persist=True)
+        ddb.set(KEY2, [0], persist=True)
+        ddb.save()
+        ddb._compact()
+        ddb.update({"action": "append", "path": [KEY1, 1], "x": 1})
+
+        ddb = self.reload(journal=True, lazy=True)
+        self.assertEqual(set(ddb._data.keys()), {KEY1})
+        self.assertEqual(ddb.get(KEY1), [0, 1])
+        self.assertEqual(ddb.get(KEY2), [0])
+
+    def test_coalesce_broadcasts(self):
+        ddb = self.reload()
+        ddb.set(KEY1, [0], persist=False)
+        ddb.set(KEY2, 0, persist=False)
+        ddb.set("unchanged", 0, persist=False)
+        published = []
+        ddb.data.publish = published.append
+        ddb.coalesce_broadcasts(0.01)
+        subscriber = pyon.decode(pyon.encode(ddb.data.raw_view))
+
+        async def modify():
+            for i in range(100):
+                ddb.update({"action": "append", "path": [KEY1, 1], "x": i})
+            ddb.set(KEY2, 1)
+            ddb.set(KEY2, 2)
+            ddb.set("temporary", 1)
+            ddb.delete("temporary")
+            ddb.set("new", 1)
+            await asyncio.sleep(0.1)
+        asyncio.run(modify())
+
+        self.assertEqual(len(published), 3)
+        for mod in published:
+            process_mod(subscriber, pyon.decode(pyon.encode(mod)))
+        self.assertEqual(subscriber, ddb.data.raw_view)
+        self.assertEqual(ddb.get_broadcast_stats(),
+                         {"received": 105, "published": 3, "merged": 102})
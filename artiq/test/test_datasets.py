@@ -1,17 +1,21 @@
 """Tests for the (Env)Experiment-facing dataset interface."""
 
 import copy
+import time
 import unittest
 
+import h5py
+import numpy as np
 from sipyco.sync_struct import process_mod
 
-from artiq.experiment import EnvExperiment
+from artiq.experiment import EnvExperiment, AppendBuffer
 from artiq.master.worker_db import DatasetManager
 
 
 class MockDatasetDB:
     def __init__(self):
         self.data = dict()
+        self.batches = 0
 
     def get(self, key):
         return self.data[key][1]
@@ -25,6 +29,11 @@ class MockDatasetDB:
         # applied twice.
         process_mod(self.data, copy.deepcopy(mod))
 
+    def update_batch(self, mods):
+        self.batches += 1
+        for mod in mods:
+            self.update(mod)
+
     def delete(self, key):
         del self.data[key]
 
@@ -132,3 +141,195 @@ class ExperimentDatasetCase(unittest.TestCase):
         self.assertEqual(self.dataset_db.get_metadata(KEY), {})
 
 
+class ExperimentDatasetBatchCase(unittest.TestCase):
+    def setUp(self):
+        self.dataset_db = MockDatasetDB()
+        self.dataset_mgr = DatasetManager(self.dataset_db, batch_size=10,
+                                          batch_period=3600)
+        self.exp = TestExperiment((None, self.dataset_mgr, None, None))
+
+    def test_batch(self):
+        self.exp.set(KEY, [], broadcast=True)
+        for i in range(5):
+            self.exp.append(KEY, i)
+        with self.assertRaises(KeyError):
+            self.dataset_db.get(KEY)
+        self.dataset_mgr.flush()
+        self.assertEqual(self.dataset_db.get(KEY), list(range(5)))
+        self.assertEqual(self.dataset_db.batches, 1)
+
+    def test_batch_size(self):
+        self.exp.set(KEY, [], broadcast=True)
+        for i in range(19):
+            self.exp.append(KEY, i)
+        self.assertEqual(self.dataset_db.batches, 2)
+        self.assertEqual(self.dataset_db.get(KEY), list(range(19)))
+
+    def test_batch_period(self):
+        self.dataset_mgr.batch_period = 0
+        self.exp.set(KEY, 0, broadcast=True)
+        self.assertEqual(self.dataset_db.get(KEY), 0)
+
+    def test_batch_timer(self):
+        self.dataset_mgr.batch_period = 0.05
+        self.exp.set(KEY, 0, broadcast=True)
+        with self.assertRaises(KeyError):
+            self.dataset_db.get(KEY)
+        # sent without any further modification
+        time.sleep(0.5)
+        self.assertEqual(self.dataset_db.get(KEY), 0)
+        self.assertEqual(self.dataset_db.batches, 1)
+        flusher = self.dataset_mgr._flusher
+        self.exp.set(KEY, 1, broadcast=True)
+        time.sleep(0.5)
+        self.assertEqual(self.dataset_db.get(KEY), 1)
+        self.assertEqual(self.dataset_db.batches, 2)
+        # the same thread sends every batch
+        self.assertIs(self.dataset_mgr._flusher, flusher)
+
+
+class DatasetHDF5Case(unittest.TestCase):
+    def setUp(self):
+        self.dataset_mgr = DatasetManager(MockDatasetDB())
+        self.exp = TestExperiment((None, self.dataset_mgr, None, None))
+
+    def test_hdf5_options(self):
+        self.dataset_mgr.hdf5_options = {"compression": "gzip"}
+        self.exp.set("a", np.arange(100), unit="s")
+        self.exp.set("b", np.arange(100), hdf5_options={"compression": None})
+        self.exp.set("c", 1.0)
+        with h5py.File("results.h5", "w", driver="core",
+                       backing_store=False) as f:
+            self.dataset_mgr.write_hdf5(f)
+            datasets = f["datasets"]
+            self.assertEqual(datasets["a"].compression, "gzip")
+            self.assertEqual(datasets["a"].attrs["unit"], "s")
+            self.assertIsNone(datasets["b"].compression)
+            self.assertNotIn("hdf5_options", datasets["b"].attrs)
+            self.assertEqual(datasets["c"][()], 1.0)
+
+    def test_hdf5_streaming(self):
+        with h5py.File("results.h5", "w", driver="core",
+                       backing_store=False) as f:
+            self.exp.set("a", [1])
+            self.dataset_mgr.start_streaming(f, 0)
+            self.assertEqual(list(f["datasets"]["a"]), [1])
+            self.exp.append("a", 2)
+            self.exp.set("b", 3, archive=False)
+            self.assertEqual(list(f["datasets"]["a"]), [1, 2])
+            self.assertNotIn("b", f["datasets"])
+            self.dataset_mgr.write_hdf5(f)
+            self.assertIn("archive", f)
+
+        with h5py.File("results.h5", "w", driver="core",
+                       backing_store=False) as f:
+            self.dataset_mgr.start_streaming(f, 3600)
+            self.exp.append("a", 3)
+            self.assertEqual(list(f["datasets"]["a"]), [1, 2])
+            self.dataset_mgr.write_hdf5(f)
+            self.assertEqual(list(f["datasets"]["a"]), [1, 2, 3])
+
+    def test_hdf5_streaming_in_place(self):
+        with h5py.File("results.h5", "w", driver="core",
+                       backing_store=False) as f:
+            self.exp.set("array", np.zeros(10000))
+            self.exp.set("list", [])
+            self.dataset_mgr.start_streaming(f, 0)
+            self.assertIsNone(f["datasets"]["list"].maxshape[0])
+            size = f.id.get_filesize()
+            for i in range(20):
+                self.exp.mutate_dataset("array", i, i)
+                self.exp.append("list", float(i))
+            # no space is left behind by rewritten datasets
+            self.assertLess(f.id.get_filesize(), size + 50000)
+            self.dataset_mgr.write_hdf5(f)
+            self.assertEqual(list(f["datasets"]["array"][:20]),
+                             list(range(20)))
+            self.assertEqual(list(f["datasets"]["list"]), list(range(20)))
+
+
+class AppendBufferCase(unittest.TestCase):
+    def setUp(self):
+        self.dataset_mgr = DatasetManager(MockDatasetDB())
+        self.exp = TestExperiment((None, self.dataset_mgr, None, None))
+
+    def test_append_buffer(self):
+        self.exp.set(KEY, AppendBuffer(dtype=np.int64))
+        for i in range(100):
+            self.exp.append(KEY, i)
+        self.exp.mutate_dataset(KEY, 3, 30)
+        self.exp.mutate_dataset(KEY, (4, 6), [40, 50])
+        expected = list(range(100))
+        expected[3:6] = [30, 40, 50]
+        value = self.exp.get(KEY)
+        self.assertEqual(len(value), 100)
+        self.assertEqual(value[5], 50)
+        self.assertEqual(value.tolist(), expected)
+        self.assertEqual(list(np.asarray(value)), expected)
+        with self.assertRaises(TypeError):
+            self.exp.set("b", AppendBuffer(), broadcast=True)
+
+    def test_append_buffer_streaming(self):
+        with h5py.File("results.h5", "w", driver="core",
+                       backing_store=False) as f:
+            self.exp.set(KEY, AppendBuffer([0.0]), unit="s")
+            self.dataset_mgr.start_streaming(f, 0)
+            for i in range(1, 50):
+                self.exp.append(KEY, float(i))
+            value = self.exp.get(KEY)
+            self.assertIsNotNone(value.spill_dataset)
+            # the values are moved to the file
+            self.assertEqual(len(value._in_memory()), 0)
+            self.exp.mutate_dataset(KEY, 0, -1.0)
+            self.dataset_mgr.write_hdf5(f)
+            dataset = f["datasets"][KEY]
+            self.assertEqual(dataset.attrs["unit"], "s")
+            self.assertEqual(list(dataset), [-1.0] + list(range(1, 50)))
+            self.assertEqual(value.tolist(), list(dataset))
+
+    def test_append_buffer_promotion(self):
+        value = AppendBuffer()
+        value.append(0)
+        value.append(0.5)
+        self.assertEqual(value.tolist(), [0, 0.5])
+        value.extend([1.5, 2])
+        self.assertEqual(value.tolist(), [0, 0.5, 1.5, 2])
+
+        with h5py.File("results.h5", "w", driver="core",
+                       backing_store=False) as f:
+            self.exp.set(KEY, AppendBuffer([0]))
+            self.dataset_mgr.start_streaming(f, 0)
+            with self.assertRaises(TypeError):
+                self.exp.append(KEY, 0.5)
+
+    def test_append_buffer_spilled_indexing(self):
+        with h5py.File("results.h5", "w", driver="core",
+                       backing_store=False) as f:
+            dataset = f.create_dataset("values", (0, ), np.int64,
+                                       maxshape=(None, ))
+            value = AppendBuffer(range(10), dtype=np.int64)
+            value.spill(dataset)
+            value.extend(range(10, 15))
+            expected = list(range(15))
+            for index in (0, 9, 10, 14, -1, -6, -15):
+                self.assertEqual(value[index], expected[index])
+            for index in (15, -16):
+                with self.assertRaises(IndexError):
+                    value[index]
+            for index in (slice(None), slice(3, 12), slice(12, 14),
+                          slice(2, 8), slice(1, None, 4),
+                          slice(None, None, -1), slice(13, 2, -3),
+                          slice(5, 5), slice(20, 30)):
+                self.assertEqual(value[index].tolist(), expected[index])
+            self.assertEqual(list(value), expected)
+
+            value[-1] = 140
+            value[0] = 100
+            value[8:12] = [80, 90, 100, 110]
+            value[13:0:-6] = [130, 70, 10]
+            expected[-1] = 140
+            expected[0] = 100
+            expected[8:12] = [80, 90, 100, 110]
+            expected[13:0:-6] = [130, 70, 10]
+            self.assertEqual(value.tolist(), expected)
+            self.assertEqual(list(dataset), expected[:10])
@@ -111,6 +111,16 @@ device_db["core_log"] = {
 
         self.assertEqual(self.ddb.get("core_log")["type"], "controller")
 
+    def test_snapshot(self):
+        version, data = self.ddb.get_snapshot()
+        self.assertEqual(data, self.ddb.get_device_db())
+        self.assertEqual(self.ddb.get_snapshot(version), (version, None))
+
+        self.ddb.scan()
+        new_version, data = self.ddb.get_snapshot(version)
+        self.assertNotEqual(new_version, version)
+        self.assertEqual(data, self.ddb.get_device_db())
+
     def test_get_ddb(self):
         ddb = self.ddb.get_device_db()
         raw = file_import(self.ddb_file.name).device_db
@@ -0,0 +1,149 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+try:
+    import pygit2
+except ImportError:
+    pygit2 = None
+
+from artiq.master.experiments import _RepoScanner, ExamineCache, GitBackend
+
+
+EXPERIMENT = """
+from artiq.experiment import *
+
+class {class_name}(EnvExperiment):
+    \"\"\"Same name\"\"\"
+    def build(self):
+        self.setattr_argument("n", NumberValue({n}))
+
+    def run(self):
+        pass
+"""
+
+
+class RepoScannerCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        root = self.tmpdir.name
+        os.mkdir(os.path.join(root, "sub"))
+        for i, filename in enumerate(["a.py", "b.py", "c.py",
+                                      os.path.join("sub", "d.py")]):
+            with open(os.path.join(root, filename), "w") as f:
+                f.write(EXPERIMENT.format(class_name="Exp" + str(i), n=i))
+        with open(os.path.join(root, "broken.py"), "w") as f:
+            f.write("syntax error")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def scan(self, worker_count, cache=None):
+        scanner = _RepoScanner(dict(), worker_count, cache)
+        return asyncio.run(scanner.scan(self.tmpdir.name))
+
+    def test_parallel_scan(self):
+        serial = self.scan(1)
+        self.assertEqual(len(serial), 4)
+        self.assertIn("Same name", serial)
+        self.assertIn("Same name1", serial)
+        self.assertIn("Same name2", serial)
+        self.assertIn("sub/Same name", serial)
+        self.assertEqual(self.scan(3), serial)
+
+    def test_examine_cache(self):
+        root = self.tmpdir.name
+        cache_file = os.path.join(root, "cache.pyon")
+        with open(os.path.join(root, "helper.py"), "w") as f:
+            f.write("N = 10\n")
+        with open(os.path.join(root, "e.py"), "w") as f:
+            f.write("import helper\n" + EXPERIMENT.format(
+                class_name="ExpHelper", n="helper.N"))
+
+        cache = ExamineCache(cache_file)
+        reference = self.scan(2, cache)
+        self.assertIn("e.py", [entry["file"] for entry in reference.values()])
+        entry, = [entry for entry in cache.entries.values()
+                  if "ExpHelper" in entry["description"]]
+        self.assertIn("helper.py", entry["dependencies"])
+        cache.save()
+        cached = set(cache.entries)
+
+        class CountingCache(ExamineCache):
+            def put(self, key, description, dependencies):
+                self.put_count += 1
+                ExamineCache.put(self, key, description, dependencies)
+
+        cache = CountingCache(cache_file)
+        cache.put_count = 0
+        self.assertEqual(self.scan(2, cache), reference)
+        self.assertEqual(cache.put_count, 0)
+        cache.save()
+        self.assertEqual(set(cache.entries), cached)
+
+        # a change to an imported module invalidates the experiment
+        with open(os.path.join(root, "helper.py"), "w") as f:
+            f.write("N = 20\n")
+        cache = CountingCache(cache_file)
+        cache.put_count = 0
+        explist = self.scan(2, cache)
+        self.assertEqual(cache.put_count, 2)  # helper.py and e.py
+        self.assertNotEqual(explist, reference)
+        self.assertEqual(explist, self.scan(1))
+
+
+@unittest.skipIf(pygit2 is None, "pygit2 is not installed")
+class GitBackendCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.repo = pygit2.init_repository(self.tmpdir.name)
+        self.revs = [self.commit({"a.py": "1", "b.py": "b"}, "one"),
+                     self.commit({"a.py": "2", "b.py": "b"}, "two")]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def commit(self, files, message):
+        builder = self.repo.TreeBuilder()
+        for name, content in files.items():
+            builder.insert(name, self.repo.create_blob(content),
+                           pygit2.GIT_FILEMODE_BLOB)
+        signature = pygit2.Signature("test", "test@example.com")
+        parents = [] if self.repo.head_is_unborn else [self.repo.head.target]
+        return str(self.repo.create_commit(
+            "HEAD", signature, signature, message, builder.write(),
+            parents))
+
+    def test_checkouts(self):
+        async def test():
+            backend = GitBackend(self.tmpdir.name)
+            backend.linger_time = 0.1
+            try:
+                wd1, message, rev1 = backend.request_rev(self.revs[0])
+                self.assertEqual(message, "one")
+                wd2, _, rev2 = backend.request_rev("HEAD")
+                self.assertEqual(rev2, self.revs[1])
+                await backend.wait_rev(rev1)
+                await backend.wait_rev(rev2)
+                for wd, content in (wd1, "1"), (wd2, "2"):
+                    with open(os.path.join(wd, "a.py")) as f:
+                        self.assertEqual(f.read(), content)
+                # unchanged files are shared
+                self.assertTrue(os.path.samefile(os.path.join(wd1, "b.py"),
+                                                 os.path.join(wd2, "b.py")))
+                self.assertEqual(backend.get_changed_files(rev1, rev2),
+                                 {"a.py"})
+
+                # released checkouts are kept for a while
+                backend.release_rev(rev1)
+                self.assertEqual(backend.request_rev(rev1)[0], wd1)
+                backend.release_rev(rev1)
+                await asyncio.sleep(0.3)
+                self.assertNotIn(rev1, backend.checkouts)
+                backend.release_rev(rev2)
+            finally:
+                backend.close()
+            self.assertFalse(os.path.exists(wd1))
+            self.assertFalse(os.path.exists(wd2))
+        asyncio.run(test())
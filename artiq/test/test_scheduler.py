@@ -1,11 +1,19 @@
 import unittest
+import unittest.mock
 import logging
 import asyncio
 import sys
+import os
+import tempfile
+from types import SimpleNamespace
 from time import time, sleep
 
+from sipyco.sync_struct import Notifier
+
 from artiq.experiment import *
-from artiq.master.scheduler import Scheduler
+from artiq.master.scheduler import (Scheduler, RunPool, RunStatus,
+                                    PrepareStage, RunStage, AnalyzeStage)
+from artiq.master.worker import WorkerRecycler
 
 
 class EmptyExperiment(EnvExperiment):
@@ -41,6 +49,39 @@ class CheckPauseBackgroundExperiment(EnvExperiment):
             self.scheduler.pause()
 
 
+class SlowAnalyzeExperiment(EnvExperiment):
+    def build(self):
+        pass
+
+    def run(self):
+        pass
+
+    def analyze(self):
+        sleep(1)
+
+
+class PidExperiment(EnvExperiment):
+    def build(self):
+        pass
+
+    def run(self):
+        self.set_dataset("pid", os.getpid(), broadcast=True, archive=False)
+
+
+HELPER_EXPERIMENT = """
+from artiq.experiment import *
+import recycle_helper
+
+class HelperExperiment(EnvExperiment):
+    def build(self):
+        pass
+
+    def run(self):
+        self.set_dataset("value", recycle_helper.VALUE,
+                         broadcast=True, archive=False)
+"""
+
+
 def _get_expid(name):
     return {
         "log_level": logging.WARNING,
@@ -82,6 +123,11 @@ class _RIDCounter:
         self._next_rid += 1
         return rid
 
+    def get_range(self, n):
+        rids = range(self._next_rid, self._next_rid + n)
+        self._next_rid += n
+        return rids
+
 
 class SchedulerCase(unittest.TestCase):
     def setUp(self):
@@ -174,15 +220,15 @@ class SchedulerCase(unittest.TestCase):
         loop = self.loop
 
         termination_ok = False
-        def check_termination(mod):
+        def check_termination(mods):
             nonlocal termination_ok
             self.assertEqual(
-                mod,
-                {"action": "setitem", "key": "termination_ok",
-                 "value": (False, True, {}), "path": []})
+                mods,
+                [{"action": "setitem", "key": "termination_ok",
+                  "value": (False, True, {}), "path": []}])
             termination_ok = True
         handlers = {
-            "update_dataset": check_termination
+            "update_dataset_batch": check_termination
         }
         scheduler = Scheduler(_RIDCounter(0), handlers, None, None)
 
@@ -315,5 +361,265 @@ class SchedulerCase(unittest.TestCase):
         loop.run_until_complete(done.wait())
         loop.run_until_complete(scheduler.stop())
 
+    def test_submit_many(self):
+        loop = self.loop
+        scheduler = Scheduler(_RIDCounter(0), dict(), None, None)
+        expid = _get_expid("EmptyExperiment")
+        scheduler.start(loop=loop)
+
+        mods = []
+        scheduler.notifier.publish = mods.append
+        rids = scheduler.submit_many([
+            {"pipeline_name": "main", "expid": expid, "priority": 1},
+            {"pipeline_name": "other", "expid": expid},
+            {"pipeline_name": "main", "expid": expid, "due_date": 1.0}
+        ])
+        self.assertEqual(rids, [0, 1, 2])
+        self.assertEqual(len(mods), 3)
+        self.assertEqual(set(scheduler.get_status().keys()), {0, 1, 2})
+        self.assertEqual(scheduler.get_status()[0]["priority"], 1)
+        self.assertEqual(scheduler.get_status()[1]["pipeline"], "other")
+        self.assertEqual(scheduler.get_status()[2]["due_date"], 1.0)
+
+        scheduler.notifier.publish = None
+        loop.run_until_complete(scheduler.stop())
+
+    def test_submit_many_failure(self):
+        class RepoBackend:
+            def __init__(self):
+                self.held = []
+
+            def request_rev(self, rev):
+                if rev == "bad":
+                    raise KeyError(rev)
+                self.held.append(rev)
+                return "/", "message", rev
+
+            def release_rev(self, rev):
+                self.held.remove(rev)
+
+        repo_backend = RepoBackend()
+        experiment_db = SimpleNamespace(cur_rev="head",
+                                        repo_backend=repo_backend)
+        scheduler = Scheduler(_RIDCounter(0), dict(), experiment_db, None)
+        expids = [dict(_get_expid("EmptyExperiment"), repo_rev=rev)
+                  for rev in (None, "bad")]
+        with self.assertRaises(KeyError):
+            scheduler.submit_many([
+                {"pipeline_name": "main", "expid": expids[0]},
+                {"pipeline_name": "other", "expid": expids[1]}
+            ])
+        # no run is submitted
+        self.assertEqual(scheduler.get_status(), dict())
+        self.assertEqual(repo_backend.held, [])
+
+    def test_prepare_depth(self):
+        pool = RunPool(_RIDCounter(0), {}, Notifier(dict()), None, None)
+        expid = _get_expid("EmptyExperiment")
+        for i in range(3):
+            pool.submit(expid, 0, None, False, "main")
+        prepare = PrepareStage(pool, None)
+
+        r = prepare._get_run()
+        self.assertEqual(r.rid, 0)
+        r.status = RunStatus.prepare_done
+        self.assertIsNone(prepare._get_run())
+
+        prepare.depth = 2
+        r = prepare._get_run()
+        self.assertEqual(r.rid, 1)
+        r.status = RunStatus.prepare_done
+        self.assertIsNone(prepare._get_run())
+        self.assertEqual(pool.worker_count(), 2)
+
+        # the prepared runs move on, making room for another one
+        pool.runs[0].status = RunStatus.running
+        prepare.max_workers = 2
+        self.assertIsNone(prepare._get_run())
+        prepare.max_workers = None
+        self.assertEqual(prepare._get_run().rid, 2)
+
+        # a run of higher priority is always prepared
+        prepare.depth = 1
+        rid = pool.submit(expid, 1, None, False, "main")
+        self.assertEqual(prepare._get_run().rid, rid)
+
+    def test_analyze_concurrency(self):
+        loop = self.loop
+        scheduler = Scheduler(_RIDCounter(0), dict(), None, None,
+                              analyze_concurrency=2)
+        expid = _get_expid("SlowAnalyzeExperiment")
+
+        analyzing = set()
+        both_analyzing = asyncio.Event()
+        done = asyncio.Event()
+        def notify(mod):
+            if mod["action"] == "setitem" and mod["key"] == "status":
+                rid = mod["path"][0]
+                if mod["value"] == "analyzing":
+                    analyzing.add(rid)
+                    if len(analyzing) == 2:
+                        both_analyzing.set()
+                else:
+                    analyzing.discard(rid)
+            if mod["action"] == "delitem" and mod["key"] == 1:
+                done.set()
+        scheduler.notifier.publish = notify
+
+        scheduler.start(loop=loop)
+        scheduler.submit("main", expid, 0, None, False)
+        scheduler.submit("main", expid, 0, None, False)
+        loop.run_until_complete(done.wait())
+        self.assertTrue(both_analyzing.is_set())
+        scheduler.notifier.publish = None
+        loop.run_until_complete(scheduler.stop())
+
+    def test_recycle_workers(self):
+        loop = self.loop
+        pids = []
+        def update_dataset_batch(mods):
+            pids.extend(mod["value"][1] for mod in mods)
+        recycler = WorkerRecycler()
+        scheduler = Scheduler(_RIDCounter(0),
+                              {"update_dataset_batch": update_dataset_batch},
+                              None, None, recycler=recycler)
+        expid = _get_expid("PidExperiment")
+
+        deleted = {0: asyncio.Event(), 1: asyncio.Event()}
+        def notify(mod):
+            if mod["action"] == "delitem" and mod["path"] == []:
+                deleted[mod["key"]].set()
+        scheduler.notifier.publish = notify
+
+        recycler.start(loop=loop)
+        scheduler.start(loop=loop)
+        scheduler.submit("main", expid, 0, None, False)
+        loop.run_until_complete(deleted[0].wait())
+        self.assertEqual(len(recycler._idle), 1)
+        scheduler.submit("main", expid, 0, None, False)
+        loop.run_until_complete(deleted[1].wait())
+        self.assertEqual(len(pids), 2)
+        self.assertEqual(pids[0], pids[1])
+
+        scheduler.notifier.publish = None
+        loop.run_until_complete(scheduler.stop())
+        loop.run_until_complete(recycler.stop())
+        self.assertEqual(recycler._idle, dict())
+
+    def test_recycle_workers_modified_helper(self):
+        loop = self.loop
+        values = []
+        def update_dataset_batch(mods):
+            values.extend(mod["value"][1] for mod in mods)
+        recycler = WorkerRecycler()
+        scheduler = Scheduler(_RIDCounter(0),
+                              {"update_dataset_batch": update_dataset_batch},
+                              None, None, recycler=recycler)
+
+        deleted = {0: asyncio.Event(), 1: asyncio.Event()}
+        def notify(mod):
+            if mod["action"] == "delitem" and mod["path"] == []:
+                deleted[mod["key"]].set()
+        scheduler.notifier.publish = notify
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            helper = os.path.join(tmpdir, "recycle_helper.py")
+            with open(helper, "w") as f:
+                f.write("VALUE = 1\n")
+            expid = _get_expid("HelperExperiment")
+            expid["file"] = os.path.join(tmpdir, "helper_experiment.py")
+            with open(expid["file"], "w") as f:
+                f.write(HELPER_EXPERIMENT)
+
+            recycler.start(loop=loop)
+            scheduler.start(loop=loop)
+            scheduler.submit("main", expid, 0, None, False)
+            loop.run_until_complete(deleted[0].wait())
+            self.assertEqual(len(recycler._idle), 1)
+
+            with open(helper, "w") as f:
+                f.write("VALUE = 2\n")
+            mtime = os.stat(helper).st_mtime + 10
+            os.utime(helper, (mtime, mtime))
+            scheduler.submit("main", expid, 0, None, False)
+            loop.run_until_complete(deleted[1].wait())
+            self.assertEqual(values, [1, 2])
+
+            scheduler.notifier.publish = None
+            loop.run_until_complete(scheduler.stop())
+            loop.run_until_complete(recycler.stop())
+
+    def test_stats(self):
+        loop = self.loop
+        scheduler = Scheduler(_RIDCounter(0), dict(), None, None)
+        expid = _get_expid("EmptyExperiment")
+
+        done = asyncio.Event()
+        def notify(mod):
+            if mod["action"] == "setitem" and mod["path"] == []:
+                done.set()
+        scheduler.stats_notifier.publish = notify
+
+        scheduler.start(loop=loop)
+        scheduler.submit("main", expid, 0, None, False)
+        loop.run_until_complete(done.wait())
+        stats = scheduler.stats_notifier.raw_view[0]
+        self.assertEqual(stats["pipeline"], "main")
+        self.assertEqual(list(stats["statuses"].keys()),
+                         ["pending", "preparing", "prepare_done", "running",
+                          "run_done", "analyzing", "deleting"])
+        for phase in "spawn", "import", "build", "prepare", "run", "analyze":
+            self.assertGreaterEqual(stats["phases"][phase], 0)
+        scheduler.stats_notifier.publish = None
+        loop.run_until_complete(scheduler.stop())
+
+    def test_status_durations(self):
+        pool = RunPool(_RIDCounter(0), {}, Notifier(dict()), None, None)
+        clock = 0.0
+        with unittest.mock.patch("artiq.master.scheduler.monotonic",
+                                 lambda: clock):
+            rid = pool.submit(_get_expid("EmptyExperiment"), 0, None, False,
+                              "main")
+            run = pool.runs[rid]
+            for clock, status in [(1.0, RunStatus.running),
+                                  (3.0, RunStatus.paused),
+                                  (10.0, RunStatus.running),
+                                  (14.0, RunStatus.paused)]:
+                run.status = status
+            clock = 15.0
+            statuses = run.get_stats()["statuses"]
+        # every period in each status is counted
+        self.assertEqual(list(statuses.items()),
+                         [("pending", 1.0), ("running", 6.0),
+                          ("paused", 8.0)])
+
+    def test_large_pool(self):
+        # Selecting the next run of each stage must not scan the pool.
+        class NoIterDict(dict):
+            def _iter(self, *args):
+                raise AssertionError("pool runs scanned")
+            __iter__ = keys = values = items = _iter
+
+        pool = RunPool(_RIDCounter(0), {}, Notifier(dict()), None, None)
+        expid = _get_expid("EmptyExperiment")
+        for i in range(1000):
+            pool.submit(expid, i % 10, None, False, "main")
+        pool.runs = NoIterDict(pool.runs)
+        prepare = PrepareStage(pool, None)
+        run = RunStage(pool, None)
+        analyze = AnalyzeStage(pool, None)
+
+        for i in range(100):
+            r = prepare._get_run()
+            self.assertEqual(r.priority, 9)
+            self.assertEqual(r.rid, 10*i + 9)
+            r.status = RunStatus.prepare_done
+            self.assertIs(run._get_run(), r)
+            r.status = RunStatus.run_done
+            self.assertIs(analyze._get_run(), r)
+            r.status = RunStatus.deleting
+            self.loop.run_until_complete(pool.delete(r.rid))
+        self.assertEqual(len(pool.runs), 900)
+
     def tearDown(self):
         self.loop.close()
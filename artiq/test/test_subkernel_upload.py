@@ -0,0 +1,106 @@
+import threading
+import time
+import unittest
+import unittest.mock
+
+from artiq.coredevice.core import Core
+
+
+class _EmbeddingMap:
+    def __init__(self, subkernels):
+        self._subkernels = dict(subkernels)
+
+    def subkernels(self):
+        return dict(self._subkernels)
+
+    def subkernel_messages_unpaired(self):
+        return []
+
+
+class _Comm:
+    def __init__(self):
+        self.uploads = []
+
+    def upload_subkernel(self, kernel_library, sid, destination):
+        self.uploads.append((sid, destination, kernel_library))
+
+
+class SubkernelUploadTest(unittest.TestCase):
+    def setUp(self):
+        self.core = Core(None, None, 1e-9)
+        self.core.comm = _Comm()
+        self.frontends = []
+        self.backends = []
+        # sid -> subkernels discovered when compiling its frontend
+        self.discovered = dict()
+        self.core._compile_subkernel_frontend = self._frontend
+        self.core._compile_backend = self._backend
+        self.backend_hook = lambda sid: None
+
+    def _frontend(self, sid, subkernel_fn, embedding_map, args,
+                  subkernel_arg_types):
+        self.frontends.append(sid)
+        embedding_map._subkernels.update(self.discovered.get(sid, {}))
+        return sid % 2, "target", sid, embedding_map
+
+    def _backend(self, target, llir):
+        self.backend_hook(llir)
+        self.backends.append(llir)
+        return b"object", "library" + str(llir)
+
+    def compile_and_upload(self, subkernels):
+        self.core.compile_and_upload_subkernels(
+            _EmbeddingMap(subkernels), [], {})
+
+    def test_no_subkernels(self):
+        with unittest.mock.patch(
+                "artiq.coredevice.core.ThreadPoolExecutor") as executor:
+            self.compile_and_upload({})
+        executor.assert_not_called()
+        self.assertEqual(self.core.comm.uploads, [])
+
+    def test_upload_order(self):
+        def backend_hook(sid):
+            if sid == 1:
+                # finishes after the others
+                time.sleep(0.2)
+        self.backend_hook = backend_hook
+        # subkernel 3 is found in the second round
+        self.discovered[2] = {3: None}
+        self.compile_and_upload({1: None, 2: None})
+        self.assertEqual(self.frontends, [1, 2, 3])
+        self.assertEqual(sorted(self.backends), [1, 2, 3])
+        self.assertEqual(self.core.comm.uploads,
+                         [(1, 1, "library1"), (2, 0, "library2"),
+                          (3, 1, "library3")])
+
+    def test_backend_exception(self):
+        all_submitted = threading.Event()
+        release = threading.Event()
+
+        def backend_hook(sid):
+            if sid == 1:
+                all_submitted.wait(1.0)
+                raise ValueError
+            if sid == 2:
+                # keeps the only thread busy until the pool is shut down
+                release.wait(1.0)
+
+        def frontend(sid, *args):
+            result = self._frontend(sid, *args)
+            if sid == 3:
+                all_submitted.set()
+            return result
+
+        self.backend_hook = backend_hook
+        self.core._compile_subkernel_frontend = frontend
+        self.discovered[2] = {3: None}
+        with unittest.mock.patch("artiq.coredevice.core.os.cpu_count",
+                                 return_value=1):
+            with self.assertRaises(ValueError):
+                self.compile_and_upload({1: None, 2: None})
+        release.set()
+        self.assertEqual(self.frontends, [1, 2, 3])
+        # the backend of subkernel 3 was cancelled before it started
+        self.assertNotIn(3, self.backends)
+        self.assertEqual(self.core.comm.uploads, [])
@@ -2,8 +2,14 @@ import unittest
 import logging
 import asyncio
 import sys
+import os
+import glob
+import tempfile
 from time import sleep
 
+import h5py
+import numpy as np
+
 from artiq.experiment import *
 from artiq.master.worker import *
 
@@ -16,6 +22,22 @@ class SimpleExperiment(EnvExperiment):
         pass
 
 
+class ResultsExperiment(EnvExperiment):
+    def build(self):
+        pass
+
+    def run(self):
+        self.set_dataset("data", np.arange(1000000))
+
+
+class LastAsyncRequestFailure(EnvExperiment):
+    def build(self):
+        self.setattr_device("ccb")
+
+    def run(self):
+        self.ccb.issue("service")
+
+
 class ExceptionTermination(EnvExperiment):
     def build(self):
         pass
@@ -52,6 +74,16 @@ class WatchdogTimeoutInBuild(EnvExperiment):
         pass
 
 
+class AsyncRequestFailure(EnvExperiment):
+    def build(self):
+        self.setattr_device("ccb")
+        self.setattr_device("scheduler")
+
+    def run(self):
+        self.ccb.issue("service")
+        self.scheduler.get_status()
+
+
 async def _call_worker(worker, expid):
     try:
         await worker.build(0, "main", None, expid, 0)
@@ -67,14 +99,14 @@ class WorkerCase(unittest.TestCase):
         self.loop = asyncio.new_event_loop()
         asyncio.set_event_loop(self.loop)
 
-    def _run_experiment(self, class_name):
+    def _run_experiment(self, class_name, handlers=dict()):
         expid = {
             "log_level": logging.WARNING,
             "file": sys.modules[__name__].__file__,
             "class_name": class_name,
             "arguments": dict()
         }
-        worker = Worker({})
+        worker = Worker(handlers)
         self.loop.run_until_complete(_call_worker(worker, expid))
 
     def test_simple_run(self):
@@ -88,6 +120,109 @@ class WorkerCase(unittest.TestCase):
             self.assertIn("Terminating with exception (TypeError)",
                           logs.output[-1])
 
+    def test_async_request_failure(self):
+        status_requested = False
+        def ccb_issue(service):
+            raise ValueError("bad service")
+        def get_status():
+            nonlocal status_requested
+            status_requested = True
+        handlers = {
+            "ccb_issue": ccb_issue,
+            "scheduler_get_status": get_status
+        }
+        with self.assertLogs() as logs:
+            with self.assertRaises(WorkerInternalException):
+                self._run_experiment("AsyncRequestFailure", handlers)
+            self.assertTrue(any("asynchronous request ccb_issue" in line
+                                for line in logs.output))
+            self.assertIn("(ValueError: bad service)", logs.output[-1])
+        self.assertFalse(status_requested)
+
+    def test_last_async_request_failure(self):
+        def ccb_issue(service):
+            raise ValueError("bad service")
+        with self.assertLogs():
+            with self.assertRaises(WorkerError):
+                self._run_experiment("LastAsyncRequestFailure",
+                                     {"ccb_issue": ccb_issue})
+
+    def test_process_pool(self):
+        async def run():
+            pool = WorkerProcessPool(1)
+            pool.start()
+            try:
+                while not pool._idle:
+                    await asyncio.sleep(0.1)
+                ipc, _ = pool._idle[0]
+                worker = Worker(process_pool=pool)
+                await _call_worker(worker, expid)
+                self.assertIs(worker.ipc, ipc)
+                while not pool._idle:
+                    await asyncio.sleep(0.1)
+                self.assertIsNot(pool._idle[0][0], ipc)
+            finally:
+                await pool.stop()
+            self.assertEqual(len(pool._idle), 0)
+
+        expid = {
+            "log_level": logging.WARNING,
+            "file": sys.modules[__name__].__file__,
+            "class_name": "SimpleExperiment",
+            "arguments": dict()
+        }
+        self.loop.run_until_complete(run())
+
+    def test_results(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.chdir(tmpdir)
+            try:
+                self._run_experiment("ResultsExperiment")
+            finally:
+                os.chdir(cwd)
+            # the file is complete once the worker process has exited
+            filename, = glob.glob(os.path.join(
+                tmpdir, "results", "*", "*", "000000000-ResultsExperiment.h5"))
+            with h5py.File(filename, "r") as f:
+                self.assertEqual(f["datasets"]["data"].shape, (1000000, ))
+                self.assertEqual(f["rid"][()], 0)
+
+    def test_wait_results(self):
+        async def run():
+            worker = Worker()
+            try:
+                await worker.build(0, "main", None, expid, 0)
+                await worker.prepare()
+                await worker.run()
+                await worker.analyze()
+                self.assertTrue(worker.results_pending)
+                await worker.wait_results()
+                self.assertFalse(worker.results_pending)
+                # the file is complete before the worker process exits
+                filename, = glob.glob(os.path.join(
+                    tmpdir, "results", "*", "*",
+                    "000000000-ResultsExperiment.h5"))
+                with h5py.File(filename, "r") as f:
+                    self.assertEqual(f["datasets"]["data"].shape,
+                                     (1000000, ))
+            finally:
+                await worker.close()
+
+        expid = {
+            "log_level": logging.WARNING,
+            "file": sys.modules[__name__].__file__,
+            "class_name": "ResultsExperiment",
+            "arguments": dict()
+        }
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.chdir(tmpdir)
+            try:
+                self.loop.run_until_complete(run())
+            finally:
+                os.chdir(cwd)
+
     def test_watchdog_no_timeout(self):
         self._run_experiment("WatchdogNoTimeout")
 
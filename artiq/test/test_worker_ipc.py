@@ -0,0 +1,47 @@
+import io
+import unittest
+
+import numpy
+
+from artiq.master import worker_ipc
+
+
+class WorkerIPCCase(unittest.TestCase):
+    def roundtrip(self, obj):
+        f = io.BytesIO()
+        worker_ipc.write(f, obj)
+        worker_ipc.write(f, {"action": "completed"})
+        f.seek(0)
+        result = worker_ipc.read_sync(f)
+        self.assertEqual(worker_ipc.read_sync(f), {"action": "completed"})
+        self.assertIsNone(worker_ipc.read_sync(f))
+        return result
+
+    def test_control(self):
+        obj = {"action": "build", "args": (1, "a", None), "kwargs": {}}
+        self.assertEqual(self.roundtrip(obj), obj)
+
+    def test_arrays(self):
+        arrays = [
+            numpy.arange(1000, dtype=numpy.int32).reshape(10, 100),
+            numpy.linspace(0, 1, 2000).reshape(100, 20).T,
+            numpy.zeros(200, dtype=[("a", "<i4"), ("b", "<f8")]),
+            numpy.arange(3)
+        ]
+        mods = [{"action": "setitem", "path": [], "key": str(i),
+                 "value": (False, array, {})}
+                for i, array in enumerate(arrays)]
+        result = self.roundtrip({"action": "update_dataset_batch",
+                                 "args": (mods, ), "kwargs": {}})
+        for mod, array in zip(result["args"][0], arrays):
+            value = mod["value"][1]
+            self.assertEqual(value.dtype, array.dtype)
+            numpy.testing.assert_array_equal(value, array)
+            self.assertTrue(value.flags.writeable)
+
+    def test_truncated(self):
+        f = io.BytesIO()
+        worker_ipc.write(f, {"data": numpy.zeros(1000)})
+        f = io.BytesIO(f.getvalue()[:-1])
+        with self.assertRaises(EOFError):
+            worker_ipc.read_sync(f)